@@ -1,8 +1,160 @@
-from lib.board_holder import board_holder
-from lib.pizza_stand import pizza_stand, pizza_stand_lid
+"""
+Generate the .scad file of each part, and export .stl files with OpenSCAD.
+
+Parts are built in parallel. A .scad file is only rewritten, and its .stl only
+re-exported, when the generated source changed since the last build.
+
+    $ uv run src/build.py                     # .scad files of all parts
+    $ uv run src/build.py --stl pizza_stand   # .scad and .stl of one part
+"""
+
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
 
 OUT_DIR = "."
 
-pizza_stand().save_as_scad(filename="pizza_stand.scad", outdir=OUT_DIR)
-pizza_stand_lid().save_as_scad(filename="pizza_stand_lid.scad", outdir=OUT_DIR)
-board_holder().save_as_scad(filename="board_holder.scad", outdir=OUT_DIR)
+# Part name -> (module, function returning its solid)
+PARTS = {
+    "pizza_stand": ("lib.pizza_stand", "pizza_stand"),
+    "pizza_stand_lid": ("lib.pizza_stand", "pizza_stand_lid"),
+    "board_holder": ("lib.board_holder", "board_holder"),
+}
+
+# Hashes of the .scad sources which the current .stl files were exported from
+HASHES_FILE = ".build_hashes.json"
+
+
+@dataclass
+class PartResult:
+    name: str
+    scad_hash: str
+    scad_written: bool
+    stl_exported: bool
+    render_seconds: float
+    export_seconds: float
+
+
+def sha256(data: str):
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def build_part(
+    name: str, out_dir: Path, stl_hash: Optional[str], stl: bool, openscad: str
+):
+    """Render a part to SCAD and, with `stl`, export it unless it is up to date."""
+    started_at = time.perf_counter()
+    module, func = PARTS[name]
+    # Written with a trailing newline, which as_scad() leaves out
+    scad = getattr(importlib.import_module(module), func)().as_scad().rstrip("\n")
+    scad += "\n"
+    scad_hash = sha256(scad)
+
+    # Left untouched if unchanged, so that make does not see it as modified
+    scad_path = out_dir / f"{name}.scad"
+    scad_written = (
+        not scad_path.exists()
+        or sha256(scad_path.read_text(encoding="utf-8")) != scad_hash
+    )
+    if scad_written:
+        scad_path.write_text(scad, encoding="utf-8")
+    render_seconds = time.perf_counter() - started_at
+
+    stl_path = out_dir / f"{name}.stl"
+    stl_exported = stl and (stl_hash != scad_hash or not stl_path.exists())
+    export_seconds = 0.0
+    if stl_exported:
+        started_at = time.perf_counter()
+        subprocess.run([openscad, "-o", str(stl_path), str(scad_path)], check=True)
+        export_seconds = time.perf_counter() - started_at
+
+    return PartResult(
+        name, scad_hash, scad_written, stl_exported, render_seconds, export_seconds
+    )
+
+
+def load_hashes(path: Path) -> dict:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("parts", nargs="*", help=f"Default: all of {', '.join(PARTS)}")
+    parser.add_argument(
+        "--stl", action="store_true", help="Also export .stl files with OpenSCAD."
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Export .stl files even if unchanged.",
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=None)
+    parser.add_argument("-o", "--out-dir", type=Path, default=Path(OUT_DIR))
+    args = parser.parse_args()
+
+    parts = args.parts or list(PARTS)
+    if unknown := [x for x in parts if x not in PARTS]:
+        parser.error(f"Unknown parts: {', '.join(unknown)}")
+    openscad = os.environ.get("OPENSCAD", "openscad-nightly")
+    hashes_path = args.out_dir / HASHES_FILE
+    hashes = load_hashes(hashes_path)
+
+    started_at = time.perf_counter()
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.jobs or len(parts)) as executor:
+        futures = {
+            executor.submit(
+                build_part,
+                x,
+                args.out_dir,
+                None if args.force else hashes.get(x),
+                args.stl,
+                openscad,
+            ): x
+            for x in parts
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                res = future.result()
+            except Exception as e:
+                print(f"{name:<16} failed: {e}", file=sys.stderr)
+                failed.append(name)
+                continue
+
+            if res.stl_exported:
+                hashes[name] = res.scad_hash
+                # Recorded as soon as each part is done, so a failure of another
+                # part does not re-export this one next time
+                hashes_path.write_text(
+                    json.dumps(hashes, indent=2, sort_keys=True), encoding="utf-8"
+                )
+
+            scad = "written" if res.scad_written else "unchanged"
+            stl = "exported" if res.stl_exported else "skipped"
+            print(
+                f"{name:<16} scad {scad:<9} {res.render_seconds:6.2f}s  "
+                f"stl {stl:<8} {res.export_seconds:6.2f}s"
+            )
+
+    elapsed = time.perf_counter() - started_at
+    print(f"Built {len(parts) - len(failed)}/{len(parts)} parts in {elapsed:.2f}s.")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+SRC_DIR = Path(__file__).parent.parent / "src"
+
+# Stands in for lib/ (solids of solidpython2), whose parts render to fixed SCAD
+STUB_PART = """
+class Solid:
+    def __init__(self, name):
+        self.name = name
+
+    def as_scad(self):
+        return f"// {{self.name}}\\ncube({size});"
+
+{funcs}
+"""
+
+# Stands in for OpenSCAD: writes the -o file, and logs each export
+STUB_OPENSCAD = """#!/bin/sh
+echo "$2" >> "$(dirname "$0")/openscad.log"
+echo solid > "$2"
+"""
+
+
+@pytest.fixture
+def stubs(tmp_path: Path):
+    lib = tmp_path / "stubs" / "lib"
+    lib.mkdir(parents=True)
+    (lib / "__init__.py").write_text("")
+    parts = {
+        "pizza_stand": ["pizza_stand", "pizza_stand_lid"],
+        "board_holder": ["board_holder"],
+    }
+    for module, funcs in parts.items():
+        defs = "\n".join(f"def {x}():\n    return Solid({x!r})\n" for x in funcs)
+        (lib / f"{module}.py").write_text(STUB_PART.format(size=1, funcs=defs))
+
+    openscad = tmp_path / "openscad"
+    openscad.write_text(STUB_OPENSCAD)
+    openscad.chmod(0o755)
+    return tmp_path
+
+
+def build(stubs: Path, *args: str):
+    env = {
+        **os.environ,
+        # The stubs come first, should lib/ exist in src/
+        "PYTHONPATH": os.pathsep.join([str(stubs / "stubs"), str(SRC_DIR)]),
+        "OPENSCAD": str(stubs / "openscad"),
+    }
+    proc = subprocess.run(
+        [sys.executable, "-c", "import build; build.main()", *args],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return proc.stdout
+
+
+def exports(stubs: Path):
+    log = stubs / "openscad.log"
+    return log.read_text().splitlines() if log.exists() else []
+
+
+def test_second_build_skips_unchanged(stubs: Path):
+    out_dir = stubs / "out"
+    out_dir.mkdir()
+
+    stdout = build(stubs, "--stl", "-o", str(out_dir))
+    assert stdout.count("scad written") == 3
+    assert stdout.count("stl exported") == 3
+    assert len(exports(stubs)) == 3
+    scad = out_dir / "pizza_stand.scad"
+    assert scad.read_text(encoding="utf-8") == "// pizza_stand\ncube(1);\n"
+    mtimes = {x: x.stat().st_mtime_ns for x in out_dir.glob("*.scad")}
+
+    stdout = build(stubs, "--stl", "-o", str(out_dir))
+    assert stdout.count("scad unchanged") == 3
+    assert stdout.count("stl skipped") == 3
+    assert len(exports(stubs)) == 3
+    assert {x: x.stat().st_mtime_ns for x in out_dir.glob("*.scad")} == mtimes
+
+
+def test_changed_part_is_rebuilt(stubs: Path):
+    out_dir = stubs / "out"
+    out_dir.mkdir()
+    build(stubs, "--stl", "-o", str(out_dir))
+
+    module = stubs / "stubs" / "lib" / "board_holder.py"
+    module.write_text(module.read_text().replace("cube(1)", "cube(2)"))
+    stdout = build(stubs, "--stl", "-o", str(out_dir))
+
+    assert stdout.count("scad written") == 1
+    assert exports(stubs)[3:] == [str(out_dir / "board_holder.stl")]
+
+
+def test_force_exports_unchanged(stubs: Path):
+    out_dir = stubs / "out"
+    out_dir.mkdir()
+    build(stubs, "--stl", "-o", str(out_dir))
+
+    stdout = build(stubs, "--stl", "--force", "-o", str(out_dir), "pizza_stand")
+    assert "scad unchanged" in stdout
+    assert "stl exported" in stdout
+    assert exports(stubs)[3:] == [str(out_dir / "pizza_stand.stl")]
@@ -1,113 +1,160 @@
-import json
+import asyncio
+import os
+import time
 from pathlib import Path
-from typing import List
+from typing import Optional
 
 import typer
-from litellm import Choices, completion
-from litellm.types.utils import ModelResponse
-from pydantic import BaseModel
 
-from pizza_gen.logger import get_logger  # TODO: use a proper logger
+from pizza_gen.logger import get_logger, setup_logging  # TODO: use a proper logger
 
 logger = get_logger(__name__)
 
 app = typer.Typer()
 
 
-class Prompt(BaseModel):
-    thing: str
-    prompt: str
-
-
-output_examples = [
-    {
-        "thing": "marble",
-        "prompt": "A highly detailed, photorealistic image of a single, perfectly round, polished onyx marble. The marble rests on a smooth, dark wooden surface, illuminated by soft, diffused natural light. The lighting creates a gentle, subtle highlight on the top curve of the sphere, emphasizing its smoothness and perfect circular form. The onyx has subtle, swirling white veins, captured in sharp detail. The background is slightly blurred, emphasizing the crisp focus on the marble. The overall atmosphere is serene and minimalistic. Shot from a slightly elevated angle, the viewer looks down upon the marble, showcasing its three-dimensional roundness.",
-    },
-    {
-        "thing": "ferris wheel",
-        "prompt": "A photorealistic, wide-angle shot of a large, illuminated ferris wheel at night. The circular structure is brightly lit with colorful lights, showcasing its intricate design and towering height. The shot is taken from a low angle, emphasizing the scale and grandeur of the wheel against a dark, starry sky. The long exposure captures the motion blur of the lights as the wheel slowly rotates. The overall atmosphere is vibrant and festive.",
-    },
-]
-
-
-base_prompt = """
-Generate a high-quality image generation prompt for Stable Diffusion, with at least 20 words, formatted as a JSON object.
-
-Rules:
-
-1.  **Clarity and Simplicity:** Use clear, concise, and non-abstract English words. Sentences should be short and easily understood.
-2. **Focus on Circular Appearance:** The prompt must describe a single, specific object.  The final depiction of the object in the image *must* appear as a near-perfect circle or a perfect circle. This circular appearance can result from the object's inherent shape, the chosen viewpoint, or a combination of both. The object itself does not need to be inherently round.
-3.  **Detailed Description:**  Provide a detailed description of the object, including its texture, material, color, and any relevant details that contribute to its visual appearance.
-4. **Viewpoint/Angle:** Specify the viewing angle (e.g., bird's-eye view, close-up, from below) if it is crucial to achieving the circular appearance. If a specific angle is required to perceive the object as circular, it *must* be included.
-5.  **No Imperative Forms:** Avoid using commands or imperative verbs (e.g., "Create," "Generate," "Make").  Describe the scene as it *is*.
-6.  **Singular Noun:** The object name must be a singular noun.
-7.  **Lighting and Atmosphere:** Describe the lighting conditions (e.g., soft, bright, dim, natural light, studio lighting) and the overall atmosphere or mood (e.g., serene, dramatic, mysterious).
-8.  **Photorealistic Style:** The generated image should be a photorealistic photograph.
-9.  **Output Format:** The output must be a JSON object with "thing" and "prompt" keys.
-10. **Circular Composition:** The object should be composed in such a way that its circularity is the dominant visual feature. The prompt should emphasize aspects of the scene that contribute to this circular composition.
-11. **Prohibited Items:** Do not generate a prompt for the following items nor similar items: {blocklist}
-12. **Positive and Appealing Imagery:** The subject matter and its depiction must be generally perceived as positive, appealing, and suitable for a broad audience.  Avoid anything that could be considered disturbing, frightening, disgusting, gruesome, or otherwise offensive.  Specifically, do not include insects, spiders, webs, decay, bodily fluids, weapons, violence, or anything associated with harm or distress.
-"""
-
-
-def generate_base_prompt(blocklist: List[str]):
-    return base_prompt.format(blocklist=",".join(blocklist))
-
-
 @app.command()
 def genearte(
     model: str = typer.Option("ollama_chat/gemma2:9b", "-m", "--model"),
-    num_prompts: int = typer.Option(3, "-n", "--num-prompts"),
+    num_prompts: int = typer.Option(
+        3, "-n", "--num-prompts", help="Including prompts resumed from --stream-path."
+    ),
     output_file_path: Path = typer.Option(
-        "circular_things.json", "-o", "--output-file-path"
+        "circular_things.json",
+        "-o",
+        "--output-file-path",
+        help="A JSON array exported at the end, or a JSONL file to stream to.",
+    ),
+    stream_path: Optional[Path] = typer.Option(
+        None,
+        "--stream-path",
+        help="JSONL file prompts are appended to. Defaults to -o with '.jsonl'.",
+    ),
+    resume: bool = typer.Option(
+        True, "--resume/--no-resume", help="Keep prompts in --stream-path."
+    ),
+    fsync_every: int = typer.Option(10, "--fsync-every"),
+    export_only: bool = typer.Option(
+        False, "--export-only", is_flag=True, help="Export --stream-path to -o."
     ),
     temperature: float = typer.Option(0.7, "-t", "--temperature"),
+    concurrency: int = typer.Option(
+        1, "-j", "--concurrency", help="Max requests in flight."
+    ),
+    requests_per_minute: Optional[float] = typer.Option(
+        None, "--rpm", help="Rate limit of the model endpoint."
+    ),
+    dedupe: bool = typer.Option(
+        True, "--dedupe/--no-dedupe", help="Reject near-duplicate things or prompts."
+    ),
+    blocklist_size: Optional[int] = typer.Option(
+        50,
+        "--blocklist-size",
+        help="Max things listed in each request (others are rejected locally).",
+    ),
+    seed: Optional[int] = typer.Option(
+        None, "--seed", help="Passed to the model and used to sample the blocklist."
+    ),
+    # Cache
+    cache_path: Path = typer.Option(
+        ".cache/circular_prompt_gen/llm.sqlite",
+        "--cache-path",
+        help="With --seed, responses of identical requests are reused from here.",
+    ),
+    cache_max_mb: float = typer.Option(256, "--cache-max-mb"),
+    no_cache: bool = typer.Option(
+        False, "--no-cache", is_flag=True, help="Neither read nor write the cache."
+    ),
     # Others
     debug: bool = typer.Option(
         False, "--debug", is_flag=True, help="Enable debugging outputs"
     ),
 ):
-    outputs = []
-    blocklist = [
-        "clock",
-        "watch",
-        "person",
-    ]
-    for i in range(num_prompts):
-        response = completion(
-            messages=[
-                {
-                    "role": "user",
-                    "content": generate_base_prompt(blocklist),
-                },
-                *[
-                    {
-                        "role": "user",
-                        "content": f"Example: {json.dumps(x, ensure_ascii=False)}",
-                    }
-                    for x in output_examples
-                ],
-            ],
-            model=model,
-            response_format=Prompt,
-            temperature=temperature,
-            num_retries=100,
-            retry_strategy="exponential_backoff_retry",
+    # pydantic and litellm are slow to import, see `pizza_gen check-startup`
+    from circular_prompt_gen.output import PromptWriter, export_json, load_prompts
+    from circular_prompt_gen.prompts import Prompt
+
+    setup_logging()
+
+    if stream_path is None:
+        stream_path = output_file_path.with_suffix(".jsonl")
+    # Unless streaming to -o itself, export a JSON array to -o
+    export_path = output_file_path if output_file_path != stream_path else None
+
+    outputs = load_prompts(stream_path) if resume or export_only else []
+    if export_only:
+        if export_path is None:
+            raise typer.BadParameter("-o must differ from --stream-path.")
+        export_json(outputs, export_path)
+        logger.info(f"Exported {len(outputs)} prompts to '{export_path}'.")
+        return
+
+    # Use the bundled cost map instead of fetching it on import
+    os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+    from circular_prompt_gen.llm_cache import LLMCache
+    from circular_prompt_gen.runner import Blocklist, RateLimiter, agenerate_prompts
+    from circular_prompt_gen.similarity import NearDuplicateIndex
+
+    if outputs:
+        logger.info(f"Resuming with {len(outputs)} prompts in '{stream_path}'.")
+
+    blocklist = Blocklist(
+        [x.thing for x in outputs],
+        pinned=[
+            "clock",
+            "watch",
+            "person",
+        ],
+        max_size=blocklist_size or None,
+        seed=seed,
+    )
+
+    near_duplicates = None
+    if dedupe:
+        near_duplicates = NearDuplicateIndex()
+        for x in outputs:
+            near_duplicates.add(x)
+
+    writer = PromptWriter(stream_path, fsync_every=fsync_every)
+
+    def on_prompt(prompt: Prompt):
+        outputs.append(prompt)
+        writer.append(prompt)
+
+    # Without a seed, sampling is meant to differ between runs, so replaying cached
+    # responses would defeat asking again
+    cache = None
+    if seed is not None and not no_cache:
+        cache = LLMCache(cache_path, max_bytes=int(cache_max_mb * 1024**2))
+
+    rate_limiter = None
+    if requests_per_minute:
+        rate_limiter = RateLimiter(requests_per_minute, burst=concurrency)
+
+    started_at = time.perf_counter()
+    with writer.open(truncate=not resume):
+        stats = asyncio.run(
+            agenerate_prompts(
+                model=model,
+                num_prompts=max(num_prompts - len(outputs), 0),
+                blocklist=blocklist,
+                on_prompt=on_prompt,
+                temperature=temperature,
+                concurrency=concurrency,
+                rate_limiter=rate_limiter,
+                near_duplicates=near_duplicates,
+                cache=cache,
+                seed=seed,
+            )
         )
+    if cache:
+        cache.close()
 
-        if not isinstance(response, ModelResponse):
-            continue
-        if not isinstance(response.choices[0], Choices):
-            continue
-        if response.choices[0].message.content is None:
-            logger.error("Failed to get content. Skipping.")
-            continue
-
-        prompt = Prompt.model_validate_json(response.choices[0].message.content)
-        logger.info(prompt)
-        outputs.append(prompt)
-        blocklist.append(prompt.thing)
+    if export_path:
+        export_json(outputs, export_path)
+        logger.info(f"Exported {len(outputs)} prompts to '{export_path}'.")
 
-        with output_file_path.open("w") as fp:
-            json.dump([dict(x) for x in outputs], fp, ensure_ascii=False)
+    elapsed = time.perf_counter() - started_at
+    logger.info(
+        f"Generated {stats.accepted} prompts in {elapsed:.1f}s ({stats.summary()})."
+    )
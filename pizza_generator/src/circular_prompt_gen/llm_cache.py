@@ -0,0 +1,133 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Type
+
+from litellm.types.utils import ModelResponse
+from pydantic import BaseModel
+
+from pizza_gen.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Bump when the key layout changes
+KEY_VERSION = 1
+
+
+def request_key(
+    model: str,
+    messages: List[Dict[str, Any]],
+    response_format: Optional[Type[BaseModel]],
+    temperature: Optional[float],
+    seed: Optional[int],
+    occurrence: int = 0,
+) -> str:
+    """
+    Key a completion request. `occurrence` tells identical requests of a run apart,
+    so that e.g. concurrent requests with the same blocklist get distinct responses.
+    """
+    normalized = {
+        "version": KEY_VERSION,
+        "model": model.strip().lower(),
+        "messages": [
+            {"role": x["role"], "content": " ".join(str(x["content"]).split())}
+            for x in messages
+        ],
+        "schema": response_format.model_json_schema() if response_format else None,
+        "temperature": temperature,
+        "seed": seed,
+        "occurrence": occurrence,
+    }
+    data = json.dumps(normalized, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """
+    SQLite-backed cache of completion responses. WAL mode lets several processes
+    read and write the same file; the least recently used entries are evicted
+    once `max_bytes` is exceeded.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = 256 * 1024**2) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._occurrences: Counter = Counter()
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed_at "
+            "ON responses (accessed_at)"
+        )
+        self._conn.commit()
+
+    def next_key(self, **request: Any) -> str:
+        """Key the next occurrence of `request` in this run."""
+        base = request_key(**request)
+        with self._lock:
+            occurrence = self._occurrences[base]
+            self._occurrences[base] += 1
+        return request_key(**request, occurrence=occurrence)
+
+    def get(self, key: str) -> Optional[ModelResponse]:
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key)
+            )
+
+        logger.debug(f"LLM cache hit: {key=}")
+        return ModelResponse(**json.loads(row[0]))
+
+    def put(self, key: str, response: ModelResponse):
+        data = response.model_dump_json()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, data, len(data), time.time()),
+            )
+            (total,) = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            if total > self.max_bytes:
+                self._evict(total)
+
+    def _evict(self, total: int):
+        # Leave some headroom to avoid evicting on every put
+        target = self.max_bytes * 0.9
+        rows = self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at"
+        ).fetchall()
+
+        evicted = []
+        for key, size in rows:
+            if total <= target:
+                break
+            evicted.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        logger.debug(f"Evicted {len(evicted)} LLM cache entries.")
+
+    def close(self):
+        self._conn.close()
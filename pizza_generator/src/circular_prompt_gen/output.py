@@ -0,0 +1,88 @@
+import json
+import os
+from pathlib import Path
+from typing import List, Optional
+
+from pydantic import ValidationError
+
+from circular_prompt_gen.prompts import Prompt
+from pizza_gen.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def load_prompts(path: Path) -> List[Prompt]:
+    """Load a JSONL file of prompts, skipping broken lines (e.g. a torn write)."""
+    if not path.exists():
+        return []
+
+    prompts = []
+    with path.open(encoding="utf-8") as fp:
+        for i, line in enumerate(fp):
+            if not line.strip():
+                continue
+            try:
+                prompts.append(Prompt.model_validate_json(line))
+            except ValidationError:
+                logger.warning(f"Skipping a broken line {i + 1} of '{path}'.")
+    return prompts
+
+
+def export_json(prompts: List[Prompt], path: Path):
+    """Write prompts as a JSON array (the format circular-set and jq recipes read)."""
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with tmp_path.open("w", encoding="utf-8") as fp:
+        json.dump([dict(x) for x in prompts], fp, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class PromptWriter:
+    """
+    Append prompts to a JSONL file, one write per line, fsync'ed every
+    `fsync_every` prompts and on close. A crash loses at most the unsynced lines.
+    """
+
+    def __init__(self, path: Path, fsync_every: int = 10) -> None:
+        self.path = path
+        self.fsync_every = fsync_every
+        self._fd: Optional[int] = None
+        self._unsynced = 0
+
+    def open(self, truncate: bool = False):
+        flags = os.O_RDWR | os.O_APPEND | os.O_CREAT
+        if truncate:
+            flags |= os.O_TRUNC
+        self._fd = os.open(self.path, flags, 0o644)
+
+        # Do not glue the next prompt to a torn write
+        size = os.fstat(self._fd).st_size
+        if size and os.pread(self._fd, 1, size - 1) != b"\n":
+            os.write(self._fd, b"\n")
+
+        return self
+
+    def append(self, prompt: Prompt):
+        assert self._fd is not None
+        line = prompt.model_dump_json() + "\n"
+        os.write(self._fd, line.encode("utf-8"))
+
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        if self._fd is not None and self._unsynced:
+            os.fsync(self._fd)
+            self._unsynced = 0
+
+    def close(self):
+        if self._fd is not None:
+            self.sync()
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
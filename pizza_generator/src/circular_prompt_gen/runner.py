@@ -0,0 +1,265 @@
+import asyncio
+import random
+import time
+from dataclasses import dataclass
+from typing import Callable, Iterable, List, Optional
+
+from litellm import Choices, acompletion
+from litellm.types.utils import ModelResponse
+
+from circular_prompt_gen.llm_cache import LLMCache
+from circular_prompt_gen.prompts import Prompt, build_messages
+from circular_prompt_gen.similarity import NearDuplicateIndex
+from pizza_gen.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class RateLimiter:
+    """Token bucket allowing `requests_per_minute` on average, in bursts of `burst`."""
+
+    def __init__(self, requests_per_minute: float, burst: int = 1) -> None:
+        self.interval = 60.0 / requests_per_minute
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        # Waiters are served in order, as the lock is held while sleeping
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated_at) / self.interval
+                )
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) * self.interval)
+
+
+def normalize_thing(thing: str):
+    return " ".join(thing.lower().split())
+
+
+class Blocklist:
+    """
+    Things not to generate again. Requests see a snapshot taken when they are sent,
+    so concurrent requests may still come up with the same thing; `add` rejects
+    those, keeping the accepted things unique.
+
+    With `max_size`, snapshots keep the LLM input bounded: `pinned` things, the most
+    recent half and a random sample of older things. Things left out are still
+    rejected by `add`.
+    """
+
+    def __init__(
+        self,
+        things: Iterable[str] = (),
+        pinned: Iterable[str] = (),
+        max_size: Optional[int] = None,
+        seed: Optional[int] = None,
+    ) -> None:
+        self.things: List[str] = []
+        self.max_size = max_size
+        self._keys = set()
+        self._rng = random.Random(seed)
+
+        for x in pinned:
+            self.add(x)
+        self._num_pinned = len(self.things)
+        for x in things:
+            self.add(x)
+
+    def __contains__(self, thing: str):
+        return normalize_thing(thing) in self._keys
+
+    def __len__(self):
+        return len(self.things)
+
+    def add(self, thing: str):
+        """Add `thing` unless already present. Returns whether it was added."""
+        key = normalize_thing(thing)
+        if key in self._keys:
+            return False
+        self._keys.add(key)
+        self.things.append(thing)
+        return True
+
+    def snapshot(self):
+        if self.max_size is None or len(self.things) <= self.max_size:
+            return list(self.things)
+
+        pinned = self.things[: self._num_pinned]
+        rest = self.things[self._num_pinned :]
+
+        budget = max(self.max_size - len(pinned), 0)
+        num_recent = budget // 2
+        older = rest[: len(rest) - num_recent]
+        recent = rest[len(rest) - num_recent :]
+        sampled = self._rng.sample(older, budget - num_recent)
+
+        return pinned + sampled + recent
+
+
+@dataclass
+class RunStats:
+    requests: int = 0
+    accepted: int = 0
+    duplicates: int = 0
+    failures: int = 0
+    # Served from the cache, without tokens
+    cached: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    def summary(self):
+        requests = max(self.requests - self.failures - self.cached, 1)
+        return (
+            f"{self.requests} requests ({self.cached} cached), "
+            f"{self.duplicates} duplicates, "
+            f"{self.failures} failures, "
+            f"{self.prompt_tokens / requests:.0f}+"
+            f"{self.completion_tokens / requests:.0f} tokens/request"
+        )
+
+
+def parse_response(response) -> Optional[Prompt]:
+    if not isinstance(response, ModelResponse):
+        return None
+    if not isinstance(response.choices[0], Choices):
+        return None
+    if response.choices[0].message.content is None:
+        logger.error("Failed to get content. Skipping.")
+        return None
+
+    return Prompt.model_validate_json(response.choices[0].message.content)
+
+
+async def agenerate_prompts(
+    model: str,
+    num_prompts: int,
+    blocklist: Blocklist,
+    on_prompt: Callable[[Prompt], None],
+    temperature: float = 0.7,
+    concurrency: int = 1,
+    rate_limiter: Optional[RateLimiter] = None,
+    max_requests: Optional[int] = None,
+    near_duplicates: Optional[NearDuplicateIndex] = None,
+    cache: Optional[LLMCache] = None,
+    seed: Optional[int] = None,
+):
+    """
+    Generate `num_prompts` prompts of things not in `blocklist` with up to
+    `concurrency` requests in flight.
+
+    Each request reserves one of the remaining prompts before it is sent, so no more
+    requests are in flight than prompts still needed. Reservations of failed or
+    duplicate responses are released for the next request. Responses similar to
+    accepted ones in `near_duplicates` count as duplicates too.
+
+    Responses are looked up in `cache` first, and `seed` is passed to providers
+    supporting it. Cache hits skip `rate_limiter`.
+    """
+    if max_requests is None:
+        max_requests = num_prompts * 4
+
+    stats = RunStats()
+    reserved = 0
+
+    def reserve():
+        nonlocal reserved
+        if stats.accepted + reserved >= num_prompts:
+            return False
+        if stats.requests >= max_requests:
+            return False
+        reserved += 1
+        stats.requests += 1
+        return True
+
+    async def worker():
+        nonlocal reserved
+        while reserve():
+            usage = None
+            cached = False
+            try:
+                request = dict(
+                    messages=build_messages(blocklist.snapshot()),
+                    model=model,
+                    response_format=Prompt,
+                    temperature=temperature,
+                    seed=seed,
+                )
+                key = cache.next_key(**request) if cache else None
+                response = cache.get(key) if cache and key else None
+                cached = response is not None
+
+                if not cached:
+                    if rate_limiter:
+                        await rate_limiter.acquire()
+
+                    response = await acompletion(
+                        **{k: v for k, v in request.items() if v is not None},
+                        num_retries=100,
+                        retry_strategy="exponential_backoff_retry",
+                    )
+                    if cache and key and isinstance(response, ModelResponse):
+                        cache.put(key, response)
+                prompt = parse_response(response)
+
+                if cached:
+                    stats.cached += 1
+                # Not every provider reports usage
+                elif usage := getattr(response, "usage", None):
+                    stats.prompt_tokens += usage.prompt_tokens
+                    stats.completion_tokens += usage.completion_tokens
+                    logger.debug(
+                        f"Tokens: {usage.prompt_tokens} prompt, "
+                        f"{usage.completion_tokens} completion"
+                    )
+            except Exception as e:
+                logger.error(f"Request failed: {e}")
+                prompt = None
+            finally:
+                reserved -= 1
+
+            if prompt is None:
+                stats.failures += 1
+            elif near_duplicates is not None and (
+                match := near_duplicates.find(prompt)
+            ):
+                logger.warning(
+                    f"Rejected a near-duplicate: {prompt.thing} "
+                    f"(~{match.thing} by {match.field}, {match.similarity:.2f})"
+                )
+                # Still tell the model to avoid it
+                blocklist.add(prompt.thing)
+                stats.duplicates += 1
+            elif not blocklist.add(prompt.thing):
+                logger.warning(f"Rejected a duplicate: {prompt.thing}")
+                stats.duplicates += 1
+            else:
+                if near_duplicates is not None:
+                    near_duplicates.add(prompt)
+                stats.accepted += 1
+                suffix = ""
+                if cached:
+                    suffix = " (cached)"
+                elif usage:
+                    suffix = (
+                        f" ({usage.prompt_tokens}+{usage.completion_tokens} tokens)"
+                    )
+                logger.info(f"{prompt}{suffix}")
+                on_prompt(prompt)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+    if stats.accepted < num_prompts:
+        logger.warning(
+            f"Gave up after {stats.requests} requests "
+            f"({stats.accepted}/{num_prompts} prompts)."
+        )
+
+    return stats
@@ -0,0 +1,176 @@
+import re
+import zlib
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import (
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+import numpy as np
+
+from circular_prompt_gen.prompts import Prompt
+
+K = TypeVar("K", bound=Hashable)
+
+# Mersenne prime; with a, b and x below it, a * x + b fits in uint64
+_PRIME = np.uint64((1 << 31) - 1)
+
+_ARTICLES = re.compile(r"^(a|an|the)\s+")
+_WORDS = re.compile(r"[a-z0-9]+")
+
+
+def normalize_text(text: str):
+    return _ARTICLES.sub("", " ".join(text.lower().split()))
+
+
+def char_shingles(text: str, n: int = 3) -> Set[str]:
+    """Character n-grams ignoring spaces, so "mirror ball" ~ "mirrorball"."""
+    text = normalize_text(text).replace(" ", "")
+    if len(text) <= n:
+        return {text}
+    return {text[i : i + n] for i in range(len(text) - n + 1)}
+
+
+def word_shingles(text: str, n: int = 2) -> Set[str]:
+    words = _WORDS.findall(text.lower())
+    if len(words) <= n:
+        return {" ".join(words)}
+    return {" ".join(words[i : i + n]) for i in range(len(words) - n + 1)}
+
+
+def jaccard(a: Set[str], b: Set[str]):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+Measure = Callable[[Set[str], Set[str]], float]
+
+
+class MinHashLSH(Generic[K]):
+    """
+    MinHash signatures bucketed by LSH bands, so that a query only compares
+    against keys sharing a band (sublinear in the number of keys). Candidates
+    are verified with `measure` over their shingles.
+
+    With `bands` of `num_perm / bands` rows, pairs whose Jaccard similarity is
+    above roughly (1 / bands) ** (bands / num_perm) are likely to be candidates.
+    """
+
+    def __init__(
+        self,
+        num_perm: int = 64,
+        bands: int = 16,
+        measure: Measure = jaccard,
+        seed: int = 1,
+    ) -> None:
+        if num_perm % bands:
+            raise Exception(f"{num_perm=} must be divisible by {bands=}.")
+
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _PRIME, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, _PRIME, size=num_perm, dtype=np.uint64)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.measure = measure
+
+        self._shingles: Dict[K, Set[str]] = {}
+        self._buckets: List[Dict[bytes, List[K]]] = [
+            defaultdict(list) for _ in range(bands)
+        ]
+
+    def __len__(self):
+        return len(self._shingles)
+
+    def signature(self, shingles: Set[str]) -> np.ndarray:
+        # crc32 is stable across processes, unlike hash()
+        x = np.fromiter(
+            (zlib.crc32(s.encode("utf-8")) for s in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        hashes = (np.outer(x % _PRIME, self._a) + self._b) % _PRIME
+        return hashes.min(axis=0) if len(x) else np.full_like(self._a, _PRIME)
+
+    def _band_keys(self, signature: np.ndarray):
+        for i in range(self.bands):
+            yield i, signature[i * self.rows : (i + 1) * self.rows].tobytes()
+
+    def add(self, key: K, shingles: Set[str]):
+        self._shingles[key] = shingles
+        for i, band in self._band_keys(self.signature(shingles)):
+            self._buckets[i][band].append(key)
+
+    def query(self, shingles: Set[str], threshold: float) -> List[Tuple[K, float]]:
+        """Return (key, similarity) above `threshold`, the most similar first."""
+        candidates = set()
+        for i, band in self._band_keys(self.signature(shingles)):
+            candidates.update(self._buckets[i].get(band, ()))
+
+        matches = [(x, self.measure(shingles, self._shingles[x])) for x in candidates]
+        matches = [x for x in matches if x[1] >= threshold]
+        return sorted(matches, key=lambda x: -x[1])
+
+
+@dataclass
+class Match:
+    # "thing" or "prompt"
+    field: str
+    thing: str
+    similarity: float
+
+
+class NearDuplicateIndex:
+    """
+    Find near-duplicates of prompts by their thing (character trigrams) or by
+    their prompt text (word bigrams), without any network or GPU.
+    """
+
+    def __init__(
+        self, thing_threshold: float = 0.75, prompt_threshold: float = 0.6
+    ) -> None:
+        self.thing_threshold = thing_threshold
+        self.prompt_threshold = prompt_threshold
+        # Things are short, so use narrow bands to find partial overlaps too.
+        # 0.75 catches spacing and plurals ("mirror ball" ~ "mirrorball", "donut" ~
+        # "donuts"), but not "orange" ~ "orange peel"
+        self._things: MinHashLSH[int] = MinHashLSH(bands=32)
+        self._prompts: MinHashLSH[int] = MinHashLSH()
+        self._entries: List[Prompt] = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def find(self, prompt: Prompt) -> Optional[Match]:
+        for field, index, shingles, threshold in (
+            ("thing", self._things, char_shingles(prompt.thing), self.thing_threshold),
+            (
+                "prompt",
+                self._prompts,
+                word_shingles(prompt.prompt),
+                self.prompt_threshold,
+            ),
+        ):
+            if matches := index.query(shingles, threshold):
+                key, similarity = matches[0]
+                return Match(field, self._entries[key].thing, similarity)
+        return None
+
+    def add(self, prompt: Prompt):
+        key = len(self._entries)
+        self._entries.append(prompt)
+        self._things.add(key, char_shingles(prompt.thing))
+        self._prompts.add(key, word_shingles(prompt.prompt))
+
+    def add_if_unique(self, prompt: Prompt) -> Optional[Match]:
+        """Add `prompt` unless it has a near-duplicate, which is returned instead."""
+        if match := self.find(prompt):
+            return match
+        self.add(prompt)
+        return None
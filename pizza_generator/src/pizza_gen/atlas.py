@@ -0,0 +1,198 @@
+import hashlib
+import io
+import math
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from pizza_gen.catalog import Catalog, CatalogRecord, Kind
+from pizza_gen.logger import get_logger
+from pizza_gen.postprocess import SAVE_OPTIONS
+
+logger = get_logger(__name__)
+
+# GL_MAX_TEXTURE_SIZE of the Pi Zero 2 W (VideoCore IV)
+MAX_ATLAS_SIZE = 2048
+
+# Pixels around each frame, so that scaled frames do not bleed into their neighbors
+# (filled with the webui's black background)
+FRAME_PADDING = 2
+
+
+@dataclass
+class AtlasLayout:
+    """
+    `num_frames` frames of `width` x `height` (padding included), in a grid of `cols`
+    x `rows`.
+    """
+
+    num_frames: int
+    cols: int
+    rows: int
+    width: int
+    height: int
+
+    @property
+    def size(self):
+        return self.cols * self.width, self.rows * self.height
+
+
+def plan_atlases(
+    num_frames: int, frame_size: Tuple[int, int], max_size: int, padding: int
+):
+    """Split `num_frames` into as few near-square atlases of `max_size` as possible."""
+    width, height = frame_size[0] + 2 * padding, frame_size[1] + 2 * padding
+    max_cols, max_rows = max_size // width, max_size // height
+    if max_cols == 0 or max_rows == 0:
+        raise Exception(f"Frames of {frame_size} do not fit atlases of {max_size}px")
+
+    num_atlases = math.ceil(num_frames / (max_cols * max_rows))
+    # Spread frames evenly, so that the last atlas is not mostly empty
+    per_atlas, extra = divmod(num_frames, num_atlases)
+    capacity = per_atlas + (extra > 0)
+    # Widened when frames are tall, so that the rows still fit in `max_size`
+    cols = max(math.ceil(math.sqrt(capacity)), math.ceil(capacity / max_rows))
+    cols = min(max_cols, cols)
+
+    layouts = []
+    for i in range(num_atlases):
+        n = per_atlas + (i < extra)
+        layouts.append(AtlasLayout(n, cols, math.ceil(n / cols), width, height))
+    return layouts
+
+
+def select_frames(
+    catalog: Catalog,
+    kind: Kind,
+    num_variants: int = 1,
+    things: Optional[List[str]] = None,
+    **filters,
+):
+    """
+    Up to `num_variants` existing images per category (pizza) or thing (circular),
+    in order of category or thing, then of path (like export_manifest).
+    """
+    groups: Dict[tuple, List[CatalogRecord]] = defaultdict(list)
+    for x in sorted(catalog.query(kind=kind, **filters), key=lambda x: x.path):
+        if things is not None and x.thing not in things:
+            continue
+        if kind == "pizza":
+            key: tuple = (x.total_num_pieces or 0, x.num_pieces or 0)
+        else:
+            key = (x.thing or "",)
+        if len(groups[key]) >= num_variants:
+            continue
+        if not catalog.exists(x):
+            logger.warning(f"'{x.path}' does not exist. Skipping.")
+            continue
+        groups[key].append(x)
+
+    # A clock needs every frame of its set
+    if kind == "pizza":
+        for total in sorted({total for total, _ in groups}):
+            missing = [f"{n}p" for n in range(total + 1) if not groups.get((total, n))]
+            if missing:
+                logger.warning(f"No frames of {', '.join(missing)} ({total}p set).")
+    elif things is not None:
+        missing = [x for x in things if not groups.get((x,))]
+        if missing:
+            logger.warning(f"No frames of {', '.join(missing)}.")
+
+    return [x for key in sorted(groups) for x in groups[key]]
+
+
+def _encode(image: Image.Image, format: str, quality: Optional[int]):
+    options = dict(SAVE_OPTIONS.get(format, {}))
+    if quality is not None:
+        options["quality"] = quality
+    with io.BytesIO() as output:
+        image.save(output, format=format, **options)
+        return output.getvalue()
+
+
+def export_atlas(
+    catalog: Catalog,
+    records: List[CatalogRecord],
+    kind: Kind,
+    atlas_dir: Path,
+    name: str,
+    base_url: str,
+    frame_width: Optional[int] = None,
+    max_size: int = MAX_ATLAS_SIZE,
+    padding: int = FRAME_PADDING,
+    format: str = "webp",
+    quality: Optional[int] = None,
+):
+    """
+    Pack the images of `records` into atlases in `atlas_dir` and return a manifest
+    of where the frames are, e.g.
+
+        {"type": "pizza", "frame": {"width": 480, "height": 480},
+         "atlases": [{"path": "<base_url>/<name>.0.<hash>.webp", ...}],
+         "files": [{"category": "3p", "atlas": 0, "x": 2, "y": 486}]}
+
+    where x, y are the top-left corner of each frame (padding excluded). Atlases are
+    named by content, so they can be cached forever.
+    """
+    if not records:
+        raise Exception("No frames to export")
+    atlas_dir.mkdir(parents=True, exist_ok=True)
+
+    with Image.open(catalog.root / records[0].path) as im:
+        if frame_width is None:
+            frame_size = im.size
+        else:
+            frame_size = (frame_width, round(im.height * frame_width / im.width))
+
+    atlases = []
+    files = []
+    start = 0
+    for i, layout in enumerate(
+        plan_atlases(len(records), frame_size, max_size, padding)
+    ):
+        frames = records[start : start + layout.num_frames]
+        start += layout.num_frames
+
+        atlas = Image.new("RGB", layout.size)
+        for j, x in enumerate(frames):
+            left = (j % layout.cols) * layout.width + padding
+            top = (j // layout.cols) * layout.height + padding
+            with Image.open(catalog.root / x.path) as im:
+                frame = ImageOps.pad(
+                    im.convert("RGB"), frame_size, Image.Resampling.LANCZOS
+                )
+            atlas.paste(frame, (left, top))
+
+            file: dict = {"atlas": i, "x": left, "y": top}
+            if x.category is not None:
+                file["category"] = x.category
+            if x.thing is not None:
+                file["thing"] = x.thing
+            files.append(file)
+
+        data = _encode(atlas, format, quality)
+        digest = hashlib.sha256(data).hexdigest()[:8]
+        filename = f"{name}.{i}.{digest}.{format}"
+        (atlas_dir / filename).write_bytes(data)
+        logger.info(
+            f"Packed {len(frames)} frames in '{filename}' ({len(data):,} bytes)."
+        )
+
+        width, height = layout.size
+        atlases.append(
+            {
+                "path": f"{base_url.rstrip('/')}/{filename}",
+                "width": width,
+                "height": height,
+            }
+        )
+
+    return {
+        "type": kind,
+        "frame": {"width": frame_size[0], "height": frame_size[1]},
+        "atlases": atlases,
+        "files": files,
+    }
@@ -0,0 +1,343 @@
+import asyncio
+import base64
+import io
+import itertools
+import json
+import math
+import time
+from contextlib import ExitStack
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from PIL import Image
+from rich.table import Table
+from webuiapi import raw_b64_img
+
+from pizza_gen.circular_gen import CircularGen
+from pizza_gen.guides import circle_guide, render_circle_guide, seg_guide
+from pizza_gen.logger import console, get_logger
+from pizza_gen.mock_server import MockConfig, MockSDServer
+from pizza_gen.pizza_gen import PizzaGen
+from pizza_gen.pool import ServerPool
+from pizza_gen.seg_raster import render_seg_map
+
+logger = get_logger(__name__)
+
+
+def percentile(values: List[float], q: float):
+    """Nearest-rank percentile, `q` in [0, 100]."""
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    rank = max(math.ceil(q / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+@dataclass
+class PathResult:
+    name: str
+    num_images: int
+    wall_seconds: float
+    latencies: List[float] = field(repr=False)
+    # Seconds the mock servers spent per image (sleeping and painting)
+    server_seconds: float = 0.0
+
+    @property
+    def images_per_second(self):
+        return self.num_images / self.wall_seconds
+
+    @property
+    def p50(self):
+        return percentile(self.latencies, 50)
+
+    @property
+    def p99(self):
+        return percentile(self.latencies, 99)
+
+    @property
+    def client_overhead(self):
+        """Mean per-image latency not spent on the server."""
+        return sum(self.latencies) / self.num_images - self.server_seconds
+
+    def summary(self):
+        return {
+            "num_images": self.num_images,
+            "images_per_second": self.images_per_second,
+            "p50": self.p50,
+            "p99": self.p99,
+            "client_overhead": self.client_overhead,
+        }
+
+
+@dataclass
+class BenchConfig:
+    num_images: int = 20
+    width: int = 720
+    latency: float = 0.05
+    num_servers: int = 2
+    max_in_flight: int = 2
+    candidates: int = 4
+    latency_per_image: float = 0.01
+
+
+def _time_calls(fn: Callable[[], object], n: int):
+    latencies = []
+    for _ in range(n):
+        started_at = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - started_at)
+    return latencies
+
+
+def _server_seconds(servers: List[MockSDServer], num_images: int):
+    total = sum(x.stats.busy_seconds for x in servers)
+    for x in servers:
+        x.stats.busy_seconds = 0.0
+    return total / num_images
+
+
+def bench_pizza(config: BenchConfig, server: MockSDServer):
+    gen = PizzaGen(server_url=server.url, width=config.width, num_pieces=1)
+    # Warm up the model cache
+    gen.generate(seed=0)
+    _server_seconds([server], 1)
+
+    frames = itertools.cycle(range(13))
+    started_at = time.perf_counter()
+    latencies = _time_calls(
+        lambda: gen.generate(num_pieces=next(frames)), config.num_images
+    )
+    wall = time.perf_counter() - started_at
+
+    return PathResult(
+        "pizza",
+        config.num_images,
+        wall,
+        latencies,
+        _server_seconds([server], config.num_images),
+    )
+
+
+def bench_circular(config: BenchConfig, server: MockSDServer):
+    gen = CircularGen(server_url=server.url, width=config.width)
+    gen.generate(prompt="A photo of a coffee cup", seed=0)
+    _server_seconds([server], 1)
+
+    started_at = time.perf_counter()
+    latencies = _time_calls(
+        lambda: gen.generate(prompt="A photo of a coffee cup"), config.num_images
+    )
+    wall = time.perf_counter() - started_at
+
+    return PathResult(
+        "circular",
+        config.num_images,
+        wall,
+        latencies,
+        _server_seconds([server], config.num_images),
+    )
+
+
+def bench_candidates(config: BenchConfig, server: MockSDServer):
+    """Like bench_pizza, but with `candidates` images per request."""
+    k = config.candidates
+    gen = PizzaGen(
+        server_url=server.url, width=config.width, num_pieces=1, candidates=k
+    )
+    gen.generate(seed=0)
+    _server_seconds([server], 1)
+
+    frames = itertools.cycle(range(13))
+    num_requests = max(config.num_images // k, 1)
+    started_at = time.perf_counter()
+    request_latencies = _time_calls(
+        lambda: gen.generate_candidates(num_pieces=next(frames)), num_requests
+    )
+    wall = time.perf_counter() - started_at
+
+    # Per image, like the other paths
+    num_images = num_requests * k
+    return PathResult(
+        "candidates",
+        num_images,
+        wall,
+        [x / k for x in request_latencies for _ in range(k)],
+        _server_seconds([server], num_images),
+    )
+
+
+def bench_batch(config: BenchConfig, servers: List[MockSDServer]):
+    gen = PizzaGen(server_url=servers[0].url, width=config.width, num_pieces=1)
+    latencies: List[float] = []
+
+    async def job(client, num_pieces: int):
+        started_at = time.perf_counter()
+        await gen.agenerate(client, num_pieces=num_pieces)
+        latencies.append(time.perf_counter() - started_at)
+
+    async def run():
+        async with ServerPool(
+            [x.url for x in servers], max_in_flight=config.max_in_flight
+        ) as pool:
+            # Warm up the model cache of every server
+            for x in pool.servers:
+                await asyncio.to_thread(gen.model_cache.get, x.client)
+            started_at = time.perf_counter()
+            await pool.map(
+                (lambda client, n=i % 13: job(client, n))
+                for i in range(config.num_images)
+            )
+            return time.perf_counter() - started_at
+
+    wall = asyncio.run(run())
+
+    return PathResult(
+        "batch",
+        config.num_images,
+        wall,
+        latencies,
+        _server_seconds(servers, config.num_images),
+    )
+
+
+def bench_stages(config: BenchConfig, server: MockSDServer, n: int = 20):
+    """Mean seconds of the client-side stages of a single pizza request."""
+    gen = PizzaGen(server_url=server.url, width=config.width, num_pieces=6)
+    args = gen._prepare_txt2img_args(gen.client)
+    units = args["controlnet_units"]
+
+    res = gen.client.txt2img(**args, use_async=False)
+    response_json = json.dumps(res.json)
+
+    def seg_map_cold():
+        render_seg_map.cache_clear()
+        render_seg_map(config.width, 6, 12)
+
+    def seg_guide_cold():
+        seg_guide.cache_clear()
+        seg_guide(config.width, 6, 12)
+
+    def decode_response():
+        r = json.loads(response_json)
+        for x in r["images"]:
+            Image.open(io.BytesIO(base64.b64decode(x))).load()
+
+    def save_webp():
+        with io.BytesIO() as output:
+            res.image.save(output, format="webp")
+
+    stages: Dict[str, Callable[[], object]] = {
+        "seg_map (cold)": seg_map_cold,
+        "seg_map (cached)": lambda: render_seg_map(config.width, 6, 12),
+        "seg_guide (cold)": seg_guide_cold,
+        "prepare_args": lambda: gen._prepare_txt2img_args(gen.client),
+        "encode_cn_units": lambda: [x.to_dict() for x in units],
+        "decode_response": decode_response,
+        "save_webp": save_webp,
+    }
+
+    return {name: sum(_time_calls(fn, n)) / n for name, fn in stages.items()}
+
+
+def bench_payloads(config: BenchConfig):
+    """Bytes sent per request, with guides encoded once vs. by webuiapi each time."""
+    seg_map = render_seg_map(config.width, 6, 12)
+    return {
+        "seg_guide": seg_guide(config.width, 6, 12).nbytes,
+        "seg_guide (webuiapi)": len(raw_b64_img(seg_map)),
+        "circle_guide": circle_guide(config.width).nbytes,
+        "circle_guide (webuiapi)": len(
+            raw_b64_img(render_circle_guide(config.width).convert("RGBA"))
+        ),
+    }
+
+
+def run_benchmarks(config: BenchConfig):
+    mock_config = MockConfig(
+        latency=config.latency, latency_per_image=config.latency_per_image
+    )
+
+    with ExitStack() as stack:
+        servers = [
+            stack.enter_context(MockSDServer(mock_config))
+            for _ in range(config.num_servers)
+        ]
+
+        paths = [
+            bench_pizza(config, servers[0]),
+            bench_circular(config, servers[0]),
+            bench_candidates(config, servers[0]),
+            bench_batch(config, servers),
+        ]
+        stages = bench_stages(config, servers[0])
+
+    return {
+        "config": asdict(config),
+        "paths": {x.name: x.summary() for x in paths},
+        "stages": stages,
+        "payloads": bench_payloads(config),
+    }
+
+
+def print_report(report: dict):
+    table = Table(title="Generation paths")
+    for col in ["path", "images", "images/s", "p50 (ms)", "p99 (ms)", "overhead (ms)"]:
+        table.add_column(col, justify="right")
+    for name, x in report["paths"].items():
+        table.add_row(
+            name,
+            str(x["num_images"]),
+            f"{x['images_per_second']:.2f}",
+            f"{x['p50'] * 1000:.1f}",
+            f"{x['p99'] * 1000:.1f}",
+            f"{x['client_overhead'] * 1000:.1f}",
+        )
+    console.print(table)
+
+    table = Table(title="Client-side stages (pizza)")
+    table.add_column("stage")
+    table.add_column("mean (ms)", justify="right")
+    for name, seconds in report["stages"].items():
+        table.add_row(name, f"{seconds * 1000:.2f}")
+    console.print(table)
+
+    table = Table(title="Request payloads")
+    table.add_column("payload")
+    table.add_column("bytes", justify="right")
+    for name, size in report.get("payloads", {}).items():
+        table.add_row(name, f"{size:,}")
+    console.print(table)
+
+
+def compare_with_baseline(report: dict, baseline_path: Path, max_regression: float):
+    """Return messages for every metric that regressed more than `max_regression`."""
+    with baseline_path.open(encoding="utf-8") as fp:
+        baseline = json.load(fp)
+
+    regressions = []
+
+    def check(name: str, current: float, base: Optional[float], lower_is_better=True):
+        if base is None or base <= 0:
+            return
+        ratio = current / base if lower_is_better else base / current
+        if ratio > 1 + max_regression:
+            regressions.append(f"{name}: {base:.4g} -> {current:.4g}")
+
+    for name, x in report["paths"].items():
+        base = baseline.get("paths", {}).get(name, {})
+        check(
+            f"{name}.client_overhead", x["client_overhead"], base.get("client_overhead")
+        )
+        check(
+            f"{name}.images_per_second",
+            x["images_per_second"],
+            base.get("images_per_second"),
+            lower_is_better=False,
+        )
+    for name, seconds in report["stages"].items():
+        check(f"stages.{name}", seconds, baseline.get("stages", {}).get(name))
+    for name, size in report.get("payloads", {}).items():
+        check(f"payloads.{name}", size, baseline.get("payloads", {}).get(name))
+
+    return regressions
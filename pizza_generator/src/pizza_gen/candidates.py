@@ -0,0 +1,124 @@
+import importlib
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import webuiapi
+from PIL import Image
+
+from pizza_gen.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Takes a candidate image and its info, returns a score (higher is better)
+Scorer = Callable[[Image.Image, dict], float]
+
+# Per-batch lists, replaced by the values of each candidate
+BATCH_INFO_KEYS = (
+    "all_prompts",
+    "all_negative_prompts",
+    "all_seeds",
+    "all_subseeds",
+    "infotexts",
+)
+
+
+@dataclass
+class Candidate:
+    """One of the images generated by a single (batch) request."""
+
+    image: Image.Image
+    info: dict
+    seed: Optional[int]
+    infotext: Optional[str]
+    score: Optional[float] = None
+
+
+def batch_images(res: webuiapi.WebUIApiResult, batch_size: int):
+    """
+    The generated images of a response. The server may put a grid before them and
+    ControlNet detected maps after them.
+    """
+    first = 0
+    if isinstance(res.info, dict):
+        first = res.info.get("index_of_first_image", 0)
+    return res.images[first : first + batch_size]
+
+
+def split_candidates(res: webuiapi.WebUIApiResult, batch_size: int):
+    """Split a response to `batch_size` candidates, each with its own seed and info."""
+    info = res.info if isinstance(res.info, dict) else {}
+    seeds = info.get("all_seeds") or []
+    infotexts = info.get("infotexts") or []
+
+    images = batch_images(res, batch_size)
+    if batch_size == 1:
+        return [
+            Candidate(
+                images[0], info, info.get("seed"), infotexts[0] if infotexts else None
+            )
+        ]
+
+    candidates = []
+    for i, image in enumerate(images):
+        seed = seeds[i] if i < len(seeds) else info.get("seed")
+        infotext = infotexts[i] if i < len(infotexts) else None
+
+        # Shaped like the info of a single image, so that outputs look the same
+        candidate_info = {k: v for k, v in info.items() if k not in BATCH_INFO_KEYS}
+        candidate_info.update(seed=seed, all_seeds=[seed])
+        if infotext is not None:
+            candidate_info["infotexts"] = [infotext]
+        candidate_info["candidate"] = {"index": i, "batch_size": batch_size}
+
+        candidates.append(Candidate(image, candidate_info, seed, infotext))
+
+    return candidates
+
+
+def rank_candidates(candidates: List[Candidate], scorer: Optional[Scorer]):
+    """
+    Score `candidates` with `scorer` and return them best first. Without a scorer,
+    keep the order of the batch.
+    """
+    if scorer is None or len(candidates) <= 1:
+        return list(candidates)
+
+    for x in candidates:
+        x.score = float(scorer(x.image, x.info))
+        x.info.setdefault("candidate", {})["score"] = x.score
+
+    return sorted(candidates, key=lambda x: x.score or 0.0, reverse=True)
+
+
+def sharpness(image: Image.Image, info: dict):
+    """Mean absolute Laplacian of the luma. Blurry or flat images score low."""
+    luma = np.asarray(image.convert("L"), dtype=np.float32)
+    laplacian = (
+        luma[:-2, 1:-1]
+        + luma[2:, 1:-1]
+        + luma[1:-1, :-2]
+        + luma[1:-1, 2:]
+        - 4 * luma[1:-1, 1:-1]
+    )
+    return float(np.abs(laplacian).mean())
+
+
+BUILTIN_SCORERS: Dict[str, Scorer] = {"sharpness": sharpness}
+
+
+def load_scorer(spec: str) -> Scorer:
+    """A built-in scorer by name, or any callable as 'package.module:function'."""
+    if spec in BUILTIN_SCORERS:
+        return BUILTIN_SCORERS[spec]
+
+    module_name, sep, attr = spec.partition(":")
+    if not sep:
+        raise Exception(
+            f"Unknown scorer: {spec} (expected one of {list(BUILTIN_SCORERS)} "
+            "or 'module:function')"
+        )
+    scorer = getattr(importlib.import_module(module_name), attr)
+    if not callable(scorer):
+        raise Exception(f"Scorer is not callable: {spec}")
+    return scorer
@@ -0,0 +1,227 @@
+import fcntl
+import os
+import re
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Literal, Optional
+
+from pydantic import BaseModel, Field, ValidationError
+
+from pizza_gen.logger import get_logger
+
+logger = get_logger(__name__)
+
+Kind = Literal["pizza", "circular"]
+
+PIZZA_FILENAME = re.compile(r"pizza_(?P<total>\d+)p_(?P<num>\d+)p_[0-9a-f]{40}$")
+CIRCULAR_FILENAME = re.compile(r"circular_(?:(?P<thing>.+)_)?[0-9a-f]{40}$")
+
+
+class CatalogRecord(BaseModel):
+    # Relative to the directory of the catalog
+    path: str
+    kind: Kind
+    num_pieces: Optional[int] = None
+    total_num_pieces: Optional[int] = None
+    thing: Optional[str] = None
+    seed: Optional[int] = None
+    fingerprint: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    # Seconds per stage, e.g. {"generate": 4.2, "server": 3.9, "save": 0.1}
+    # (see metrics.py)
+    timings: Dict[str, float] = Field(default_factory=dict)
+    # Bytes, e.g. {"request": 130000, "response": 710000, "image": 90000}
+    sizes: Dict[str, int] = Field(default_factory=dict)
+    created_at: float = Field(default_factory=time.time)
+    # Tombstone, see Catalog.remove()
+    deleted: bool = False
+
+    @property
+    def category(self):
+        return f"{self.num_pieces}p" if self.num_pieces is not None else None
+
+
+class Catalog:
+    """
+    Append-only JSONL index of generated images (one record per line).
+
+    Appends are atomic per line and fsync'ed, so a crash loses at most the record
+    being written. Later records of the same path supersede earlier ones; `compact`
+    drops the superseded ones.
+
+    Writers and readers lock `<catalog>.lock` rather than the catalog itself, which
+    `compact` replaces: a writer blocked on the old file would append to the
+    unlinked one.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    @property
+    def root(self):
+        return self.path.parent
+
+    @property
+    def lock_path(self):
+        return self.path.with_name(f"{self.path.name}.lock")
+
+    @contextmanager
+    def _locked(self, lock: int):
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, lock)
+            yield
+        finally:
+            os.close(fd)
+
+    def relative_path(self, path: Path):
+        try:
+            return str(path.resolve().relative_to(self.root.resolve()))
+        except ValueError:
+            return str(path.resolve())
+
+    def append(self, *records: CatalogRecord):
+        data = "".join(x.model_dump_json(exclude_defaults=True) + "\n" for x in records)
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._locked(fcntl.LOCK_EX):
+            fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                # Do not glue the new records to a torn write
+                size = os.fstat(fd).st_size
+                if size and os.pread(fd, 1, size - 1) != b"\n":
+                    data = "\n" + data
+                os.write(fd, data.encode("utf-8"))
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def remove(self, path: str):
+        for x in self.records():
+            if x.path == path:
+                self.append(x.model_copy(update={"deleted": True}))
+
+    def _read_lines(self) -> Iterator[CatalogRecord]:
+        if not self.path.exists():
+            return
+
+        with self._locked(fcntl.LOCK_SH):
+            # A torn write may end in the middle of a character
+            with self.path.open(encoding="utf-8", errors="replace") as fp:
+                for i, line in enumerate(fp):
+                    try:
+                        yield CatalogRecord.model_validate_json(line)
+                    except ValidationError:
+                        # e.g. a torn write after a crash
+                        logger.warning(f"Skipping a broken record at line {i + 1}.")
+
+    def records(self) -> List[CatalogRecord]:
+        """Return the latest, non-deleted record of every path."""
+        latest: Dict[str, CatalogRecord] = {}
+        for x in self._read_lines():
+            latest[x.path] = x
+
+        return [x for x in latest.values() if not x.deleted]
+
+    def query(
+        self,
+        kind: Optional[Kind] = None,
+        num_pieces: Optional[int] = None,
+        total_num_pieces: Optional[int] = None,
+        thing: Optional[str] = None,
+    ):
+        return [
+            x
+            for x in self.records()
+            if (kind is None or x.kind == kind)
+            and (num_pieces is None or x.num_pieces == num_pieces)
+            and (total_num_pieces is None or x.total_num_pieces == total_num_pieces)
+            and (thing is None or x.thing == thing)
+        ]
+
+    def compact(self, drop_missing: bool = False):
+        """Rewrite the catalog with only the latest records. Returns dropped count."""
+        if not self.path.exists():
+            return 0
+
+        with self._locked(fcntl.LOCK_EX):
+            lines = 0
+            latest: Dict[str, CatalogRecord] = {}
+            with self.path.open(encoding="utf-8", errors="replace") as fp:
+                for line in fp:
+                    lines += 1
+                    try:
+                        x = CatalogRecord.model_validate_json(line)
+                    except ValidationError:
+                        continue
+                    latest[x.path] = x
+
+            records = [
+                x
+                for x in latest.values()
+                if not x.deleted and not (drop_missing and not self.exists(x))
+            ]
+
+            tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+            with tmp_path.open("w", encoding="utf-8") as fp:
+                for x in records:
+                    fp.write(x.model_dump_json(exclude_defaults=True) + "\n")
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp_path, self.path)
+
+        return lines - len(records)
+
+    def exists(self, record: CatalogRecord):
+        return (self.root / record.path).exists()
+
+    def export_manifest(
+        self, kind: Kind, base_url: str, variant: Optional[str] = None, **filters
+    ):
+        """
+        Build the theme definition served by the webui (see webui/src/pages/theme),
+        e.g. {"type": "pizza", "files": [{"path": "...", "category": "3p"}]}.
+
+        `variant` (e.g. "240w.avif") points files to post-processed variants.
+        """
+        files = []
+        for x in sorted(self.query(kind=kind, **filters), key=lambda x: x.path):
+            path = Path(x.path)
+            name = f"{path.stem}.{variant}" if variant else path.name
+            file = {"path": f"{base_url.rstrip('/')}/{name}"}
+            if x.category is not None:
+                file["category"] = x.category
+            files.append(file)
+
+        return {"type": kind, "files": files}
+
+
+def record_from_filename(path: Path, catalog: Catalog) -> Optional[CatalogRecord]:
+    """Recover a record from an existing image following pizza_gen's naming."""
+    from PIL import Image
+
+    if m := PIZZA_FILENAME.match(path.stem):
+        kind: Kind = "pizza"
+        fields = dict(
+            num_pieces=int(m.group("num")), total_num_pieces=int(m.group("total"))
+        )
+    elif m := CIRCULAR_FILENAME.match(path.stem):
+        kind = "circular"
+        thing = m.group("thing")
+        fields = dict(thing=thing.replace("_", " ") if thing else None)
+    else:
+        return None
+
+    with Image.open(path) as im:
+        width, height = im.size
+
+    return CatalogRecord(
+        path=catalog.relative_path(path),
+        kind=kind,
+        width=width,
+        height=height,
+        created_at=path.stat().st_mtime,
+        **fields,
+    )
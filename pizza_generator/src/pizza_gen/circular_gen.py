@@ -1,10 +1,17 @@
-from typing import List, Optional, cast
-from urllib.parse import urlparse
+import asyncio
+from functools import partial
+from typing import Any, Dict, List, Optional
 
 import webuiapi
-from PIL import Image, ImageDraw
 
+from pizza_gen.candidates import Candidate, Scorer, rank_candidates, split_candidates
+from pizza_gen.guides import GuideUnit, circle_guide
 from pizza_gen.logger import console, get_logger
+from pizza_gen.metrics import stage
+from pizza_gen.model_cache import ControlNetModelCache
+from pizza_gen.result_cache import ResultCache
+from pizza_gen.runner import arun_txt2img, run_txt2img
+from pizza_gen.webui import create_client
 
 logger = get_logger(__name__)
 
@@ -16,67 +23,37 @@ class CircularGen:
         width: int,
         canny_weight: Optional[float] = None,
         debug: bool = False,
+        model_cache: Optional[ControlNetModelCache] = None,
+        result_cache: Optional[ResultCache] = None,
+        candidates: int = 1,
+        scorer: Optional[Scorer] = None,
     ) -> None:
         self.client = self._create_client(server_url)
         self.width = width
         self.canny_weight = canny_weight
         self.debug = debug
+        self.model_cache = model_cache or ControlNetModelCache()
+        self.result_cache = result_cache
+        # Images per request (batch_size), ranked by `scorer`
+        self.candidates = candidates
+        self.scorer = scorer
 
     def _create_client(self, url: str):
-        parsed = urlparse(url)
+        return create_client(url)
 
-        if parsed.hostname is None:
-            raise Exception("Failed to get hostname.")
-        if parsed.port is None:
-            raise Exception("Failed to get port.")
-
-        return webuiapi.WebUIApi(
-            host=parsed.hostname, port=parsed.port, use_https=parsed.scheme == "https"
-        )
-
-    def _prepare_canny_image(self):
-        image_size = (self.width, self.width)
-
-        im = Image.new("RGBA", image_size, "white")
-        draw = ImageDraw.Draw(im)
-
-        circle_d = image_size[0] * 0.90
-        circle_padding = (image_size[0] - circle_d) / 2
-
-        # Draw a circle
-        draw.ellipse(
-            (
-                (circle_padding, circle_padding),
-                (image_size[0] - circle_padding, image_size[1] - circle_padding),
-            ),
-            # The "DISH" class is not suitable for rendering an empty dish
-            fill="black",
-            outline="white",
-            width=0,
-        )
+    def _prepare_canny_guide(self):
+        with stage("canny_image"):
+            guide = circle_guide(self.width)
 
         if self.debug:
             logger.debug("Saving canny_image to debug_canny_image.png")
-            im.save("debug_canny_image.png")
-
-        return im
-
-    def _prepare_cn_canny_model(self, models: List[str], weight: float):
-        guide_image = self._prepare_canny_image()
+            guide.decode().save("debug_canny_image.png")
 
-        model = next((x for x in models if "sd15_canny" in x), None)
-        logger.debug(f"{model=}")
+        return guide
 
-        if model is None:
-            raise Exception(
-                (
-                    "Failed to find a proper canny model,"
-                    "which contains 'sd15_canny' in its name."
-                )
-            )
-
-        return webuiapi.ControlNetUnit(
-            image=guide_image,  # type: ignore
+    def _prepare_cn_canny_model(self, model: str, weight: float):
+        return GuideUnit(
+            self._prepare_canny_guide(),
             module="none",
             model=model,
             weight=weight,
@@ -97,23 +74,20 @@ class CircularGen:
 
         return neg_prompt
 
-    def generate(
+    def _prepare_txt2img_args(
         self,
+        client: webuiapi.WebUIApi,
         prompt: str,
         neg_prompt_override: Optional[str] = None,
         seed: int = -1,
-    ):
-        # Configure ControlNet units
-        cn = webuiapi.ControlNetInterface(self.client)
-        cn_models: List[str] = cn.model_list()
-        logger.debug(f"{cn_models=}")
-
+    ) -> Dict[str, Any]:
         canny_weight = 0.60
         if self.canny_weight is not None:
             canny_weight = self.canny_weight
 
         logger.debug(f"{canny_weight=}")
-        cn_units = [self._prepare_cn_canny_model(cn_models, canny_weight)]
+        canny_model = self.model_cache.resolve(client, "sd15_canny")
+        cn_units = [self._prepare_cn_canny_model(canny_model, canny_weight)]
 
         # Prepare prompts
         neg_prompt = self._prepare_prompts()
@@ -122,20 +96,91 @@ class CircularGen:
             neg_prompt = neg_prompt_override
         logger.debug(f"{prompt=}, {neg_prompt=}")
 
+        args = dict(
+            prompt=prompt,
+            negative_prompt=neg_prompt,
+            seed=seed,
+            cfg_scale=10,
+            steps=20,
+            width=self.width,
+            height=self.width,
+            sampler_name="Euler a",
+            controlnet_units=cn_units,
+            # webuiapi mutates its (shared) default, which races between
+            # concurrent requests
+            alwayson_scripts={},
+        )
+        # Only when needed, to keep fingerprints of single images as they were
+        if self.candidates > 1:
+            args["batch_size"] = self.candidates
+        return args
+
+    def generate_candidates(
+        self,
+        prompt: str,
+        neg_prompt_override: Optional[str] = None,
+        seed: int = -1,
+    ) -> List[Candidate]:
+        """Generate `candidates` images in one request and return them, best first."""
+        prepare_args = partial(
+            self._prepare_txt2img_args,
+            self.client,
+            prompt=prompt,
+            neg_prompt_override=neg_prompt_override,
+            seed=seed,
+        )
+
         # Generate image
         with console.status("Processing...", spinner="pong"):
-            res = self.client.txt2img(
-                prompt=prompt,
-                negative_prompt=neg_prompt,
-                seed=seed,
-                cfg_scale=10,
-                steps=20,
-                width=self.width,
-                height=self.width,
-                sampler_name="Euler a",
-                controlnet_units=cn_units,
-                use_async=False,
+            res = run_txt2img(
+                self.client, prepare_args, self.model_cache, self.result_cache
             )
-            res = cast(webuiapi.WebUIApiResult, res)
 
-        return res.image, res.info
+        return rank_candidates(split_candidates(res, self.candidates), self.scorer)
+
+    def generate(
+        self,
+        prompt: str,
+        neg_prompt_override: Optional[str] = None,
+        seed: int = -1,
+    ):
+        best = self.generate_candidates(prompt, neg_prompt_override, seed)[0]
+        return best.image, best.info
+
+    async def agenerate_candidates(
+        self,
+        client: webuiapi.WebUIApi,
+        prompt: str,
+        neg_prompt_override: Optional[str] = None,
+        seed: int = -1,
+    ) -> List[Candidate]:
+        """Same as `generate_candidates`, but against the given client."""
+        prepare_args = partial(
+            asyncio.to_thread,
+            self._prepare_txt2img_args,
+            client,
+            prompt=prompt,
+            neg_prompt_override=neg_prompt_override,
+            seed=seed,
+        )
+
+        res = await arun_txt2img(
+            client, prepare_args, self.model_cache, self.result_cache
+        )
+
+        return await asyncio.to_thread(
+            rank_candidates, split_candidates(res, self.candidates), self.scorer
+        )
+
+    async def agenerate(
+        self,
+        client: webuiapi.WebUIApi,
+        prompt: str,
+        neg_prompt_override: Optional[str] = None,
+        seed: int = -1,
+    ):
+        """Same as `generate`, but against the given client (e.g. from a ServerPool)."""
+        best = (
+            await self.agenerate_candidates(client, prompt, neg_prompt_override, seed)
+        )[0]
+        return best.image, best.info
@@ -1,33 +1,301 @@
+import asyncio
 import hashlib
 import json
+import time
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, cast
 
 import typer
-from PIL import Image
 
-from pizza_gen.circular_gen import CircularGen
-from pizza_gen.logger import enable_debug_log, get_logger
-from pizza_gen.pizza_gen import PizzaGen
+from pizza_gen.logger import enable_debug_log, get_logger, setup_logging
+from pizza_gen.metrics import Metrics, MetricsSummary, collect, record_size, stage
+
+# Heavy dependencies (webuiapi, PIL, numpy, pydantic...) are imported by the commands
+# needing them, to keep startup fast (see `check-startup`)
+if TYPE_CHECKING:
+    from PIL import Image
+
+    from pizza_gen.candidates import Candidate
+    from pizza_gen.catalog import Catalog
 
 logger = get_logger(__name__)
 
 app = typer.Typer()
+catalog_app = typer.Typer(help="Query and maintain the catalog of generated images")
+app.add_typer(catalog_app, name="catalog")
+queue_app = typer.Typer(help="Manage the job queue drained by run-queue")
+app.add_typer(queue_app, name="queue")
+library_app = typer.Typer(help="Find and prune near-duplicate images")
+app.add_typer(library_app, name="library")
+
+
+@app.callback()
+def main():
+    setup_logging()
 
 
-def save_image_safely(img: Image.Image, path: Path, force: bool = False):
+def save_image_safely(img: "Image.Image", path: Path, force: bool = False):
     if path.exists() and not force:
         logger.warning(f"'{path}' already exists. Skipping.")
-        return
+        return False
 
     img.save(path)
     logger.info(f"Successfully saved the image to '{path}'.")
+    return True
+
+
+def add_to_catalog(
+    catalog: Optional["Catalog"],
+    image_path: Path,
+    img: "Image.Image",
+    info: dict,
+    metrics: Optional[Metrics],
+    **fields,
+):
+    from pizza_gen.catalog import CatalogRecord
+
+    if catalog is None:
+        return
+
+    catalog.append(
+        CatalogRecord(
+            path=catalog.relative_path(image_path),
+            seed=info.get("seed"),
+            fingerprint=info.get("request_fingerprint"),
+            width=img.width,
+            height=img.height,
+            timings={k: round(v, 4) for k, v in metrics.timings.items()}
+            if metrics
+            else {},
+            sizes=dict(metrics.sizes) if metrics else {},
+            **fields,
+        )
+    )
+
+
+def save_pizza_outputs(
+    img: "Image.Image",
+    info: dict,
+    output_path: Path,
+    num_pieces: int,
+    total_num_pieces: int,
+    output_image_format: Path,
+    force: bool = False,
+    catalog: Optional["Catalog"] = None,
+    metrics: Optional[Metrics] = None,
+):
+    # Define filename
+    info_json = json.dumps(info, indent=2, ensure_ascii=False)
+    info_hash = hashlib.sha1(
+        info_json.encode("utf-8"), usedforsecurity=False
+    ).hexdigest()
+    base_filename = f"pizza_{total_num_pieces}p_{num_pieces}p_{info_hash}"
+
+    # Save outputs
+    image_path = output_path / f"{base_filename}.{output_image_format}"
+    json_path = output_path / f"{base_filename}.info.json"
+    with stage("save"):
+        saved = save_image_safely(img, image_path, force)
+
+        if not json_path.exists() or force:
+            with json_path.open("w", encoding="utf-8") as fp:
+                fp.write(info_json)
+                logger.info(f"Successfully saved info.json to '{json_path}'.")
+
+    if saved:
+        record_size("image", image_path.stat().st_size)
+        add_to_catalog(
+            catalog,
+            image_path,
+            img,
+            info,
+            metrics,
+            kind="pizza",
+            num_pieces=num_pieces,
+            total_num_pieces=total_num_pieces,
+        )
+
+    return image_path
+
+
+def save_circular_outputs(
+    img: "Image.Image",
+    info: dict,
+    output_path: Path,
+    output_filename_template: str,
+    output_image_format: Path,
+    force: bool = False,
+    catalog: Optional["Catalog"] = None,
+    metrics: Optional[Metrics] = None,
+    thing: Optional[str] = None,
+    **template_vars: str,
+):
+    # Define filename
+    info_hash = hashlib.sha1(
+        info["infotexts"][0].encode("utf-8"), usedforsecurity=False
+    ).hexdigest()
+    base_filename = output_filename_template.format(
+        INFO_HASH=info_hash, **template_vars
+    )
+
+    # Save outputs
+    image_path = output_path / f"{base_filename}.{output_image_format}"
+    json_path = output_path / f"{base_filename}.info.json"
+    with stage("save"):
+        saved = save_image_safely(img, image_path, force)
+
+        if not json_path.exists() or force:
+            with json_path.open("w", encoding="utf-8") as fp:
+                fp.write(json.dumps(info, indent=2, ensure_ascii=False))
+                logger.info(f"Successfully saved info.json to '{json_path}'.")
+
+    if saved:
+        record_size("image", image_path.stat().st_size)
+        add_to_catalog(
+            catalog,
+            image_path,
+            img,
+            info,
+            metrics,
+            kind="circular",
+            thing=thing,
+        )
+
+    return image_path
+
+
+def save_other_candidates(
+    candidates: List["Candidate"],
+    output_path: Path,
+    save: Callable[..., Path],
+):
+    """Save candidates which were not picked, for review (not cataloged)."""
+    if not candidates:
+        return
+    candidates_path = output_path / "candidates"
+    candidates_path.mkdir(parents=True, exist_ok=True)
+    for x in candidates:
+        save(x.image, x.info, output_path=candidates_path)
+
+
+def create_result_cache(path: Optional[Path], max_mb: int):
+    from pizza_gen.result_cache import ResultCache
+
+    if path is None:
+        return None
+    return ResultCache(path, max_bytes=max_mb * 1024**2)
+
+
+def create_depth_cache(path: Path, no_depth_cache: bool):
+    from pizza_gen.depth_maps import DepthMapCache
+
+    if no_depth_cache:
+        return None
+    return DepthMapCache(path)
+
+
+def create_post_processor(variants: List[str], max_workers: Optional[int]):
+    from pizza_gen.postprocess import PostProcessor, parse_variants
+
+    if not variants:
+        return None
+    try:
+        parsed = parse_variants(variants)
+    except ValueError as e:
+        raise typer.BadParameter(str(e))
+    return PostProcessor(parsed, max_workers=max_workers)
+
+
+def create_scorer(spec: Optional[str]):
+    from pizza_gen.candidates import load_scorer
+
+    if spec is None:
+        return None
+    try:
+        return load_scorer(spec)
+    except Exception as e:
+        raise typer.BadParameter(str(e))
+
+
+def create_catalog(path: Optional[Path], output_path: Path, no_catalog: bool):
+    from pizza_gen.catalog import Catalog
+
+    if no_catalog:
+        return None
+    return Catalog(path or output_path / "catalog.jsonl")
+
+
+def log_summary(summary: MetricsSummary, path: Optional[Path]):
+    if summary.images:
+        logger.info(f"Timings per image: {summary.describe()}")
+    if path:
+        summary.write(path)
+
+
+def log_chain_savings(
+    txt2img: MetricsSummary, img2img: MetricsSummary, sampling_steps: float
+):
+    """Compare frames chained by img2img with the txt2img frames starting chains."""
+    from pizza_gen.pizza_gen import STEPS
+
+    if not img2img.images:
+        return
+    logger.info(
+        f"Chained {img2img.images} frames by img2img: {sampling_steps:g} sampling "
+        f"steps per request vs {STEPS} ({1 - sampling_steps / STEPS:.0%} fewer)."
+    )
+    # Server time excludes queueing and transfer, if the server reports it
+    for name in ("server", "request"):
+        first, chained = txt2img.mean(name), img2img.mean(name)
+        if first and chained is not None:
+            logger.info(
+                f"Time per chained frame ({name}): {chained:.2f}s vs {first:.2f}s "
+                f"by txt2img ({1 - chained / first:.0%} less)."
+            )
+            break
+
+
+def log_metrics(metrics: Metrics, path: Optional[Path]):
+    summary = MetricsSummary()
+    summary.add(metrics)
+    log_summary(summary, path)
+
+
+class Progress:
+    def __init__(self, total: int) -> None:
+        self.total = total
+        self.done = 0
+        self.started_at = time.perf_counter()
+
+    def advance(self, label: str):
+        self.done += 1
+        elapsed = time.perf_counter() - self.started_at
+        logger.info(f"[{self.done}/{self.total}] {label} done ({elapsed:.1f}s).")
+
+    def finish(self):
+        elapsed = time.perf_counter() - self.started_at
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        logger.info(
+            f"Generated {self.done} images in {elapsed:.1f}s ({rate:.2f} images/s)."
+        )
 
 
 @app.command()
 def circular(
     # API
     server_url: str = typer.Option("http://127.0.0.1:7860", "-s", "--server-url"),
+    model_cache_path: Optional[Path] = typer.Option(
+        None, "--model-cache-path", help="Persist resolved ControlNet model names."
+    ),
+    model_cache_ttl: float = typer.Option(3600.0, "--model-cache-ttl"),
+    result_cache_path: Optional[Path] = typer.Option(
+        None,
+        "--result-cache-path",
+        help="Reuse results of identical requests (with a fixed --seed).",
+    ),
+    result_cache_max_mb: int = typer.Option(2048, "--result-cache-max-mb"),
     # New image
     width: int = typer.Option(720, "-W", "--width"),
     seed: int = typer.Option(-1, "--seed"),
@@ -36,61 +304,145 @@ def circular(
         None, "--negative-prompt-override"
     ),
     canny_weight: Optional[float] = typer.Option(None, "--canny-weight"),
+    num_candidates: int = typer.Option(
+        1, "-K", "--candidates", help="Images per request. The best one is kept."
+    ),
+    scorer: Optional[str] = typer.Option(
+        None,
+        "--scorer",
+        help="Rank candidates by 'sharpness' or 'module:function(image, info)'.",
+    ),
     # Output
     force_overwrite: bool = typer.Option(False, "-f", "--force-overwrite"),
     output_path: Path = typer.Option(".", "-o", "--output-path"),
     output_filename_template: str = typer.Option(
         "circular_{INFO_HASH}", "-t", "--output-filename-template"
     ),
+    save_candidates: bool = typer.Option(
+        False,
+        "--save-candidates",
+        is_flag=True,
+        help="Also save the other candidates to <output-path>/candidates.",
+    ),
     output_image_format: Path = typer.Option("webp", "-F", "--output-image-format"),
+    catalog_path: Optional[Path] = typer.Option(
+        None, "--catalog-path", help="Defaults to <output-path>/catalog.jsonl."
+    ),
+    no_catalog: bool = typer.Option(
+        False, "--no-catalog", is_flag=True, help="Do not record outputs."
+    ),
+    variants: List[str] = typer.Option(
+        [],
+        "-V",
+        "--variant",
+        help="Also encode WIDTH:FORMAT[:QUALITY] (e.g. 240:avif:50). Can be repeated.",
+    ),
+    post_workers: Optional[int] = typer.Option(
+        None, "--post-workers", help="Processes encoding variants."
+    ),
+    metrics_path: Optional[Path] = typer.Option(
+        None,
+        "--metrics-path",
+        help="Write stage timings and payload sizes (JSON, or Prometheus if *.prom).",
+    ),
     # Others
     debug: bool = typer.Option(
         False, "--debug", is_flag=True, help="Output intermediate images for debugging."
     ),
 ):
     """Generate something circular"""
+    from pizza_gen.circular_gen import CircularGen
+    from pizza_gen.model_cache import ControlNetModelCache
+
     # Parse args
     if debug:
         enable_debug_log()
 
     logger.debug(f"{output_path=}")
 
+    post_processor = create_post_processor(variants, post_workers)
+
     # Generate
     gen = CircularGen(
         server_url=server_url,
         width=width,
         canny_weight=canny_weight,
         debug=debug,
+        model_cache=ControlNetModelCache(ttl=model_cache_ttl, path=model_cache_path),
+        result_cache=create_result_cache(result_cache_path, result_cache_max_mb),
+        candidates=num_candidates,
+        scorer=create_scorer(scorer),
     )
-    img, info = gen.generate(
-        prompt=prompt,
-        neg_prompt_override=negative_prompt_override,
-        seed=seed,
-    )
+    with collect() as metrics:
+        with stage("generate"):
+            best, *others = gen.generate_candidates(
+                prompt=prompt,
+                neg_prompt_override=negative_prompt_override,
+                seed=seed,
+            )
 
-    # Define filename
-    info_hash = hashlib.sha1(
-        info["infotexts"][0].encode("utf-8"), usedforsecurity=False
-    ).hexdigest()
-    base_filename = output_filename_template.format(INFO_HASH=info_hash)
+        image_path = save_circular_outputs(
+            best.image,
+            best.info,
+            output_path=output_path,
+            output_filename_template=output_filename_template,
+            output_image_format=output_image_format,
+            force=force_overwrite,
+            catalog=create_catalog(catalog_path, output_path, no_catalog),
+            metrics=metrics,
+        )
+    log_metrics(metrics, metrics_path)
 
-    # Save outputs
-    image_path = output_path / f"{base_filename}.{output_image_format}"
-    save_image_safely(img, image_path, force_overwrite)
+    if save_candidates:
+        save_other_candidates(
+            others,
+            output_path,
+            partial(
+                save_circular_outputs,
+                output_filename_template=output_filename_template,
+                output_image_format=output_image_format,
+                force=force_overwrite,
+            ),
+        )
 
-    json_path = output_path / f"{base_filename}.info.json"
-    if not json_path.exists() or force_overwrite:
-        with json_path.open("w", encoding="utf-8") as fp:
-            fp.write(json.dumps(info, indent=2, ensure_ascii=False))
-            logger.info(f"Successfully saved info.json to '{json_path}'.")
+    if post_processor:
+        with post_processor:
+            post_processor.submit(image_path)
 
 
 @app.command()
 def pizza(
     # API
     server_url: str = typer.Option("http://127.0.0.1:7860", "-s", "--server-url"),
+    model_cache_path: Optional[Path] = typer.Option(
+        None, "--model-cache-path", help="Persist resolved ControlNet model names."
+    ),
+    model_cache_ttl: float = typer.Option(3600.0, "--model-cache-ttl"),
+    result_cache_path: Optional[Path] = typer.Option(
+        None,
+        "--result-cache-path",
+        help="Reuse results of identical requests (with a fixed --seed).",
+    ),
+    result_cache_max_mb: int = typer.Option(2048, "--result-cache-max-mb"),
+    depth_cache_path: Path = typer.Option(
+        ".cache/pizza_gen/depth_maps",
+        "--depth-cache-path",
+        help="Depth maps of guide images, computed once by the server.",
+    ),
+    no_depth_cache: bool = typer.Option(
+        False,
+        "--no-depth-cache",
+        is_flag=True,
+        help="Let the server preprocess depth guides with every request.",
+    ),
     # Input image
     guide_image: Optional[Path] = typer.Option(None, "-g", "--guide-image"),
+    two_stage: bool = typer.Option(
+        False,
+        "--two-stage",
+        is_flag=True,
+        help="Feed a strong-seg stage 1 image to stage 2 as its depth guide.",
+    ),
     # New image
     width: int = typer.Option(720, "-W", "--width"),
     seed: int = typer.Option(-1, "--seed"),
@@ -101,10 +453,59 @@ def pizza(
         None, "--negative-prompt-override"
     ),
     seg_weight: Optional[float] = typer.Option(None, "--seg-weight"),
+    jitter_seed: Optional[int] = typer.Option(
+        None,
+        "--jitter-seed",
+        help="Make the slice edges of seg maps reproducible. Defaults to --seed.",
+    ),
+    validate: bool = typer.Option(
+        False,
+        "--validate",
+        is_flag=True,
+        help="Resample images that do not show the right slices.",
+    ),
+    max_attempts: int = typer.Option(3, "--max-attempts", help="With --validate."),
+    num_candidates: int = typer.Option(
+        1, "-K", "--candidates", help="Images per request. The best one is kept."
+    ),
+    scorer: Optional[str] = typer.Option(
+        None,
+        "--scorer",
+        help="Rank by 'sharpness' or 'module:function' instead of the slice score.",
+    ),
     # Output
     force_overwrite: bool = typer.Option(False, "-f", "--force-overwrite"),
     output_path: Path = typer.Option(".", "-o", "--output-path"),
     output_image_format: Path = typer.Option("webp", "-F", "--output-image-format"),
+    save_candidates: bool = typer.Option(
+        False,
+        "--save-candidates",
+        is_flag=True,
+        help="Also save the other candidates to <output-path>/candidates.",
+    ),
+    catalog_path: Optional[Path] = typer.Option(
+        None, "--catalog-path", help="Defaults to <output-path>/catalog.jsonl."
+    ),
+    no_catalog: bool = typer.Option(
+        False, "--no-catalog", is_flag=True, help="Do not record outputs."
+    ),
+    variants: List[str] = typer.Option(
+        [],
+        "-V",
+        "--variant",
+        help="Also encode WIDTH:FORMAT[:QUALITY] (e.g. 240:avif:50). Can be repeated.",
+    ),
+    post_workers: Optional[int] = typer.Option(
+        None, "--post-workers", help="Processes encoding variants."
+    ),
+    metrics_path: Optional[Path] = typer.Option(
+        None,
+        "--metrics-path",
+        help="Write stage timings and payload sizes (JSON, or Prometheus if *.prom).",
+    ),
+    save_stage1: bool = typer.Option(
+        False, "--save-stage1", is_flag=True, help="Also save stage 1 images."
+    ),
     # Others
     debug: bool = typer.Option(
         False, "--debug", is_flag=True, help="Output intermediate images for debugging."
@@ -113,17 +514,30 @@ def pizza(
     """
     Generate pizza
     """
+    from PIL import Image
+
+    from pizza_gen.model_cache import ControlNetModelCache
+    from pizza_gen.pizza_gen import PizzaGen
+    from pizza_gen.validate import SliceValidator
+
     # Parse args
     if debug:
         enable_debug_log()
 
     logger.debug(f"{output_path=}")
 
+    if guide_image and two_stage:
+        raise typer.BadParameter("--guide-image cannot be used with --two-stage.")
+    if save_candidates and two_stage:
+        raise typer.BadParameter("--save-candidates cannot be used with --two-stage.")
+
     guide_image_ = None
     if guide_image:
         logger.info(f"Loading {guide_image=}")
         guide_image_ = Image.open(guide_image)
 
+    post_processor = create_post_processor(variants, post_workers)
+
     # Generate
     gen = PizzaGen(
         server_url=server_url,
@@ -132,28 +546,1433 @@ def pizza(
         total_num_pieces=total_num_pieces,
         seg_weight=seg_weight,
         debug=debug,
+        model_cache=ControlNetModelCache(ttl=model_cache_ttl, path=model_cache_path),
+        result_cache=create_result_cache(result_cache_path, result_cache_max_mb),
+        jitter_seed=jitter_seed,
+        validator=SliceValidator() if validate else None,
+        max_attempts=max_attempts,
+        candidates=num_candidates,
+        scorer=create_scorer(scorer),
+        depth_cache=create_depth_cache(depth_cache_path, no_depth_cache),
+    )
+    with collect() as metrics:
+        with stage("generate"):
+            if two_stage:
+                res = gen.generate_two_stage(
+                    prompt_override=prompt_override,
+                    neg_prompt_override=negative_prompt_override,
+                    seed=seed,
+                )
+                img, info = res.image, res.info
+
+                if save_stage1:
+                    (output_path / "stage1").mkdir(parents=True, exist_ok=True)
+                    save_pizza_outputs(
+                        res.stage1_image,
+                        res.stage1_info,
+                        output_path=output_path / "stage1",
+                        num_pieces=num_pieces,
+                        total_num_pieces=total_num_pieces,
+                        output_image_format=output_image_format,
+                        force=force_overwrite,
+                    )
+            else:
+                best, *others = gen.generate_candidates(
+                    depth_guide=guide_image_,
+                    prompt_override=prompt_override,
+                    neg_prompt_override=negative_prompt_override,
+                    seed=seed,
+                )
+                img, info = best.image, best.info
+
+        image_path = save_pizza_outputs(
+            img,
+            info,
+            output_path=output_path,
+            num_pieces=num_pieces,
+            total_num_pieces=total_num_pieces,
+            output_image_format=output_image_format,
+            force=force_overwrite,
+            catalog=create_catalog(catalog_path, output_path, no_catalog),
+            metrics=metrics,
+        )
+    log_metrics(metrics, metrics_path)
+
+    if save_candidates:
+        save_other_candidates(
+            others,
+            output_path,
+            partial(
+                save_pizza_outputs,
+                num_pieces=num_pieces,
+                total_num_pieces=total_num_pieces,
+                output_image_format=output_image_format,
+                force=force_overwrite,
+            ),
+        )
+
+    if post_processor:
+        with post_processor:
+            post_processor.submit(image_path)
+
+
+@app.command("pizza-set")
+def pizza_set(
+    # API
+    server_urls: List[str] = typer.Option(
+        ["http://127.0.0.1:7860"], "-s", "--server-url", help="Can be repeated."
+    ),
+    max_in_flight: int = typer.Option(
+        1, "-j", "--max-in-flight", help="Max concurrent jobs per server."
+    ),
+    model_cache_path: Optional[Path] = typer.Option(
+        None, "--model-cache-path", help="Persist resolved ControlNet model names."
+    ),
+    model_cache_ttl: float = typer.Option(3600.0, "--model-cache-ttl"),
+    result_cache_path: Optional[Path] = typer.Option(
+        None,
+        "--result-cache-path",
+        help="Reuse results of identical requests (with a fixed --seed).",
+    ),
+    result_cache_max_mb: int = typer.Option(2048, "--result-cache-max-mb"),
+    depth_cache_path: Path = typer.Option(
+        ".cache/pizza_gen/depth_maps",
+        "--depth-cache-path",
+        help="Depth maps of guide images, computed once by the server.",
+    ),
+    no_depth_cache: bool = typer.Option(
+        False,
+        "--no-depth-cache",
+        is_flag=True,
+        help="Let the server preprocess depth guides with every request.",
+    ),
+    # Input image
+    guide_image_template: Optional[str] = typer.Option(
+        None,
+        "-g",
+        "--guide-image-template",
+        help="e.g. 'ref_images/pizza_12p_{NUM_PIECES}p.webp'",
+    ),
+    two_stage: bool = typer.Option(
+        False,
+        "--two-stage",
+        is_flag=True,
+        help="Feed a strong-seg stage 1 image to stage 2 as its depth guide.",
+    ),
+    # New image
+    width: int = typer.Option(720, "-W", "--width"),
+    seed: int = typer.Option(-1, "--seed"),
+    start_num_pieces: int = typer.Option(0, "--start"),
+    total_num_pieces: int = typer.Option(12, "-N", "--total-num-pieces"),
+    num_variants: int = typer.Option(1, "-v", "--num-variants"),
+    prompt_override: Optional[str] = typer.Option(None, "--prompt-override"),
+    negative_prompt_override: Optional[str] = typer.Option(
+        None, "--negative-prompt-override"
+    ),
+    seg_weight: Optional[float] = typer.Option(None, "--seg-weight"),
+    jitter_seed: Optional[int] = typer.Option(
+        None,
+        "--jitter-seed",
+        help="Make the slice edges of seg maps reproducible. Defaults to --seed.",
+    ),
+    validate: bool = typer.Option(
+        False,
+        "--validate",
+        is_flag=True,
+        help="Resample images that do not show the right slices.",
+    ),
+    max_attempts: int = typer.Option(3, "--max-attempts", help="With --validate."),
+    num_candidates: int = typer.Option(
+        1, "-K", "--candidates", help="Images per request. The best one is kept."
+    ),
+    scorer: Optional[str] = typer.Option(
+        None,
+        "--scorer",
+        help="Rank by 'sharpness' or 'module:function' instead of the slice score.",
+    ),
+    chain: bool = typer.Option(
+        False,
+        "--chain",
+        is_flag=True,
+        help="Derive each frame from the previous one of its variant by img2img.",
+    ),
+    chain_denoising_strength: float = typer.Option(
+        0.5, "--chain-denoising-strength", help="With --chain."
+    ),
+    chain_steps: int = typer.Option(16, "--chain-steps", help="With --chain."),
+    # Output
+    force_overwrite: bool = typer.Option(False, "-f", "--force-overwrite"),
+    output_path: Path = typer.Option(".", "-o", "--output-path"),
+    output_image_format: Path = typer.Option("webp", "-F", "--output-image-format"),
+    save_candidates: bool = typer.Option(
+        False,
+        "--save-candidates",
+        is_flag=True,
+        help="Also save the other candidates to <output-path>/candidates.",
+    ),
+    catalog_path: Optional[Path] = typer.Option(
+        None, "--catalog-path", help="Defaults to <output-path>/catalog.jsonl."
+    ),
+    no_catalog: bool = typer.Option(
+        False, "--no-catalog", is_flag=True, help="Do not record outputs."
+    ),
+    variants: List[str] = typer.Option(
+        [],
+        "-V",
+        "--variant",
+        help="Also encode WIDTH:FORMAT[:QUALITY] (e.g. 240:avif:50). Can be repeated.",
+    ),
+    post_workers: Optional[int] = typer.Option(
+        None, "--post-workers", help="Processes encoding variants."
+    ),
+    metrics_path: Optional[Path] = typer.Option(
+        None,
+        "--metrics-path",
+        help="Write stage timings and payload sizes (JSON, or Prometheus if *.prom).",
+    ),
+    save_stage1: bool = typer.Option(
+        False, "--save-stage1", is_flag=True, help="Also save stage 1 images."
+    ),
+    # Others
+    debug: bool = typer.Option(
+        False, "--debug", is_flag=True, help="Output intermediate images for debugging."
+    ),
+):
+    """
+    Generate a full set of pizza (from --start to --total-num-pieces) in one process
+
+    With --chain, the frames of each variant are generated in order, each from the
+    previous one (img2img with fewer steps), so that a set looks consistent.
+    """
+    from PIL import Image
+
+    from pizza_gen.catalog import Catalog
+    from pizza_gen.guides import REUSED_PNG_COMPRESS_LEVEL, EncodedImage
+    from pizza_gen.model_cache import ControlNetModelCache
+    from pizza_gen.pizza_gen import PizzaGen
+    from pizza_gen.pool import ServerPool
+    from pizza_gen.validate import SliceValidator
+
+    # Parse args
+    if debug:
+        enable_debug_log()
+
+    logger.debug(f"{output_path=}, {server_urls=}")
+
+    frames = list(range(start_num_pieces, total_num_pieces + 1))
+    num_jobs = len(frames) * num_variants
+
+    if guide_image_template and two_stage:
+        raise typer.BadParameter(
+            "--guide-image-template cannot be used with --two-stage."
+        )
+    if save_candidates and two_stage:
+        raise typer.BadParameter("--save-candidates cannot be used with --two-stage.")
+    if chain and two_stage:
+        raise typer.BadParameter("--chain cannot be used with --two-stage.")
+
+    guide_images = {}
+    if guide_image_template:
+        for num_pieces in frames:
+            guide_image = Path(guide_image_template.format(NUM_PIECES=num_pieces))
+            logger.info(f"Loading {guide_image=}")
+            # Encoded once for every variant
+            with Image.open(guide_image) as im:
+                guide_images[num_pieces] = EncodedImage.from_image(
+                    im, REUSED_PNG_COMPRESS_LEVEL
+                )
+
+    # One engine (and thus one model list per server) for the whole set
+    gen = PizzaGen(
+        server_url=server_urls[0],
+        width=width,
+        num_pieces=total_num_pieces,
+        total_num_pieces=total_num_pieces,
+        seg_weight=seg_weight,
+        debug=debug,
+        model_cache=ControlNetModelCache(ttl=model_cache_ttl, path=model_cache_path),
+        result_cache=create_result_cache(result_cache_path, result_cache_max_mb),
+        jitter_seed=jitter_seed,
+        validator=SliceValidator() if validate else None,
+        max_attempts=max_attempts,
+        candidates=num_candidates,
+        scorer=create_scorer(scorer),
+        depth_cache=create_depth_cache(depth_cache_path, no_depth_cache),
+        chain_denoising_strength=chain_denoising_strength,
+        chain_steps=chain_steps,
+    )
+
+    progress = Progress(num_jobs)
+    summary = MetricsSummary()
+    # Frames starting chains (txt2img) vs the others (img2img), with --chain
+    first_summary = MetricsSummary()
+    chained_summary = MetricsSummary()
+    catalog = create_catalog(catalog_path, output_path, no_catalog)
+    post_processor = create_post_processor(variants, post_workers)
+
+    def save(
+        img: Image.Image,
+        info: dict,
+        num_pieces: int,
+        output_path: Path,
+        catalog: Optional[Catalog] = None,
+        metrics: Optional[Metrics] = None,
+    ):
+        return save_pizza_outputs(
+            img,
+            info,
+            output_path=output_path,
+            num_pieces=num_pieces,
+            total_num_pieces=total_num_pieces,
+            output_image_format=output_image_format,
+            force=force_overwrite,
+            catalog=catalog,
+            metrics=metrics,
+        )
+
+    async def run_frame(
+        pool: ServerPool,
+        num_pieces: int,
+        variant: int,
+        previous: Optional[Tuple[int, Image.Image]] = None,
+    ):
+        kwargs = dict(
+            prompt_override=prompt_override,
+            neg_prompt_override=negative_prompt_override,
+            # Keep fixed seeds reproducible while giving each variant its own
+            # (a batch of candidates takes consecutive seeds)
+            seed=seed if seed == -1 else seed + variant * num_candidates,
+            num_pieces=num_pieces,
+        )
+
+        # Requests are timed by the pool, as "queue" (waiting for a server) and
+        # "generate"; files are saved off the event loop
+        with collect() as metrics:
+            if two_stage:
+                res = await gen.agenerate_two_stage(pool, **kwargs)
+                img, info = res.image, res.info
+                if save_stage1:
+                    await asyncio.to_thread(
+                        save, res.stage1_image, res.stage1_info, num_pieces, stage1_path
+                    )
+            else:
+                best, *others = await pool.submit(
+                    partial(
+                        gen.agenerate_candidates,
+                        depth_guide=guide_images.get(num_pieces),
+                        init_image=previous[1] if previous else None,
+                        **kwargs,
+                    )
+                )
+                img, info = best.image, best.info
+                if previous:
+                    info["chain"] = {
+                        "previous_num_pieces": previous[0],
+                        "denoising_strength": gen.chain_denoising_strength,
+                        "steps": gen.chain_steps,
+                    }
+                if save_candidates:
+                    for x in others:
+                        await asyncio.to_thread(
+                            save, x.image, x.info, num_pieces, candidates_path
+                        )
+
+            # Stage 1 images are intermediates, so only final ones are cataloged
+            image_path = await asyncio.to_thread(
+                save, img, info, num_pieces, output_path, catalog, metrics
+            )
+        summary.add(metrics)
+        if chain:
+            (chained_summary if previous else first_summary).add(metrics)
+        # Encoded in the background, without blocking the next request
+        if post_processor:
+            post_processor.submit(image_path)
+        progress.advance(f"{num_pieces}p (variant {variant + 1})")
+        return img
+
+    async def run_chain(pool: ServerPool, variant: int):
+        previous = None
+        for num_pieces in frames:
+            img = await run_frame(pool, num_pieces, variant, previous)
+            previous = (num_pieces, img)
+
+    async def run():
+        async with ServerPool(server_urls, max_in_flight=max_in_flight) as pool:
+            if chain:
+                # Frames of a variant depend on each other, variants do not
+                await asyncio.gather(
+                    *[run_chain(pool, variant) for variant in range(num_variants)]
+                )
+                return
+            await asyncio.gather(
+                *[
+                    run_frame(pool, num_pieces, variant)
+                    for num_pieces in frames
+                    for variant in range(num_variants)
+                ]
+            )
+
+    output_path.mkdir(parents=True, exist_ok=True)
+    stage1_path = output_path / "stage1"
+    if two_stage and save_stage1:
+        stage1_path.mkdir(parents=True, exist_ok=True)
+    candidates_path = output_path / "candidates"
+    if save_candidates:
+        candidates_path.mkdir(parents=True, exist_ok=True)
+
+    with post_processor or nullcontext():
+        asyncio.run(run())
+        progress.finish()
+    log_summary(summary, metrics_path)
+    if chain:
+        log_chain_savings(first_summary, chained_summary, gen.chain_sampling_steps)
+
+
+@app.command("circular-set")
+def circular_set(
+    # API
+    server_urls: List[str] = typer.Option(
+        ["http://127.0.0.1:7860"], "-s", "--server-url", help="Can be repeated."
+    ),
+    max_in_flight: int = typer.Option(
+        1, "-j", "--max-in-flight", help="Max concurrent jobs per server."
+    ),
+    model_cache_path: Optional[Path] = typer.Option(
+        None, "--model-cache-path", help="Persist resolved ControlNet model names."
+    ),
+    model_cache_ttl: float = typer.Option(3600.0, "--model-cache-ttl"),
+    result_cache_path: Optional[Path] = typer.Option(
+        None,
+        "--result-cache-path",
+        help="Reuse results of identical requests (with a fixed --seed).",
+    ),
+    result_cache_max_mb: int = typer.Option(2048, "--result-cache-max-mb"),
+    # Input
+    things_path: Path = typer.Option(
+        "circular_things.json",
+        "-i",
+        "--input-path",
+        help="A JSON array of {thing, prompt} (see circular_prompt_gen).",
+    ),
+    dedupe: bool = typer.Option(
+        True, "--dedupe/--no-dedupe", help="Skip near-duplicate things or prompts."
+    ),
+    # New image
+    width: int = typer.Option(720, "-W", "--width"),
+    seed: int = typer.Option(-1, "--seed"),
+    negative_prompt_override: Optional[str] = typer.Option(
+        None, "--negative-prompt-override"
+    ),
+    canny_weight: Optional[float] = typer.Option(None, "--canny-weight"),
+    num_candidates: int = typer.Option(
+        1, "-K", "--candidates", help="Images per request. The best one is kept."
+    ),
+    scorer: Optional[str] = typer.Option(
+        None,
+        "--scorer",
+        help="Rank candidates by 'sharpness' or 'module:function(image, info)'.",
+    ),
+    # Output
+    force_overwrite: bool = typer.Option(False, "-f", "--force-overwrite"),
+    output_path: Path = typer.Option(".", "-o", "--output-path"),
+    output_filename_template: str = typer.Option(
+        "circular_{THING}_{INFO_HASH}", "-t", "--output-filename-template"
+    ),
+    save_candidates: bool = typer.Option(
+        False,
+        "--save-candidates",
+        is_flag=True,
+        help="Also save the other candidates to <output-path>/candidates.",
+    ),
+    output_image_format: Path = typer.Option("webp", "-F", "--output-image-format"),
+    catalog_path: Optional[Path] = typer.Option(
+        None, "--catalog-path", help="Defaults to <output-path>/catalog.jsonl."
+    ),
+    no_catalog: bool = typer.Option(
+        False, "--no-catalog", is_flag=True, help="Do not record outputs."
+    ),
+    variants: List[str] = typer.Option(
+        [],
+        "-V",
+        "--variant",
+        help="Also encode WIDTH:FORMAT[:QUALITY] (e.g. 240:avif:50). Can be repeated.",
+    ),
+    post_workers: Optional[int] = typer.Option(
+        None, "--post-workers", help="Processes encoding variants."
+    ),
+    metrics_path: Optional[Path] = typer.Option(
+        None,
+        "--metrics-path",
+        help="Write stage timings and payload sizes (JSON, or Prometheus if *.prom).",
+    ),
+    # Others
+    debug: bool = typer.Option(
+        False, "--debug", is_flag=True, help="Output intermediate images for debugging."
+    ),
+):
+    """Generate something circular for every prompt in a file"""
+    from circular_prompt_gen.prompts import Prompt
+    from circular_prompt_gen.similarity import NearDuplicateIndex
+    from pizza_gen.circular_gen import CircularGen
+    from pizza_gen.model_cache import ControlNetModelCache
+    from pizza_gen.pool import ServerPool
+
+    # Parse args
+    if debug:
+        enable_debug_log()
+
+    logger.debug(f"{output_path=}, {server_urls=}")
+
+    with things_path.open(encoding="utf-8") as fp:
+        things = json.load(fp)
+
+    if dedupe:
+        index = NearDuplicateIndex()
+        unique = []
+        for x in things:
+            if match := index.add_if_unique(Prompt(**x)):
+                logger.info(f"Skipping {x['thing']} (~{match.thing} by {match.field}).")
+            else:
+                unique.append(x)
+        logger.info(f"Skipped {len(things) - len(unique)} near-duplicates.")
+        things = unique
+
+    gen = CircularGen(
+        server_url=server_urls[0],
+        width=width,
+        canny_weight=canny_weight,
+        debug=debug,
+        model_cache=ControlNetModelCache(ttl=model_cache_ttl, path=model_cache_path),
+        result_cache=create_result_cache(result_cache_path, result_cache_max_mb),
+        candidates=num_candidates,
+        scorer=create_scorer(scorer),
+    )
+
+    progress = Progress(len(things))
+    summary = MetricsSummary()
+    catalog = create_catalog(catalog_path, output_path, no_catalog)
+    post_processor = create_post_processor(variants, post_workers)
+
+    async def run_thing(pool: ServerPool, thing: str, prompt: str):
+        with collect() as metrics:
+            # Timed by the pool, as "queue" (waiting for a server) and "generate"
+            best, *others = await pool.submit(
+                partial(
+                    gen.agenerate_candidates,
+                    prompt=prompt,
+                    neg_prompt_override=negative_prompt_override,
+                    seed=seed,
+                )
+            )
+
+            # Saved off the event loop, without holding the server
+            image_path = await asyncio.to_thread(
+                save_circular_outputs,
+                best.image,
+                best.info,
+                output_path=output_path,
+                output_filename_template=output_filename_template,
+                output_image_format=output_image_format,
+                force=force_overwrite,
+                catalog=catalog,
+                metrics=metrics,
+                thing=thing,
+                THING=thing.replace(" ", "_"),
+            )
+        summary.add(metrics)
+        if save_candidates:
+            await asyncio.to_thread(
+                save_other_candidates,
+                others,
+                output_path,
+                partial(
+                    save_circular_outputs,
+                    output_filename_template=output_filename_template,
+                    output_image_format=output_image_format,
+                    force=force_overwrite,
+                    THING=thing.replace(" ", "_"),
+                ),
+            )
+        if post_processor:
+            post_processor.submit(image_path)
+        progress.advance(thing)
+
+    async def run():
+        async with ServerPool(server_urls, max_in_flight=max_in_flight) as pool:
+            await asyncio.gather(
+                *[run_thing(pool, x["thing"], x["prompt"]) for x in things]
+            )
+
+    with post_processor or nullcontext():
+        asyncio.run(run())
+        progress.finish()
+    log_summary(summary, metrics_path)
+
+
+@app.command("run-queue")
+def run_queue(
+    # API
+    server_urls: List[str] = typer.Option(
+        ["http://127.0.0.1:7860"], "-s", "--server-url", help="Can be repeated."
+    ),
+    max_in_flight: int = typer.Option(
+        1, "-j", "--max-in-flight", help="Max concurrent jobs per server."
+    ),
+    model_cache_path: Optional[Path] = typer.Option(
+        None, "--model-cache-path", help="Persist resolved ControlNet model names."
+    ),
+    model_cache_ttl: float = typer.Option(3600.0, "--model-cache-ttl"),
+    result_cache_path: Optional[Path] = typer.Option(
+        None,
+        "--result-cache-path",
+        help="Reuse results of identical requests (with a fixed --seed).",
+    ),
+    result_cache_max_mb: int = typer.Option(2048, "--result-cache-max-mb"),
+    # Queue
+    queue_path: Path = typer.Option("queue.sqlite", "-q", "--queue-path"),
+    max_job_attempts: int = typer.Option(
+        5, "--max-job-attempts", help="Give up on a job after this many failures."
+    ),
+    lease_seconds: float = typer.Option(
+        120.0, "--lease", help="Other workers take over jobs not renewed for this."
+    ),
+    # New image
+    seg_weight: Optional[float] = typer.Option(None, "--seg-weight"),
+    jitter_seed: Optional[int] = typer.Option(
+        None,
+        "--jitter-seed",
+        help="Make the slice edges of seg maps reproducible. Defaults to --seed.",
+    ),
+    canny_weight: Optional[float] = typer.Option(None, "--canny-weight"),
+    validate: bool = typer.Option(
+        False,
+        "--validate",
+        is_flag=True,
+        help="Resample images that do not show the right slices.",
+    ),
+    max_attempts: int = typer.Option(3, "--max-attempts", help="With --validate."),
+    scorer: Optional[str] = typer.Option(
+        None,
+        "--scorer",
+        help="Rank candidates by 'sharpness' or 'module:function' (see --candidates).",
+    ),
+    # Output
+    force_overwrite: bool = typer.Option(False, "-f", "--force-overwrite"),
+    output_filename_template: str = typer.Option(
+        "circular_{THING}_{INFO_HASH}",
+        "-t",
+        "--output-filename-template",
+        help="For circular jobs.",
+    ),
+    output_image_format: Path = typer.Option("webp", "-F", "--output-image-format"),
+    catalog_path: Optional[Path] = typer.Option(
+        None, "--catalog-path", help="Defaults to <output-path>/catalog.jsonl."
+    ),
+    no_catalog: bool = typer.Option(
+        False, "--no-catalog", is_flag=True, help="Do not record outputs."
+    ),
+    variants: List[str] = typer.Option(
+        [],
+        "-V",
+        "--variant",
+        help="Also encode WIDTH:FORMAT[:QUALITY] (e.g. 240:avif:50). Can be repeated.",
+    ),
+    post_workers: Optional[int] = typer.Option(
+        None, "--post-workers", help="Processes encoding variants."
+    ),
+    metrics_path: Optional[Path] = typer.Option(
+        None,
+        "--metrics-path",
+        help="Write stage timings and payload sizes (JSON, or Prometheus if *.prom).",
+    ),
+    # Others
+    debug: bool = typer.Option(
+        False, "--debug", is_flag=True, help="Output intermediate images for debugging."
+    ),
+):
+    """
+    Run queued jobs (see `queue add-pizza`) until none are left. Can be killed and
+    rerun at any time, and several workers can share a queue.
+    """
+    from pizza_gen.catalog import Catalog
+    from pizza_gen.circular_gen import CircularGen
+    from pizza_gen.job_queue import Job, JobQueue, JobSpec, worker_id
+    from pizza_gen.model_cache import ControlNetModelCache
+    from pizza_gen.pizza_gen import PizzaGen
+    from pizza_gen.pool import ServerPool
+    from pizza_gen.validate import SliceValidator
+
+    # Parse args
+    if debug:
+        enable_debug_log()
+
+    queue = JobQueue(
+        queue_path, lease_seconds=lease_seconds, max_attempts=max_job_attempts
     )
-    gen._prepare_seg_image()
-    img, info = gen.generate(
-        depth_guide=guide_image_,
-        prompt_override=prompt_override,
-        neg_prompt_override=negative_prompt_override,
+    queue.reclaim_dead()
+    worker = worker_id()
+
+    post_processor = create_post_processor(variants, post_workers)
+    model_cache = ControlNetModelCache(ttl=model_cache_ttl, path=model_cache_path)
+    result_cache = create_result_cache(result_cache_path, result_cache_max_mb)
+    scorer_ = create_scorer(scorer)
+
+    # Engines and catalogs are created on first use, as specs may differ
+    pizza_gens: Dict[Tuple[int, int, int], PizzaGen] = {}
+    circular_gens: Dict[Tuple[int, int], CircularGen] = {}
+    catalogs: Dict[str, Optional[Catalog]] = {}
+
+    def get_pizza_gen(spec: JobSpec):
+        assert spec.total_num_pieces is not None
+        key = (spec.width, spec.total_num_pieces, spec.candidates)
+        if key not in pizza_gens:
+            pizza_gens[key] = PizzaGen(
+                server_url=server_urls[0],
+                width=spec.width,
+                num_pieces=spec.total_num_pieces,
+                total_num_pieces=spec.total_num_pieces,
+                seg_weight=seg_weight,
+                debug=debug,
+                model_cache=model_cache,
+                result_cache=result_cache,
+                jitter_seed=jitter_seed,
+                validator=SliceValidator() if validate else None,
+                max_attempts=max_attempts,
+                candidates=spec.candidates,
+                scorer=scorer_,
+            )
+        return pizza_gens[key]
+
+    def get_circular_gen(spec: JobSpec):
+        key = (spec.width, spec.candidates)
+        if key not in circular_gens:
+            circular_gens[key] = CircularGen(
+                server_url=server_urls[0],
+                width=spec.width,
+                canny_weight=canny_weight,
+                debug=debug,
+                model_cache=model_cache,
+                result_cache=result_cache,
+                candidates=spec.candidates,
+                scorer=scorer_,
+            )
+        return circular_gens[key]
+
+    def get_catalog(output_path: Path):
+        if str(output_path) not in catalogs:
+            catalogs[str(output_path)] = create_catalog(
+                catalog_path, output_path, no_catalog
+            )
+        return catalogs[str(output_path)]
+
+    async def run_job(pool: ServerPool, spec: JobSpec, metrics: Metrics):
+        output_path = Path(spec.output_path)
+        output_path.mkdir(parents=True, exist_ok=True)
+
+        if spec.kind == "pizza":
+            assert spec.num_pieces is not None and spec.total_num_pieces is not None
+            img, info = await pool.submit(
+                partial(
+                    get_pizza_gen(spec).agenerate,
+                    prompt_override=spec.prompt_override,
+                    neg_prompt_override=spec.negative_prompt_override,
+                    seed=spec.seed,
+                    num_pieces=spec.num_pieces,
+                )
+            )
+            return await asyncio.to_thread(
+                save_pizza_outputs,
+                img,
+                info,
+                output_path=output_path,
+                num_pieces=spec.num_pieces,
+                total_num_pieces=spec.total_num_pieces,
+                output_image_format=output_image_format,
+                force=force_overwrite,
+                catalog=get_catalog(output_path),
+                metrics=metrics,
+            )
+
+        assert spec.prompt is not None
+        thing = spec.thing or ""
+        img, info = await pool.submit(
+            partial(
+                get_circular_gen(spec).agenerate,
+                prompt=spec.prompt,
+                neg_prompt_override=spec.negative_prompt_override,
+                seed=spec.seed,
+            )
+        )
+        return await asyncio.to_thread(
+            save_circular_outputs,
+            img,
+            info,
+            output_path=output_path,
+            output_filename_template=output_filename_template,
+            output_image_format=output_image_format,
+            force=force_overwrite,
+            catalog=get_catalog(output_path),
+            metrics=metrics,
+            thing=spec.thing,
+            THING=thing.replace(" ", "_"),
+        )
+
+    async def heartbeat(job: Job):
+        while True:
+            await asyncio.sleep(lease_seconds / 3)
+            await asyncio.to_thread(queue.heartbeat, job)
+
+    async def work(pool: ServerPool):
+        while True:
+            job = await asyncio.to_thread(queue.claim, worker)
+            if job is None:
+                # Wait for retries and jobs of other workers, which may still fail
+                wait = await asyncio.to_thread(queue.next_wakeup)
+                if wait is None:
+                    return
+                await asyncio.sleep(min(wait, 5.0) + 0.1)
+                continue
+
+            beat = asyncio.create_task(heartbeat(job))
+            try:
+                with collect() as metrics:
+                    image_path = await run_job(pool, job.spec, metrics)
+            except asyncio.CancelledError:
+                queue.release(job)
+                raise
+            except Exception as e:
+                state = await asyncio.to_thread(queue.fail, job, e)
+                logger.error(
+                    f"Job {job.id} ({job.spec.label}) failed "
+                    f"(attempt {job.attempts}, {state or 'lease lost'}): {e}"
+                )
+                continue
+            finally:
+                beat.cancel()
+
+            # Otherwise the worker which claimed it again records it
+            if not await asyncio.to_thread(queue.complete, job, image_path):
+                continue
+            summary.add(metrics)
+            if post_processor:
+                post_processor.submit(image_path)
+            progress.advance(job.spec.label)
+
+    async def run():
+        async with ServerPool(server_urls, max_in_flight=max_in_flight) as pool:
+            await asyncio.gather(*[work(pool) for _ in range(pool.capacity)])
+
+    counts = queue.counts()
+    logger.info(f"Queue '{queue_path}': {counts}")
+    progress = Progress(counts["pending"] + counts["running"])
+    summary = MetricsSummary()
+
+    with post_processor or nullcontext():
+        asyncio.run(run())
+        progress.finish()
+    log_summary(summary, metrics_path)
+
+    counts = queue.counts()
+    logger.info(f"Queue '{queue_path}': {counts}")
+    if counts["failed"]:
+        logger.error(
+            f"{counts['failed']} jobs failed. See `queue status`, `queue retry-failed`."
+        )
+        raise typer.Exit(1)
+
+
+@app.command("validate")
+def validate_images(
+    image_paths: List[Path] = typer.Argument(..., help="pizza_{N}p_{n}p_* images."),
+    chroma_threshold: Optional[int] = typer.Option(
+        None, "--chroma", help="Defaults to SliceValidator.chroma_threshold."
+    ),
+):
+    """Check that existing pizza images show the right slices"""
+    from PIL import Image
+
+    from pizza_gen.catalog import PIZZA_FILENAME
+    from pizza_gen.validate import SliceValidator
+
+    validator = SliceValidator()
+    if chroma_threshold is not None:
+        validator.chroma_threshold = chroma_threshold
+
+    num_invalid = 0
+    for path in image_paths:
+        m = PIZZA_FILENAME.match(path.stem)
+        if m is None:
+            logger.warning(f"Skipping '{path}' (unknown filename).")
+            continue
+
+        with Image.open(path) as im:
+            report = validator.validate(im, int(m.group("num")), int(m.group("total")))
+        num_invalid += not report.valid
+        status = "OK" if report.valid else "NG"
+        logger.info(f"{status} {path.name}: {report.summary()}")
+
+    logger.info(f"{num_invalid} of {len(image_paths)} images look wrong.")
+    if num_invalid:
+        raise typer.Exit(1)
+
+
+@app.command()
+def models(
+    # API
+    server_urls: List[str] = typer.Option(
+        ["http://127.0.0.1:7860"], "-s", "--server-url", help="Can be repeated."
+    ),
+    model_cache_path: Optional[Path] = typer.Option(
+        None, "--model-cache-path", help="Persist resolved ControlNet model names."
+    ),
+    model_cache_ttl: float = typer.Option(3600.0, "--model-cache-ttl"),
+    refresh: bool = typer.Option(
+        False, "--refresh", is_flag=True, help="Invalidate cached entries first."
+    ),
+    # Others
+    debug: bool = typer.Option(
+        False, "--debug", is_flag=True, help="Enable debugging outputs"
+    ),
+):
+    """Show (and cache) the ControlNet models resolved on each server"""
+    from pizza_gen.model_cache import ControlNetModelCache
+    from pizza_gen.webui import create_client
+
+    if debug:
+        enable_debug_log()
+
+    cache = ControlNetModelCache(ttl=model_cache_ttl, path=model_cache_path)
+    for server_url in server_urls:
+        client = create_client(server_url)
+        if refresh:
+            cache.invalidate(client)
+        logger.info(f"{server_url}: {cache.get(client)}")
+
+
+@app.command("mock-server")
+def mock_server(
+    host: str = typer.Option("127.0.0.1", "--host"),
+    port: int = typer.Option(7860, "-p", "--port"),
+    latency: float = typer.Option(1.0, "--latency", help="Seconds per request."),
+    latency_jitter: float = typer.Option(0.0, "--latency-jitter"),
+    latency_per_image: float = typer.Option(
+        0.0, "--latency-per-image", help="Per image of a batch beyond the first."
+    ),
+    preprocess_latency: float = typer.Option(
+        0.0, "--preprocess-latency", help="Per ControlNet preprocessor run."
+    ),
+    error_rate: float = typer.Option(0.0, "--error-rate"),
+    misdraw_rate: float = typer.Option(0.0, "--misdraw-rate"),
+    seed: int = typer.Option(0, "--seed"),
+    # Others
+    debug: bool = typer.Option(
+        False, "--debug", is_flag=True, help="Enable debugging outputs"
+    ),
+):
+    """Serve a stand-in of the stable-diffusion-webui API (no GPU required)"""
+    from pizza_gen.mock_server import MockConfig, MockSDServer
+
+    if debug:
+        enable_debug_log()
+
+    config = MockConfig(
+        latency=latency,
+        latency_jitter=latency_jitter,
+        latency_per_image=latency_per_image,
+        preprocess_latency=preprocess_latency,
+        error_rate=error_rate,
+        misdraw_rate=misdraw_rate,
         seed=seed,
     )
+    server = MockSDServer(config, host=host, port=port)
+    logger.info(f"Serving a mock stable-diffusion-webui on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
 
-    # Define filename
-    info_json = json.dumps(info, indent=2, ensure_ascii=False)
-    info_hash = hashlib.sha1(
-        info_json.encode("utf-8"), usedforsecurity=False
-    ).hexdigest()
-    base_filename = f"pizza_{total_num_pieces}p_{num_pieces}p_{info_hash}"
 
-    # Save outputs
-    image_path = output_path / f"{base_filename}.{output_image_format}"
-    save_image_safely(img, image_path, force_overwrite)
+@app.command()
+def bench(
+    num_images: int = typer.Option(20, "-n", "--num-images"),
+    width: int = typer.Option(720, "-W", "--width"),
+    latency: float = typer.Option(0.05, "--latency", help="Mock server latency."),
+    num_servers: int = typer.Option(2, "--num-servers"),
+    max_in_flight: int = typer.Option(2, "-j", "--max-in-flight"),
+    num_candidates: int = typer.Option(
+        4, "-K", "--candidates", help="Images per request of the candidates path."
+    ),
+    latency_per_image: float = typer.Option(
+        0.01, "--latency-per-image", help="Mock server latency per extra image."
+    ),
+    output_json: Optional[Path] = typer.Option(None, "-o", "--output-json"),
+    baseline: Optional[Path] = typer.Option(
+        None, "--baseline", help="A previous --output-json to compare with."
+    ),
+    max_regression: float = typer.Option(
+        0.2, "--max-regression", help="Fail if a metric gets worse by this ratio."
+    ),
+    # Others
+    debug: bool = typer.Option(
+        False, "--debug", is_flag=True, help="Enable debugging outputs"
+    ),
+):
+    """Benchmark the client side against local mock servers"""
+    from pizza_gen.bench import (
+        BenchConfig,
+        compare_with_baseline,
+        print_report,
+        run_benchmarks,
+    )
 
-    json_path = output_path / f"{base_filename}.info.json"
-    if not json_path.exists() or force_overwrite:
-        with json_path.open("w", encoding="utf-8") as fp:
-            fp.write(info_json)
-            logger.info(f"Successfully saved info.json to '{json_path}'.")
+    if debug:
+        enable_debug_log()
+
+    report = run_benchmarks(
+        BenchConfig(
+            num_images=num_images,
+            width=width,
+            latency=latency,
+            num_servers=num_servers,
+            max_in_flight=max_in_flight,
+            candidates=num_candidates,
+            latency_per_image=latency_per_image,
+        )
+    )
+    print_report(report)
+
+    if output_json:
+        with output_json.open("w", encoding="utf-8") as fp:
+            json.dump(report, fp, indent=2)
+
+    if baseline:
+        regressions = compare_with_baseline(report, baseline, max_regression)
+        for x in regressions:
+            logger.error(f"Regression: {x}")
+        if regressions:
+            raise typer.Exit(1)
+
+
+@app.command("check-startup")
+def check_startup_time(
+    repeat: int = typer.Option(3, "-n", "--repeat", help="Runs per measurement."),
+):
+    """Fail if a CLI loads heavy dependencies or starts slower than its budget"""
+    from pizza_gen.startup import check_startup, print_startup_report
+
+    results = check_startup(repeat=repeat)
+    print_startup_report(results)
+
+    failed = False
+    for x in results:
+        for problem in x.problems():
+            logger.error(f"{x.entry_point.name}: {problem}")
+            failed = True
+    if failed:
+        raise typer.Exit(1)
+
+
+@catalog_app.command("import")
+def catalog_import(
+    image_paths: List[Path] = typer.Argument(..., help="Images or directories."),
+    catalog_path: Path = typer.Option("catalog.jsonl", "-c", "--catalog-path"),
+    output_image_format: str = typer.Option("webp", "-F", "--output-image-format"),
+):
+    """Record existing images (named by pizza_gen) in the catalog"""
+    from pizza_gen.catalog import Catalog, record_from_filename
+
+    catalog = Catalog(catalog_path)
+    known = {x.path for x in catalog.records()}
+
+    records = []
+    for path in image_paths:
+        files = path.glob(f"**/*.{output_image_format}") if path.is_dir() else [path]
+        for x in sorted(files):
+            record = record_from_filename(x, catalog)
+            if record is None:
+                logger.warning(f"Skipping '{x}' (unknown filename).")
+            elif record.path not in known:
+                records.append(record)
+
+    catalog.append(*records)
+    logger.info(f"Imported {len(records)} images into '{catalog_path}'.")
+
+
+@catalog_app.command("query")
+def catalog_query(
+    catalog_path: Path = typer.Option("catalog.jsonl", "-c", "--catalog-path"),
+    kind: Optional[str] = typer.Option(None, "-k", "--kind", help="pizza/circular"),
+    num_pieces: Optional[int] = typer.Option(None, "-n", "--num-pieces"),
+    total_num_pieces: Optional[int] = typer.Option(None, "-N", "--total-num-pieces"),
+    thing: Optional[str] = typer.Option(None, "--thing"),
+    as_json: bool = typer.Option(False, "--json", is_flag=True, help="Print JSONL."),
+):
+    """List cataloged images"""
+    from pizza_gen.catalog import Catalog, Kind
+
+    records = Catalog(catalog_path).query(
+        kind=cast(Optional[Kind], kind),
+        num_pieces=num_pieces,
+        total_num_pieces=total_num_pieces,
+        thing=thing,
+    )
+    for x in sorted(records, key=lambda x: x.path):
+        print(x.model_dump_json(exclude_defaults=True) if as_json else x.path)
+
+
+@catalog_app.command("compact")
+def catalog_compact(
+    catalog_path: Path = typer.Option("catalog.jsonl", "-c", "--catalog-path"),
+    drop_missing: bool = typer.Option(
+        False, "--drop-missing", is_flag=True, help="Drop records of deleted files."
+    ),
+):
+    """Rewrite the catalog without superseded records"""
+    from pizza_gen.catalog import Catalog
+
+    dropped = Catalog(catalog_path).compact(drop_missing=drop_missing)
+    logger.info(f"Dropped {dropped} records from '{catalog_path}'.")
+
+
+@catalog_app.command("export-manifest")
+def catalog_export_manifest(
+    catalog_path: Path = typer.Option("catalog.jsonl", "-c", "--catalog-path"),
+    kind: str = typer.Option("pizza", "-k", "--kind", help="pizza/circular"),
+    total_num_pieces: Optional[int] = typer.Option(None, "-N", "--total-num-pieces"),
+    base_url: str = typer.Option(
+        ..., "-b", "--base-url", help="e.g. '/pizza-clock/assets/pizza_12p'"
+    ),
+    variant: Optional[str] = typer.Option(
+        None, "-V", "--variant", help="Use encoded variants, e.g. '240w.avif'."
+    ),
+    output: Optional[Path] = typer.Option(None, "-o", "--output"),
+):
+    """Export a theme definition for the webui (e.g. webui/public/theme/*.json)"""
+    from pizza_gen.catalog import Catalog, Kind
+
+    if kind not in ("pizza", "circular"):
+        raise typer.BadParameter(f"Unknown kind: {kind}")
+
+    filters = {}
+    if total_num_pieces is not None:
+        filters["total_num_pieces"] = total_num_pieces
+
+    manifest = Catalog(catalog_path).export_manifest(
+        cast(Kind, kind), base_url, variant=variant, **filters
+    )
+    text = json.dumps(manifest, indent=2, ensure_ascii=False)
+    if output is None:
+        print(text)
+    else:
+        output.write_text(text, encoding="utf-8")
+        logger.info(f"Exported {len(manifest['files'])} files to '{output}'.")
+
+
+@catalog_app.command("export-atlas")
+def catalog_export_atlas(
+    catalog_path: Path = typer.Option("catalog.jsonl", "-c", "--catalog-path"),
+    kind: str = typer.Option("pizza", "-k", "--kind", help="pizza/circular"),
+    total_num_pieces: Optional[int] = typer.Option(None, "-N", "--total-num-pieces"),
+    num_variants: int = typer.Option(
+        1, "-v", "--num-variants", help="Frames per category (pizza) or thing."
+    ),
+    things: Optional[List[str]] = typer.Option(
+        None, "--thing", help="Only pack these things (circular)."
+    ),
+    # Atlas
+    frame_width: Optional[int] = typer.Option(
+        None, "-W", "--frame-width", help="Resize frames (defaults to their width)."
+    ),
+    max_size: int = typer.Option(
+        2048, "--max-size", help="Max width/height of atlases."
+    ),
+    padding: int = typer.Option(2, "--padding", help="Pixels around each frame."),
+    image_format: str = typer.Option("webp", "-F", "--format"),
+    quality: Optional[int] = typer.Option(None, "-Q", "--quality"),
+    # Output
+    base_url: str = typer.Option(
+        ..., "-b", "--base-url", help="e.g. '/pizza-clock/assets/pizza_12p'"
+    ),
+    atlas_dir: Optional[Path] = typer.Option(
+        None, "-d", "--atlas-dir", help="Defaults to the directory of -o."
+    ),
+    output: Path = typer.Option(..., "-o", "--output", help="Manifest (JSON)."),
+):
+    """Pack a theme into a few texture atlases, with a manifest of frame offsets"""
+    from pizza_gen.atlas import export_atlas, select_frames
+    from pizza_gen.catalog import Catalog, Kind
+    from pizza_gen.postprocess import is_format_supported
+
+    if kind not in ("pizza", "circular"):
+        raise typer.BadParameter(f"Unknown kind: {kind}")
+    if not is_format_supported(image_format):
+        raise typer.BadParameter(f"'{image_format}' is not supported by Pillow.")
+
+    filters = {}
+    if total_num_pieces is not None:
+        filters["total_num_pieces"] = total_num_pieces
+
+    catalog = Catalog(catalog_path)
+    records = select_frames(
+        catalog, cast(Kind, kind), num_variants, things or None, **filters
+    )
+    if not records:
+        raise typer.BadParameter("No frames found in the catalog.")
+
+    # e.g. pizza_12p.json -> pizza_12p.0.<hash>.webp
+    name = output.name.split(".")[0]
+    manifest = export_atlas(
+        catalog,
+        records,
+        cast(Kind, kind),
+        atlas_dir or output.parent,
+        name,
+        base_url,
+        frame_width=frame_width,
+        max_size=max_size,
+        padding=padding,
+        format=image_format.lower(),
+        quality=quality,
+    )
+    output.write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+    logger.info(
+        f"Exported {len(manifest['files'])} frames in "
+        f"{len(manifest['atlases'])} atlases to '{output}'."
+    )
+
+
+@queue_app.command("add-pizza")
+def queue_add_pizza(
+    queue_path: Path = typer.Option("queue.sqlite", "-q", "--queue-path"),
+    # New image
+    width: int = typer.Option(720, "-W", "--width"),
+    seed: int = typer.Option(-1, "--seed"),
+    start_num_pieces: int = typer.Option(0, "--start"),
+    total_num_pieces: int = typer.Option(12, "-N", "--total-num-pieces"),
+    num_variants: int = typer.Option(1, "-v", "--num-variants"),
+    prompt_override: Optional[str] = typer.Option(None, "--prompt-override"),
+    negative_prompt_override: Optional[str] = typer.Option(
+        None, "--negative-prompt-override"
+    ),
+    num_candidates: int = typer.Option(
+        1, "-K", "--candidates", help="Images per request. The best one is kept."
+    ),
+    # Output
+    output_path: Path = typer.Option(".", "-o", "--output-path"),
+):
+    """Queue a full set of pizza (like pizza-set)"""
+    from pizza_gen.job_queue import JobQueue, JobSpec
+
+    specs = [
+        JobSpec(
+            kind="pizza",
+            output_path=str(output_path),
+            width=width,
+            seed=seed if seed == -1 else seed + variant * num_candidates,
+            variant=variant,
+            candidates=num_candidates,
+            negative_prompt_override=negative_prompt_override,
+            num_pieces=num_pieces,
+            total_num_pieces=total_num_pieces,
+            prompt_override=prompt_override,
+        )
+        for num_pieces in range(start_num_pieces, total_num_pieces + 1)
+        for variant in range(num_variants)
+    ]
+    added = JobQueue(queue_path).enqueue(specs)
+    logger.info(f"Queued {added} jobs ({len(specs) - added} already queued).")
+
+
+@queue_app.command("add-circular")
+def queue_add_circular(
+    queue_path: Path = typer.Option("queue.sqlite", "-q", "--queue-path"),
+    # Input
+    things_path: Path = typer.Option(
+        "circular_things.json",
+        "-i",
+        "--input-path",
+        help="A JSON array of {thing, prompt} (see circular_prompt_gen).",
+    ),
+    dedupe: bool = typer.Option(
+        True, "--dedupe/--no-dedupe", help="Skip near-duplicate things or prompts."
+    ),
+    # New image
+    width: int = typer.Option(720, "-W", "--width"),
+    seed: int = typer.Option(-1, "--seed"),
+    negative_prompt_override: Optional[str] = typer.Option(
+        None, "--negative-prompt-override"
+    ),
+    num_candidates: int = typer.Option(
+        1, "-K", "--candidates", help="Images per request. The best one is kept."
+    ),
+    # Output
+    output_path: Path = typer.Option(".", "-o", "--output-path"),
+):
+    """Queue something circular for every prompt in a file (like circular-set)"""
+    from circular_prompt_gen.prompts import Prompt
+    from circular_prompt_gen.similarity import NearDuplicateIndex
+    from pizza_gen.job_queue import JobQueue, JobSpec
+
+    with things_path.open(encoding="utf-8") as fp:
+        things = [Prompt(**x) for x in json.load(fp)]
+
+    if dedupe:
+        index = NearDuplicateIndex()
+        things = [x for x in things if index.add_if_unique(x) is None]
+
+    specs = [
+        JobSpec(
+            kind="circular",
+            output_path=str(output_path),
+            width=width,
+            seed=seed,
+            candidates=num_candidates,
+            negative_prompt_override=negative_prompt_override,
+            thing=x.thing,
+            prompt=x.prompt,
+        )
+        for x in things
+    ]
+    added = JobQueue(queue_path).enqueue(specs)
+    logger.info(f"Queued {added} jobs ({len(specs) - added} already queued).")
+
+
+@queue_app.command("status")
+def queue_status(
+    queue_path: Path = typer.Option("queue.sqlite", "-q", "--queue-path"),
+):
+    """Show the number of jobs by state, and why failed jobs failed"""
+    from pizza_gen.job_queue import JobQueue
+
+    queue = JobQueue(queue_path)
+    for state, n in queue.counts().items():
+        print(f"{state}: {n}")
+    for job in queue.jobs("failed"):
+        print(f"[{job.id}] {job.spec.label}: {job.last_error}")
+
+
+@queue_app.command("retry-failed")
+def queue_retry_failed(
+    queue_path: Path = typer.Option("queue.sqlite", "-q", "--queue-path"),
+):
+    """Queue failed jobs again"""
+    from pizza_gen.job_queue import JobQueue
+
+    n = JobQueue(queue_path).retry_failed()
+    logger.info(f"Queued {n} failed jobs again.")
+
+
+def update_library_index(
+    index_path: Path, image_paths: List[Path], max_workers: Optional[int]
+):
+    from pizza_gen.library import ImageIndex
+
+    index = ImageIndex(index_path)
+    started_at = time.perf_counter()
+    res = index.update(image_paths, max_workers=max_workers)
+    logger.info(
+        f"Indexed {res.added} new and {res.updated} changed images, forgot "
+        f"{res.removed} ({res.unchanged} unchanged) in "
+        f"{time.perf_counter() - started_at:.1f}s."
+    )
+    return index
+
+
+@library_app.command("index")
+def library_index(
+    image_paths: List[Path] = typer.Argument(..., help="Images or directories."),
+    index_path: Path = typer.Option(
+        ".cache/pizza_gen/library.sqlite", "-i", "--index-path"
+    ),
+    max_workers: Optional[int] = typer.Option(None, "-j", "--max-workers"),
+):
+    """Hash new and changed images (dHash, pHash)"""
+    update_library_index(index_path, image_paths, max_workers).close()
+
+
+@library_app.command("dupes")
+def library_dupes(
+    image_paths: List[Path] = typer.Argument(..., help="Images or directories."),
+    index_path: Path = typer.Option(
+        ".cache/pizza_gen/library.sqlite", "-i", "--index-path"
+    ),
+    max_workers: Optional[int] = typer.Option(None, "-j", "--max-workers"),
+    phash_distance: int = typer.Option(6, "--phash-distance", help="Of 64 bits."),
+    dhash_distance: int = typer.Option(8, "--dhash-distance", help="Of 64 bits."),
+    as_json: bool = typer.Option(False, "--json", is_flag=True, help="Print JSONL."),
+):
+    """Report clusters of near-duplicate images (the oldest of each is kept)"""
+    from pizza_gen.library import find_clusters
+
+    with update_library_index(index_path, image_paths, max_workers) as index:
+        clusters = find_clusters(
+            index.entries(image_paths), phash_distance, dhash_distance
+        )
+
+    for x in clusters:
+        if as_json:
+            duplicates = [
+                {"path": y.path, "phash_distance": p, "dhash_distance": d}
+                for y, p, d in x.duplicates
+            ]
+            print(json.dumps({"keep": x.keep.path, "duplicates": duplicates}))
+        else:
+            print(x.keep.path)
+            for y, p, d in x.duplicates:
+                print(f"  {y.path} (pHash {p}, dHash {d})")
+
+    num_duplicates = sum(len(x.duplicates) for x in clusters)
+    logger.info(f"Found {num_duplicates} near-duplicates in {len(clusters)} clusters.")
+
+
+@library_app.command("prune")
+def library_prune(
+    image_paths: List[Path] = typer.Argument(..., help="Images or directories."),
+    index_path: Path = typer.Option(
+        ".cache/pizza_gen/library.sqlite", "-i", "--index-path"
+    ),
+    max_workers: Optional[int] = typer.Option(None, "-j", "--max-workers"),
+    phash_distance: int = typer.Option(6, "--phash-distance", help="Of 64 bits."),
+    dhash_distance: int = typer.Option(8, "--dhash-distance", help="Of 64 bits."),
+    catalog_path: Optional[Path] = typer.Option(
+        None, "-c", "--catalog-path", help="Also remove pruned images from here."
+    ),
+    yes: bool = typer.Option(
+        False, "--yes", is_flag=True, help="Delete (only list files otherwise)."
+    ),
+):
+    """
+    Delete near-duplicates (see `library dupes`) with their info JSON and variants
+    """
+    from pizza_gen.catalog import Catalog
+    from pizza_gen.library import find_clusters, related_files
+
+    catalog = Catalog(catalog_path) if catalog_path else None
+    with update_library_index(index_path, image_paths, max_workers) as index:
+        clusters = find_clusters(
+            index.entries(image_paths), phash_distance, dhash_distance
+        )
+
+        pruned = []
+        num_bytes = 0
+        for x in clusters:
+            for y, _, _ in x.duplicates:
+                for file in related_files(Path(y.path)):
+                    num_bytes += file.stat().st_size
+                    print(file)
+                    if yes:
+                        file.unlink()
+                if catalog and yes:
+                    catalog.remove(catalog.relative_path(Path(y.path)))
+                pruned.append(y.path)
+
+        if yes:
+            index.forget(pruned)
+
+    if yes:
+        logger.info(f"Deleted {len(pruned)} near-duplicates ({num_bytes:,} bytes).")
+    else:
+        logger.info(
+            f"Would delete {len(pruned)} near-duplicates ({num_bytes:,} bytes). "
+            "Pass --yes to delete them."
+        )
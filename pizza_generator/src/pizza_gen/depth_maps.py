@@ -0,0 +1,117 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+import webuiapi
+
+from pizza_gen.guides import REUSED_PNG_COMPRESS_LEVEL, EncodedImage
+from pizza_gen.logger import get_logger
+from pizza_gen.metrics import stage
+from pizza_gen.result_cache import ResultCache
+from pizza_gen.webui import server_root
+
+logger = get_logger(__name__)
+
+DEPTH_MODULE = "depth_midas"
+# The default of ControlNetUnit, i.e. what txt2img would preprocess at
+DEPTH_PROCESSOR_RES = 512
+
+# Bump when keys or stored maps change
+KEY_VERSION = 1
+
+# Depth maps kept in memory, e.g. of every frame of a set
+MEMORY_ENTRIES = 64
+
+
+class NoDepthMap(RuntimeError):
+    """The server answered /controlnet/detect without a depth map."""
+
+
+class DepthMapCache:
+    """
+    Depth maps of guide images, computed once with the server's /controlnet/detect
+    so that txt2img requests can send them with module="none" instead of having the
+    preprocessor rerun every time.
+
+    Maps are keyed by the PNG digest of their guide and kept in memory, and on disk
+    at `path` (evicted like the result cache).
+    """
+
+    def __init__(
+        self,
+        path: Optional[Path] = None,
+        max_bytes: int = 256 * 1024**2,
+        module: str = DEPTH_MODULE,
+        processor_res: int = DEPTH_PROCESSOR_RES,
+    ) -> None:
+        self.module = module
+        self.processor_res = processor_res
+        self._disk = ResultCache(path, max_bytes=max_bytes) if path else None
+        self._memory: OrderedDict[str, EncodedImage] = OrderedDict()
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, guide: EncodedImage):
+        data = f"{KEY_VERSION}:{self.module}:{self.processor_res}:{guide.sha256}"
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _detect(self, client: webuiapi.WebUIApi, guide: EncodedImage):
+        payload = {
+            "controlnet_module": self.module,
+            "controlnet_input_images": [guide.b64],
+            "controlnet_processor_res": self.processor_res,
+        }
+        with stage("depth_map"):
+            res = client.custom_post("controlnet/detect", payload=payload)
+        if not res.images:
+            raise NoDepthMap(f"No depth map from '{server_root(client)}': {res.info}")
+
+        logger.debug(f"Computed a depth map of {guide.sha256=}")
+        # Sent to txt2img like any guide, see guides.py
+        return EncodedImage.from_image(
+            res.images[0].convert("RGB"), REUSED_PNG_COMPRESS_LEVEL
+        )
+
+    def _remember(self, key: str, depth_map: EncodedImage):
+        with self._lock:
+            self._memory[key] = depth_map
+            self._memory.move_to_end(key)
+            while len(self._memory) > MEMORY_ENTRIES:
+                self._memory.popitem(last=False)
+
+    def get(self, client: webuiapi.WebUIApi, guide: EncodedImage) -> EncodedImage:
+        """The depth map of `guide`, computed by the server behind `client` if new."""
+        key = self._key(guide)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Requests sharing a guide (e.g. variants) wait for a single detection
+        with key_lock:
+            with self._lock:
+                if key in self._memory:
+                    return self._memory[key]
+
+            cached = self._disk.get(key) if self._disk else None
+            if cached:
+                depth_map = EncodedImage.from_image(
+                    cached[0], REUSED_PNG_COMPRESS_LEVEL
+                )
+            else:
+                depth_map = self._detect(client, guide)
+                if self._disk:
+                    info = {
+                        "module": self.module,
+                        "processor_res": self.processor_res,
+                        "guide_sha256": guide.sha256,
+                    }
+                    self._disk.put(key, depth_map.decode(), info)
+            self._remember(key, depth_map)
+
+        with self._lock:
+            self._key_locks.pop(key, None)
+        return depth_map
@@ -0,0 +1,120 @@
+import base64
+import hashlib
+import io
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Optional, Tuple, Union
+
+import numpy as np
+import webuiapi
+from PIL import Image
+
+from pizza_gen.metrics import record_size
+from pizza_gen.seg_raster import polar_grid, render_seg_map
+
+# Pillow's default, for images sent once (e.g. seg maps of random jitter)
+PNG_COMPRESS_LEVEL = 6
+# Guides reused by many requests are encoded once, so it pays to compress harder
+REUSED_PNG_COMPRESS_LEVEL = 9
+
+CIRCLE_DIAMETER_RATIO = 0.90
+
+
+@dataclass(frozen=True)
+class EncodedImage:
+    """An image encoded to base64 PNG once, then sent as is with every request."""
+
+    b64: str = field(repr=False)
+    # Of the PNG bytes, e.g. for request fingerprints
+    sha256: str
+    size: Tuple[int, int]
+
+    @classmethod
+    def from_image(cls, image: Image.Image, compress_level: int = PNG_COMPRESS_LEVEL):
+        with io.BytesIO() as output:
+            image.save(output, format="PNG", compress_level=compress_level)
+            data = output.getvalue()
+
+        return cls(
+            b64=base64.b64encode(data).decode("ascii"),
+            sha256=hashlib.sha256(data).hexdigest(),
+            size=image.size,
+        )
+
+    @property
+    def nbytes(self):
+        return len(self.b64)
+
+    def decode(self) -> Image.Image:
+        return Image.open(io.BytesIO(base64.b64decode(self.b64)))
+
+
+Guide = Union[Image.Image, EncodedImage]
+
+
+def encode_guide(image: Optional[Guide]) -> Optional[EncodedImage]:
+    if image is None or isinstance(image, EncodedImage):
+        return image
+    return EncodedImage.from_image(image)
+
+
+class GuideUnit(webuiapi.ControlNetUnit):
+    """A ControlNetUnit sending a pre-encoded image instead of encoding it per request."""
+
+    def __init__(self, guide: EncodedImage, **kwargs) -> None:
+        super().__init__(image=None, **kwargs)
+        self.guide = guide
+
+    def to_dict(self):
+        record_size("guides", self.guide.nbytes)
+        return {**super().to_dict(), "image": self.guide.b64}
+
+
+def encode_seg_guide(
+    width: int,
+    num_pieces: int,
+    total_num_pieces: int,
+    start_jitter: int = 0,
+    end_jitter: int = 0,
+    compress_level: int = PNG_COMPRESS_LEVEL,
+) -> EncodedImage:
+    """`render_seg_map`, encoded. For layouts used once, e.g. of random jitter."""
+    return EncodedImage.from_image(
+        render_seg_map(width, num_pieces, total_num_pieces, start_jitter, end_jitter),
+        compress_level,
+    )
+
+
+@lru_cache(maxsize=64)
+def seg_guide(
+    width: int,
+    num_pieces: int,
+    total_num_pieces: int,
+    start_jitter: int = 0,
+    end_jitter: int = 0,
+) -> EncodedImage:
+    """`encode_seg_guide`, shared by every request with the same layout."""
+    return encode_seg_guide(
+        width,
+        num_pieces,
+        total_num_pieces,
+        start_jitter,
+        end_jitter,
+        REUSED_PNG_COMPRESS_LEVEL,
+    )
+
+
+def render_circle_guide(width: int) -> Image.Image:
+    """A black disc on white, the layout of circular images (for the canny model)."""
+    _, radius = polar_grid(width)
+    labels = np.where(radius <= width * CIRCLE_DIAMETER_RATIO / 2, 0, 255)
+
+    # The canny model expects 3 channels, so do not send a grayscale PNG
+    return Image.fromarray(labels.astype(np.uint8), mode="L").convert("RGB")
+
+
+@lru_cache(maxsize=8)
+def circle_guide(width: int) -> EncodedImage:
+    return EncodedImage.from_image(
+        render_circle_guide(width), REUSED_PNG_COMPRESS_LEVEL
+    )
@@ -0,0 +1,331 @@
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, Literal, Optional
+
+from pydantic import BaseModel
+from tenacity import RetryCallState, wait_exponential_jitter
+from tenacity.wait import wait_base
+
+from pizza_gen.catalog import Kind
+from pizza_gen.logger import get_logger
+
+logger = get_logger(__name__)
+
+State = Literal["pending", "running", "done", "failed"]
+STATES = ("pending", "running", "done", "failed")
+
+
+class JobSpec(BaseModel):
+    """What to generate. Identical specs are enqueued only once."""
+
+    kind: Kind
+    output_path: str
+    width: int = 720
+    seed: int = -1
+    # Tells apart jobs which only differ by a random (-1) seed
+    variant: int = 0
+    # Images per request, of which the best one is kept
+    candidates: int = 1
+    negative_prompt_override: Optional[str] = None
+    # pizza
+    num_pieces: Optional[int] = None
+    total_num_pieces: Optional[int] = None
+    prompt_override: Optional[str] = None
+    # circular
+    thing: Optional[str] = None
+    prompt: Optional[str] = None
+
+    @property
+    def label(self):
+        if self.kind == "pizza":
+            return f"{self.num_pieces}p (variant {self.variant + 1})"
+        return self.thing or self.prompt or ""
+
+    def digest(self):
+        data = self.model_dump_json(exclude_defaults=True)
+        return hashlib.sha1(data.encode("utf-8"), usedforsecurity=False).hexdigest()
+
+
+@dataclass
+class Job:
+    id: int
+    spec: JobSpec
+    state: State
+    attempts: int
+    last_error: Optional[str]
+    output_path: Optional[str]
+    worker: Optional[str]
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _is_alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueue:
+    """
+    Jobs in a SQLite database, shared by any number of worker processes.
+
+    A worker claims a job with a lease which it renews with `heartbeat` while the
+    job runs. Jobs of killed workers are claimed again once their lease expires (or
+    right away by a worker on the same host, see `reclaim_dead`). Failed jobs are
+    retried with exponential backoff, up to `max_attempts` times.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        lease_seconds: float = 120.0,
+        max_attempts: int = 5,
+        backoff: wait_base = wait_exponential_jitter(initial=10, max=600, jitter=5),
+    ) -> None:
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+        # Transactions are managed explicitly, see `_transaction`. Workers call the
+        # queue from threads (asyncio.to_thread), which `_lock` serializes.
+        self._conn = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._lock = threading.Lock()
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                digest TEXT NOT NULL UNIQUE,
+                spec TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                output_path TEXT,
+                worker TEXT,
+                lease_expires_at REAL,
+                run_after REAL NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, run_after)"
+        )
+
+    @contextmanager
+    def _transaction(self):
+        # Take the write lock up front, so that two workers never claim the same job
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _query(self, sql: str, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _job(self, row: sqlite3.Row):
+        return Job(
+            id=row["id"],
+            spec=JobSpec.model_validate_json(row["spec"]),
+            state=row["state"],
+            attempts=row["attempts"],
+            last_error=row["last_error"],
+            output_path=row["output_path"],
+            worker=row["worker"],
+        )
+
+    def enqueue(self, specs: Iterable[JobSpec]):
+        """Add jobs unless already queued. Returns the number of added jobs."""
+        now = time.time()
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO jobs (digest, spec, updated_at) "
+                "VALUES (?, ?, ?)",
+                [(x.digest(), x.model_dump_json(), now) for x in specs],
+            )
+            return conn.total_changes - before
+
+    def claim(self, worker: str) -> Optional[Job]:
+        """Take the next runnable job, including those with an expired lease."""
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                """
+                SELECT * FROM jobs
+                WHERE (state = 'pending' AND run_after <= ?)
+                    OR (state = 'running' AND lease_expires_at < ?)
+                ORDER BY id LIMIT 1
+                """,
+                (now, now),
+            ).fetchone()
+            if row is None:
+                return None
+
+            if row["state"] == "running":
+                logger.warning(f"Reclaiming job {row['id']} from {row['worker']}.")
+            conn.execute(
+                """
+                UPDATE jobs SET state = 'running', attempts = attempts + 1,
+                    worker = ?, lease_expires_at = ?, updated_at = ?
+                WHERE id = ?
+                """,
+                (worker, now + self.lease_seconds, now, row["id"]),
+            )
+
+        job = self._job(row)
+        job.state = "running"
+        job.attempts += 1
+        job.worker = worker
+        return job
+
+    def _update_claimed(self, job: Job, assignments: str, params: tuple):
+        """
+        Update `job` unless its lease was lost, i.e. it expired and the job was
+        claimed again (by another worker, or another task of this one).
+        """
+        with self._transaction() as conn:
+            updated = conn.execute(
+                f"UPDATE jobs SET {assignments} "
+                "WHERE id = ? AND worker = ? AND attempts = ? AND state = 'running'",
+                (*params, job.id, job.worker, job.attempts),
+            ).rowcount
+        if not updated:
+            logger.warning(f"Lost the lease of job {job.id} ({job.spec.label}).")
+        return updated > 0
+
+    def heartbeat(self, job: Job):
+        now = time.time()
+        return self._update_claimed(
+            job,
+            "lease_expires_at = ?, updated_at = ?",
+            (now + self.lease_seconds, now),
+        )
+
+    def complete(self, job: Job, output_path: Optional[Path]):
+        """Mark `job` done. False if its lease was lost, the result is not recorded."""
+        return self._update_claimed(
+            job,
+            "state = 'done', output_path = ?, last_error = NULL, "
+            "lease_expires_at = NULL, updated_at = ?",
+            (str(output_path) if output_path else None, time.time()),
+        )
+
+    def fail(self, job: Job, error: BaseException) -> Optional[State]:
+        """
+        Record `error` and schedule a retry, unless out of attempts. None if the
+        lease of `job` was lost, which leaves it to the worker which claimed it again.
+        """
+        now = time.time()
+        message = f"{type(error).__name__}: {error}"
+        if error.__cause__:
+            message += f" ({error.__cause__})"
+
+        if job.attempts >= self.max_attempts:
+            state: State = "failed"
+            run_after = now
+        else:
+            state = "pending"
+            retry_state = RetryCallState(None, None, (), {})
+            retry_state.attempt_number = job.attempts
+            run_after = now + self.backoff(retry_state)
+
+        if not self._update_claimed(
+            job,
+            "state = ?, last_error = ?, run_after = ?, lease_expires_at = NULL, "
+            "updated_at = ?",
+            (state, message, run_after, now),
+        ):
+            return None
+        return state
+
+    def release(self, job: Job):
+        """Put back a job interrupted by its worker, without counting the attempt."""
+        return self._update_claimed(
+            job,
+            "state = 'pending', attempts = MAX(attempts - 1, 0), "
+            "lease_expires_at = NULL, updated_at = ?",
+            (time.time(),),
+        )
+
+    def reclaim_dead(self):
+        """Put back jobs of workers on this host which are no longer running."""
+        host = socket.gethostname()
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, worker FROM jobs WHERE state = 'running' AND worker LIKE ?",
+                (f"{host}:%",),
+            ).fetchall()
+            dead = [
+                (x["id"],)
+                for x in rows
+                if not _is_alive(int(x["worker"].rsplit(":", 1)[1]))
+            ]
+            conn.executemany(
+                "UPDATE jobs SET state = 'pending', lease_expires_at = NULL "
+                "WHERE id = ?",
+                dead,
+            )
+        if dead:
+            logger.info(f"Reclaimed {len(dead)} jobs of dead workers.")
+        return len(dead)
+
+    def retry_failed(self):
+        """Give failed jobs another `max_attempts` attempts."""
+        with self._transaction() as conn:
+            return conn.execute(
+                "UPDATE jobs SET state = 'pending', attempts = 0, run_after = 0, "
+                "updated_at = ? WHERE state = 'failed'",
+                (time.time(),),
+            ).rowcount
+
+    def counts(self) -> Dict[str, int]:
+        rows = self._query("SELECT state, COUNT(*) FROM jobs GROUP BY state")
+        return {**{x: 0 for x in STATES}, **{state: n for state, n in rows}}
+
+    def next_wakeup(self) -> Optional[float]:
+        """Seconds until a job may become runnable, or None if none will."""
+        (row,) = self._query(
+            """
+            SELECT MIN(CASE state WHEN 'pending' THEN run_after
+                ELSE lease_expires_at END)
+            FROM jobs WHERE state IN ('pending', 'running')
+            """
+        )
+        if row[0] is None:
+            return None
+        return max(row[0] - time.time(), 0.0)
+
+    def jobs(self, state: Optional[State] = None):
+        query = "SELECT * FROM jobs"
+        params = ()
+        if state:
+            query += " WHERE state = ?"
+            params = (state,)
+        return [self._job(x) for x in self._query(query + " ORDER BY id", params)]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
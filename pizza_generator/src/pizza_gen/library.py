@@ -0,0 +1,343 @@
+import glob
+import multiprocessing
+import re
+import sqlite3
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Generic, Iterable, List, Optional, Tuple, TypeVar
+
+import numpy as np
+from PIL import Image
+
+from pizza_gen.catalog import PIZZA_FILENAME
+from pizza_gen.logger import get_logger
+
+logger = get_logger(__name__)
+
+K = TypeVar("K")
+
+IMAGE_SUFFIXES = (".webp", ".png", ".jpg", ".jpeg", ".avif")
+# Encoded variants of a master image, e.g. pizza_12p_3p_<hash>.480w.webp
+VARIANT_STEM = re.compile(r"\.\d+w$")
+
+# Bump when the hashes change
+HASH_VERSION = 1
+
+# Max Hamming distances (of 64 bits) of near-duplicates. Images of a pizza set share
+# their layout by design, so higher distances start matching different toppings
+PHASH_DISTANCE = 6
+DHASH_DISTANCE = 8
+
+# Fewer new images are hashed without starting worker processes
+MIN_PARALLEL = 64
+
+
+def _bits_to_int(bits: np.ndarray):
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def _dct_matrix(n: int):
+    k = np.arange(n)
+    m = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    m[0] /= np.sqrt(2)
+    return m * np.sqrt(2 / n)
+
+
+_DCT32 = _dct_matrix(32)
+
+
+def dhash(image: Image.Image, size: int = 8):
+    """Difference hash: whether each pixel is brighter than its right neighbor."""
+    gray = image.convert("L").resize((size + 1, size), Image.Resampling.BILINEAR)
+    arr = np.asarray(gray, dtype=np.int16)
+    return _bits_to_int(arr[:, 1:] > arr[:, :-1])
+
+
+def phash(image: Image.Image):
+    """
+    Perceptual hash: whether each of the 8x8 lowest frequencies of a 32x32 DCT is
+    above their median (the DC term excluded).
+    """
+    gray = image.convert("L").resize((32, 32), Image.Resampling.BILINEAR)
+    freqs = (_DCT32 @ np.asarray(gray, dtype=np.float64) @ _DCT32.T)[:8, :8]
+    return _bits_to_int(freqs > np.median(freqs.ravel()[1:]))
+
+
+def hamming(a: int, b: int):
+    return (a ^ b).bit_count()
+
+
+def hash_image(path: Path) -> Tuple[int, int]:
+    """(dHash, pHash) of an image file. Runs in worker processes."""
+    with Image.open(path) as im:
+        # Hashes only need a thumbnail; decode JPEGs at a reduced size, and
+        # box-reduce the others before converting
+        im.draft("L", (64, 64))
+        small = im.reduce(max(min(im.size) // 64, 1)).convert("L")
+    return dhash(small), phash(small)
+
+
+class BKTree(Generic[K]):
+    """
+    Burkhard-Keller tree of 64-bit hashes under the Hamming distance. A query only
+    visits subtrees whose distance to the query is within its radius, by the
+    triangle inequality.
+    """
+
+    def __init__(self) -> None:
+        # (hash, keys, children by distance)
+        self._root: Optional[Tuple[int, List[K], Dict[int, tuple]]] = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, value: int, key: K):
+        self._size += 1
+        if self._root is None:
+            self._root = (value, [key], {})
+            return
+
+        node = self._root
+        while True:
+            d = hamming(value, node[0])
+            if d == 0:
+                node[1].append(key)
+                return
+            if d not in node[2]:
+                node[2][d] = (value, [key], {})
+                return
+            node = node[2][d]
+
+    def query(self, value: int, max_distance: int) -> List[Tuple[int, K]]:
+        """Return (distance, key) of hashes within `max_distance`, nearest first."""
+        matches: List[Tuple[int, K]] = []
+        stack = [self._root] if self._root else []
+        while stack:
+            node_value, keys, children = stack.pop()
+            d = hamming(value, node_value)
+            if d <= max_distance:
+                matches.extend((d, x) for x in keys)
+            for child_d, child in children.items():
+                if d - max_distance <= child_d <= d + max_distance:
+                    stack.append(child)
+
+        return sorted(matches, key=lambda x: x[0])
+
+
+@dataclass
+class ImageEntry:
+    path: str
+    size: int
+    mtime_ns: int
+    dhash: int
+    phash: int
+    version: int = HASH_VERSION
+
+    @property
+    def group(self):
+        """Only images of a group can be duplicates, e.g. pizza of the same slices."""
+        if m := PIZZA_FILENAME.match(Path(self.path).stem):
+            return f"pizza_{m.group('total')}p_{m.group('num')}p"
+        return None
+
+
+@dataclass
+class IndexUpdate:
+    added: int = 0
+    updated: int = 0
+    removed: int = 0
+    unchanged: int = 0
+
+
+def find_images(paths: Iterable[Path]):
+    """Image files in `paths` (directories are searched recursively)."""
+    files = set()
+    for path in paths:
+        candidates = path.rglob("*") if path.is_dir() else [path]
+        for x in candidates:
+            if x.suffix.lower() not in IMAGE_SUFFIXES or not x.is_file():
+                continue
+            # Variants are pruned with their master, see `related_files`
+            if VARIANT_STEM.search(x.stem):
+                continue
+            files.add(x.resolve())
+    return sorted(files)
+
+
+def _to_signed(value: int):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _to_unsigned(value: int):
+    return value + (1 << 64) if value < 0 else value
+
+
+class ImageIndex:
+    """
+    Perceptual hashes of image files in a SQLite database. `update` only hashes
+    files which are new or changed (by size and mtime) since the last update.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS images (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                dhash INTEGER NOT NULL,
+                phash INTEGER NOT NULL,
+                version INTEGER NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def entries(self, paths: Optional[Iterable[Path]] = None) -> List[ImageEntry]:
+        """Indexed images, optionally only those under `paths`."""
+        rows = self._conn.execute(
+            "SELECT path, size, mtime_ns, dhash, phash, version FROM images "
+            "ORDER BY path"
+        ).fetchall()
+        entries = [
+            ImageEntry(p, size, mtime, _to_unsigned(d), _to_unsigned(h), version)
+            for p, size, mtime, d, h, version in rows
+        ]
+        if paths is None:
+            return entries
+
+        roots = [x.resolve() for x in paths]
+        return [
+            x
+            for x in entries
+            if any(Path(x.path).is_relative_to(root) for root in roots)
+        ]
+
+    def update(self, paths: Iterable[Path], max_workers: Optional[int] = None):
+        """Index the images in `paths` and forget indexed ones no longer there."""
+        paths = list(paths)
+        files = find_images(paths)
+        known = {x.path: x for x in self.entries(paths)}
+        result = IndexUpdate()
+
+        stale = []
+        for x in files:
+            st = x.stat()
+            entry = known.pop(str(x), None)
+            # Hashes of an older version are computed again, like those of changed files
+            if entry and (entry.size, entry.mtime_ns, entry.version) == (
+                st.st_size,
+                st.st_mtime_ns,
+                HASH_VERSION,
+            ):
+                result.unchanged += 1
+                continue
+            stale.append((x, st, entry is not None))
+
+        stale_paths = [x for x, _, _ in stale]
+        if len(stale) < MIN_PARALLEL:
+            hashes = list(map(hash_image, stale_paths))
+        else:
+            with ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                hashes = list(executor.map(hash_image, stale_paths, chunksize=16))
+
+        rows = []
+        for (x, st, existed), (d, h) in zip(stale, hashes):
+            rows.append(
+                (
+                    str(x),
+                    st.st_size,
+                    st.st_mtime_ns,
+                    _to_signed(d),
+                    _to_signed(h),
+                    HASH_VERSION,
+                )
+            )
+            if existed:
+                result.updated += 1
+            else:
+                result.added += 1
+
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+            # Left in `known`: indexed under `paths`, but deleted since
+            self._conn.executemany(
+                "DELETE FROM images WHERE path = ?", [(x,) for x in known]
+            )
+            # Hashes of an older version, of images not under `paths`
+            self._conn.execute("DELETE FROM images WHERE version != ?", (HASH_VERSION,))
+        result.removed = len(known)
+
+        return result
+
+    def forget(self, paths: Iterable[str]):
+        with self._conn:
+            self._conn.executemany(
+                "DELETE FROM images WHERE path = ?", [(x,) for x in paths]
+            )
+
+
+@dataclass
+class Cluster:
+    """An image to keep, and its near-duplicates with their (pHash, dHash) distances."""
+
+    keep: ImageEntry
+    duplicates: List[Tuple[ImageEntry, int, int]] = field(default_factory=list)
+
+
+def find_clusters(
+    entries: List[ImageEntry],
+    phash_distance: int = PHASH_DISTANCE,
+    dhash_distance: int = DHASH_DISTANCE,
+) -> List[Cluster]:
+    """
+    Group near-duplicates, i.e. images of a group within `phash_distance` and
+    `dhash_distance` of each other. The oldest image of a cluster is kept, and
+    every duplicate is near it (chains of similar images are not merged).
+    """
+    clusters: List[Cluster] = []
+    # pHashes of the kept images per group, to clusters
+    trees: Dict[Optional[str], BKTree[int]] = defaultdict(BKTree)
+    for x in sorted(entries, key=lambda x: (x.mtime_ns, x.path)):
+        tree = trees[x.group]
+        matches = [
+            (p, hamming(x.dhash, clusters[i].keep.dhash), i)
+            for p, i in tree.query(x.phash, phash_distance)
+        ]
+        matches = [m for m in matches if m[1] <= dhash_distance]
+        if matches:
+            p, d, i = min(matches)
+            clusters[i].duplicates.append((x, p, d))
+        else:
+            tree.add(x.phash, len(clusters))
+            clusters.append(Cluster(x))
+
+    return [x for x in clusters if x.duplicates]
+
+
+def related_files(path: Path):
+    """`path` and the files saved along with it: info JSON and encoded variants."""
+    files = [path, path.with_suffix(".info.json")]
+    files.extend(path.parent.glob(f"{glob.escape(path.stem)}.*w.*"))
+    return [x for x in files if x.exists()]
@@ -1,16 +1,19 @@
 import logging
 
-from rich.console import Console
-from rich.logging import RichHandler
-
 FORMAT = "%(message)s"
-logging.basicConfig(
-    level="INFO", format=FORMAT, datefmt="[%X]", handlers=[RichHandler()]
-)
 
 LOGGER_PREFIX = "pizza_gen"
 
 
+def setup_logging(level: str = "INFO"):
+    """Log to stderr with rich. Done by the CLIs, as rich is slow to import."""
+    from rich.logging import RichHandler
+
+    logging.basicConfig(
+        level=level, format=FORMAT, datefmt="[%X]", handlers=[RichHandler()]
+    )
+
+
 def enable_debug_log():
     logging.getLogger().setLevel(logging.DEBUG)
 
@@ -19,4 +22,11 @@ def get_logger(name: str):
     return logging.getLogger(f"{LOGGER_PREFIX}." + name)
 
 
-console = Console(stderr=True)
+def __getattr__(name: str):
+    # `console` is created on first use
+    if name == "console":
+        from rich.console import Console
+
+        globals()["console"] = Console(stderr=True)
+        return globals()["console"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,152 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+from pizza_gen.logger import get_logger
+
+logger = get_logger(__name__)
+
+PROMETHEUS_PREFIX = "pizza_gen"
+
+
+@dataclass
+class Metrics:
+    """Stage timings (seconds) and payload sizes (bytes) of one image."""
+
+    timings: Dict[str, float] = field(default_factory=dict)
+    sizes: Dict[str, int] = field(default_factory=dict)
+
+    def add_time(self, name: str, seconds: float):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def add_size(self, name: str, size: int):
+        self.sizes[name] = self.sizes.get(name, 0) + size
+
+
+# Set per job; copied into tasks and threads (asyncio.to_thread), which then record
+# into the same Metrics
+_current: ContextVar[Optional[Metrics]] = ContextVar("metrics", default=None)
+
+
+@contextmanager
+def collect() -> Iterator[Metrics]:
+    """Record the stages run within the block (in this task or thread)."""
+    metrics = Metrics()
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def stage(name: str):
+    """Time the block as `name`. Does next to nothing outside of `collect`."""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_time(name, time.perf_counter() - started_at)
+
+
+def record_time(name: str, seconds: float):
+    if metrics := _current.get():
+        metrics.add_time(name, seconds)
+
+
+def record_size(name: str, size: int):
+    if metrics := _current.get():
+        metrics.add_size(name, size)
+
+
+@dataclass
+class _Total:
+    count: int = 0
+    sum: float = 0.0
+    max: float = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+class MetricsSummary:
+    """Totals over a run, written as JSON or as a Prometheus textfile (*.prom)."""
+
+    def __init__(self) -> None:
+        self.images = 0
+        self.timings: Dict[str, _Total] = {}
+        self.sizes: Dict[str, _Total] = {}
+
+    def add(self, metrics: Metrics):
+        self.images += 1
+        for name, seconds in metrics.timings.items():
+            self.timings.setdefault(name, _Total()).add(seconds)
+        for name, size in metrics.sizes.items():
+            self.sizes.setdefault(name, _Total()).add(size)
+
+    def to_dict(self):
+        def mean(x: _Total):
+            return x.sum / x.count if x.count else 0.0
+
+        return {
+            "images": self.images,
+            "timings": {
+                k: {"count": v.count, "mean": mean(v), "max": v.max, "sum": v.sum}
+                for k, v in sorted(self.timings.items())
+            },
+            "sizes": {
+                k: {"count": v.count, "mean": mean(v), "max": v.max, "sum": v.sum}
+                for k, v in sorted(self.sizes.items())
+            },
+        }
+
+    def mean(self, name: str) -> Optional[float]:
+        """Mean seconds of a stage over images running it."""
+        x = self.timings.get(name)
+        return x.sum / x.count if x and x.count else None
+
+    def describe(self):
+        """e.g. 'server 3.90s, generate 4.21s' (means over images running a stage)"""
+        return ", ".join(
+            f"{k} {v.sum / v.count:.2f}s" for k, v in self.timings.items() if v.count
+        )
+
+    def to_prometheus(self):
+        p = PROMETHEUS_PREFIX
+        lines = [
+            f"# TYPE {p}_images_total counter",
+            f"{p}_images_total {self.images}",
+            f"# TYPE {p}_stage_seconds summary",
+        ]
+        for name, x in sorted(self.timings.items()):
+            lines.append(f'{p}_stage_seconds_sum{{stage="{name}"}} {x.sum:.6f}')
+            lines.append(f'{p}_stage_seconds_count{{stage="{name}"}} {x.count}')
+        lines.append(f"# TYPE {p}_payload_bytes summary")
+        for name, x in sorted(self.sizes.items()):
+            lines.append(f'{p}_payload_bytes_sum{{payload="{name}"}} {x.sum:.0f}')
+            lines.append(f'{p}_payload_bytes_count{{payload="{name}"}} {x.count}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: Path):
+        if path.suffix == ".prom":
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.to_dict(), indent=2)
+
+        # The textfile collector may read at any time, so replace atomically
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(text, encoding="utf-8")
+        os.replace(tmp_path, path)
+        logger.info(f"Wrote metrics of {self.images} images to '{path}'.")
@@ -0,0 +1,318 @@
+import base64
+import io
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from pizza_gen.ade20k import ADE20K
+from pizza_gen.logger import get_logger
+from pizza_gen.seg_raster import BACKGROUND
+
+logger = get_logger(__name__)
+
+DEFAULT_MODELS = [
+    "control_v11p_sd15_seg [e1f51eb9]",
+    "control_v11f1p_sd15_depth [cfd03158]",
+    "control_v11p_sd15_canny [d14c016b]",
+]
+
+# How the mock "paints" seg map classes
+SEG_PAINT = {
+    ADE20K.FOOD: (196, 112, 44),
+    ADE20K.ROCK: (236, 234, 228),
+}
+TABLE_PAINT = (112, 78, 52)
+
+# Sampling steps that `MockConfig.latency` is for. Like the real server, requests take
+# time in proportion to their steps (times denoising strength for img2img)
+LATENCY_STEPS = 20
+
+
+@dataclass
+class MockConfig:
+    # Seconds per request (of `LATENCY_STEPS` sampling steps for txt2img and img2img),
+    # plus uniform jitter of +/- `latency_jitter`
+    latency: float = 0.0
+    latency_jitter: float = 0.0
+    # Seconds per image of a batch beyond the first, as batches are cheaper per
+    # image than separate requests
+    latency_per_image: float = 0.0
+    # Seconds per run of a ControlNet preprocessor (e.g. depth_midas)
+    preprocess_latency: float = 0.0
+    # Probability of answering with HTTP 500
+    error_rate: float = 0.0
+    # Probability of rotating the layout, as real models sometimes ignore seg maps
+    misdraw_rate: float = 0.0
+    seed: int = 0
+    models: List[str] = field(default_factory=lambda: list(DEFAULT_MODELS))
+
+
+@dataclass
+class MockStats:
+    requests: int = 0
+    errors: int = 0
+    # Seconds spent "generating" (i.e. sleeping) by the server
+    busy_seconds: float = 0.0
+    # Runs of ControlNet preprocessors, by txt2img and /controlnet/detect
+    preprocessor_runs: int = 0
+
+
+def _decode_image(data: str):
+    return Image.open(io.BytesIO(base64.b64decode(data.split(",", 1)[-1])))
+
+
+def _encode_image(image: Image.Image):
+    with io.BytesIO() as output:
+        image.save(output, format="PNG")
+        return base64.b64encode(output.getvalue()).decode("ascii")
+
+
+def _paint(guide: Optional[Image.Image], width: int, height: int, seed: int):
+    """Render a deterministic image, following the guide's seg classes if given."""
+    rng = np.random.default_rng(seed)
+    # Flat colors keep the mock cheap; a seed dependent tint tells images apart
+    tint = rng.integers(-12, 13, size=3)
+
+    if guide is None:
+        arr = np.empty((height, width, 3), dtype=np.int16)
+        arr[:] = rng.integers(0, 256, size=3)
+    else:
+        guide_arr = np.asarray(guide.convert("RGB").resize((width, height)))
+        arr = np.empty(guide_arr.shape, dtype=np.int16)
+        arr[:] = TABLE_PAINT
+        for color, paint in SEG_PAINT.items():
+            arr[(guide_arr == color).all(axis=-1)] = paint
+
+    return Image.fromarray(np.clip(arr + tint, 0, 255).astype(np.uint8))
+
+
+def _sampling_steps(payload: Dict[str, Any]):
+    steps = int(payload.get("steps") or LATENCY_STEPS)
+    if "init_images" in payload:
+        # img2img only samples the last `denoising_strength` of the schedule
+        return steps * min(float(payload.get("denoising_strength", 0.75)), 1.0)
+    return steps
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "_Server"
+
+    def log_message(self, format: str, *args: Any):
+        logger.debug(format % args)
+
+    def _send_json(
+        self, obj: Any, status: int = 200, headers: Optional[Dict[str, str]] = None
+    ):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if self.path == "/internal/ping":
+            self._send_json({})
+        elif self.path == "/controlnet/model_list":
+            self._send_json({"model_list": self.server.config.models})
+        else:
+            self._send_json({"detail": "Not Found"}, status=404)
+
+    def do_POST(self):
+        routes = {
+            "/sdapi/v1/txt2img": self._generate,
+            "/sdapi/v1/img2img": self._generate,
+            "/controlnet/detect": self._detect,
+        }
+        route = routes.get(self.path)
+        if route is None:
+            self._send_json({"detail": "Not Found"}, status=404)
+            return
+
+        payload = self._read_json()
+        started_at = time.perf_counter()
+        mock = self.server
+
+        with mock.lock:
+            mock.stats.requests += 1
+            fail = mock.rng.random() < mock.config.error_rate
+            latency = mock.config.latency
+            if route == self._generate:
+                latency *= _sampling_steps(payload) / LATENCY_STEPS
+            latency += mock.rng.uniform(
+                -mock.config.latency_jitter, mock.config.latency_jitter
+            )
+            latency += mock.config.latency_per_image * (
+                int(payload.get("batch_size", 1)) - 1
+            )
+
+        time.sleep(max(latency, 0.0))
+
+        if fail:
+            with mock.lock:
+                mock.stats.errors += 1
+            self._send_json({"error": "Injected error"}, status=500)
+            return
+
+        try:
+            res = route(payload)
+        except ValueError as e:
+            # Like the real server, reject unknown models with an error message
+            self._send_json({"error": type(e).__name__, "detail": str(e)}, status=500)
+            return
+
+        elapsed = time.perf_counter() - started_at
+        with mock.lock:
+            mock.stats.busy_seconds += elapsed
+
+        self._send_json(res, headers={"X-Process-Time": f"{elapsed:.4f}"})
+
+    def _resolve_seed(self, payload: Dict[str, Any]):
+        seed = int(payload.get("seed", -1))
+        if seed != -1:
+            return seed
+
+        with self.server.lock:
+            return self.server.rng.randrange(2**32)
+
+    def _preprocess(self):
+        with self.server.lock:
+            self.server.stats.preprocessor_runs += 1
+        time.sleep(self.server.config.preprocess_latency)
+
+    def _guide(self, payload: Dict[str, Any]):
+        units = (
+            payload.get("alwayson_scripts", {}).get("ControlNet", {}).get("args", [])
+        )
+        models = self.server.config.models
+        for unit in units:
+            if unit.get("model") not in models:
+                raise ValueError(f"ControlNet model {unit.get('model')} not found")
+            if unit.get("module", "none") != "none":
+                self._preprocess()
+        # The first unit (seg or canny) decides the layout
+        return _decode_image(units[0]["image"]) if units and units[0]["image"] else None
+
+    def _misdraw(self, guide: Optional[Image.Image], seed: int):
+        rng = random.Random(seed)
+        if guide is None or rng.random() >= self.server.config.misdraw_rate:
+            return guide
+        return guide.convert("RGB").rotate(rng.uniform(60, 300), fillcolor=BACKGROUND)
+
+    def _detect(self, payload: Dict[str, Any]):
+        # A blurred grayscale stands in for depth
+        images = []
+        for x in payload.get("controlnet_input_images", []):
+            self._preprocess()
+            image = _decode_image(x).convert("L").filter(ImageFilter.GaussianBlur(4))
+            images.append(_encode_image(image))
+        return {"images": images, "info": "Success"}
+
+    def _generate(self, payload: Dict[str, Any]):
+        width = int(payload.get("width", 512))
+        height = int(payload.get("height", 512))
+        batch_size = int(payload.get("batch_size", 1))
+        seed = self._resolve_seed(payload)
+        guide = self._guide(payload)
+
+        seeds = [seed + i for i in range(batch_size)]
+        images = [_paint(self._misdraw(guide, x), width, height, x) for x in seeds]
+        if init_images := payload.get("init_images"):
+            # img2img keeps part of the init image, the more the lower the strength
+            init = _decode_image(init_images[0]).convert("RGB").resize((width, height))
+            strength = float(payload.get("denoising_strength", 0.75))
+            images = [Image.blend(init, x, strength) for x in images]
+
+        prompt = payload.get("prompt", "")
+        infotexts = [
+            (
+                f"{prompt}\nNegative prompt: {payload.get('negative_prompt', '')}\n"
+                f"Steps: {payload.get('steps')}, "
+                f"Sampler: {payload.get('sampler_name')}, "
+                f"CFG scale: {payload.get('cfg_scale')}, Seed: {x}, "
+                f"Size: {width}x{height}, Model: mock"
+            )
+            for x in seeds
+        ]
+
+        return {
+            "images": [_encode_image(x) for x in images],
+            "parameters": {},
+            "info": json.dumps(
+                {
+                    "prompt": prompt,
+                    "seed": seed,
+                    "all_seeds": seeds,
+                    "infotexts": infotexts,
+                }
+            ),
+        }
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config: MockConfig) -> None:
+        super().__init__(address, _Handler)
+        self.config = config
+        self.stats = MockStats()
+        self.rng = random.Random(config.seed)
+        self.lock = threading.Lock()
+
+
+class MockSDServer:
+    """
+    A stand-in for the stable-diffusion-webui endpoints used by pizza_gen, with
+    configurable latency and error injection. Images are deterministic for a seed.
+
+        with MockSDServer(MockConfig(latency=0.5)) as server:
+            gen = PizzaGen(server_url=server.url, ...)
+    """
+
+    def __init__(
+        self, config: Optional[MockConfig] = None, host="127.0.0.1", port=0
+    ) -> None:
+        self._server = _Server((host, port), config or MockConfig())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def stats(self):
+        return self._server.stats
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,123 @@
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import webuiapi
+
+from pizza_gen.logger import get_logger
+from pizza_gen.metrics import stage
+from pizza_gen.webui import server_root
+
+logger = get_logger(__name__)
+
+# Substrings used to pick a ControlNet model from /controlnet/model_list
+MODEL_KEYS = ("sd15_seg", "sd15_depth", "sd15_canny")
+
+
+class ModelNotFound(Exception):
+    """The server has no ControlNet model of a kind, which retrying does not fix."""
+
+
+@dataclass
+class Entry:
+    fetched_at: float
+    models: Dict[str, str]
+
+
+class ControlNetModelCache:
+    """
+    Per-server cache of resolved ControlNet model names (e.g. "sd15_seg" ->
+    "control_v11p_sd15_seg [e1f51eb9]").
+
+    Entries expire after `ttl` seconds and are optionally persisted to `path`, so
+    that subsequent runs skip the /controlnet/model_list round-trip too.
+    """
+
+    def __init__(self, ttl: float = 3600.0, path: Optional[Path] = None) -> None:
+        self.ttl = ttl
+        self.path = path
+        self._entries: Dict[str, Entry] = {}
+        self._lock = threading.Lock()
+
+        if path and path.exists():
+            self._load(path)
+
+    def _load(self, path: Path):
+        try:
+            with path.open(encoding="utf-8") as fp:
+                data = json.load(fp)
+            self._entries = {k: Entry(**v) for k, v in data.items()}
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Ignoring broken model cache '{path}': {e}")
+
+    def _save(self):
+        if self.path is None:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+        with tmp_path.open("w", encoding="utf-8") as fp:
+            json.dump({k: vars(v) for k, v in self._entries.items()}, fp, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def _fetch(self, client: webuiapi.WebUIApi):
+        cn = webuiapi.ControlNetInterface(client)
+        with stage("model_list"):
+            model_list = cn.model_list()
+        logger.debug(f"{server_root(client)=}, {model_list=}")
+
+        # Resolve every known key in one pass over the list
+        models: Dict[str, str] = {}
+        for model in model_list:
+            for key in MODEL_KEYS:
+                if key in model and key not in models:
+                    models[key] = model
+
+        return Entry(fetched_at=time.time(), models=models)
+
+    def get(self, client: webuiapi.WebUIApi):
+        key = server_root(client)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry.fetched_at > self.ttl:
+                entry = self._fetch(client)
+                self._entries[key] = entry
+                self._save()
+
+        return entry.models
+
+    def resolve(self, client: webuiapi.WebUIApi, model_key: str) -> str:
+        model = self.get(client).get(model_key)
+        logger.debug(f"{model_key=}, {model=}")
+
+        if model is None:
+            raise ModelNotFound(
+                (
+                    "Failed to find a proper ControlNet model,"
+                    f"which contains '{model_key}' in its name."
+                )
+            )
+
+        return model
+
+    def invalidate(self, client: Optional[webuiapi.WebUIApi] = None):
+        """Forget the given server, or every server if omitted."""
+        with self._lock:
+            if client is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(server_root(client), None)
+            self._save()
+
+
+def is_model_rejection(error: Exception, args: Dict[str, Any]):
+    """Whether `error` looks like the server rejecting a model name in `args`."""
+    text = str(error)
+    return any(
+        x.model in text for x in args.get("controlnet_units", []) if x.model != "None"
+    )
@@ -1,16 +1,51 @@
-from random import randint
-from typing import List, Optional, cast
-from urllib.parse import urlparse
+import asyncio
+from dataclasses import asdict, dataclass
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
 
 import webuiapi
-from PIL import Image, ImageDraw
-
+from PIL import Image
+
+from pizza_gen.candidates import Candidate, Scorer, split_candidates
+from pizza_gen.depth_maps import DEPTH_MODULE, DepthMapCache
+from pizza_gen.guides import (
+    EncodedImage,
+    Guide,
+    GuideUnit,
+    encode_guide,
+    encode_seg_guide,
+    seg_guide,
+)
 from pizza_gen.logger import console, get_logger
-
-from .ade20k import ADE20K
+from pizza_gen.metrics import stage
+from pizza_gen.model_cache import ControlNetModelCache
+from pizza_gen.pool import ServerPool
+from pizza_gen.result_cache import ResultCache
+from pizza_gen.runner import arun_img2img, arun_txt2img, run_img2img, run_txt2img
+from pizza_gen.seg_raster import pick_jitter
+from pizza_gen.validate import SliceReport, SliceValidator
+from pizza_gen.webui import create_client, server_root
 
 logger = get_logger(__name__)
 
+# Resampled seeds stay clear of the seeds of other variants (seed + variant)
+RESAMPLE_SEED_STRIDE = 1_000_000
+
+# Sampling steps of txt2img requests
+STEPS = 20
+
+
+def resample_seed(seed: int, attempt: int):
+    return seed if seed == -1 else seed + attempt * RESAMPLE_SEED_STRIDE
+
+
+@dataclass
+class TwoStageResult:
+    image: Image.Image
+    info: dict
+    stage1_image: Image.Image
+    stage1_info: dict
+
 
 class PizzaGen:
     def __init__(
@@ -21,6 +56,16 @@ class PizzaGen:
         total_num_pieces: int = 12,
         seg_weight: Optional[float] = None,
         debug: bool = False,
+        model_cache: Optional[ControlNetModelCache] = None,
+        result_cache: Optional[ResultCache] = None,
+        jitter_seed: Optional[int] = None,
+        validator: Optional[SliceValidator] = None,
+        max_attempts: int = 3,
+        candidates: int = 1,
+        scorer: Optional[Scorer] = None,
+        depth_cache: Optional[DepthMapCache] = None,
+        chain_denoising_strength: float = 0.5,
+        chain_steps: int = 16,
     ) -> None:
         self.client = self._create_client(server_url)
         self.width = width
@@ -28,80 +73,61 @@ class PizzaGen:
         self.total_num_pieces = total_num_pieces
         self.seg_weight = seg_weight
         self.debug = debug
+        self.model_cache = model_cache or ControlNetModelCache()
+        self.result_cache = result_cache
+        self.jitter_seed = jitter_seed
+        # Resample until `validator` accepts the image, up to `max_attempts` times
+        self.validator = validator
+        self.max_attempts = max_attempts if validator else 1
+        # Images per request (batch_size), ranked by `scorer` or else by the slice
+        # score of `validator`
+        self.candidates = candidates
+        self.scorer = scorer
+        # Send depth maps computed once per guide, rather than raw guides which the
+        # server would preprocess with every request
+        self.depth_cache = depth_cache
+        # Servers which failed to compute depth maps
+        self._no_depth_maps = set()
+        # img2img of images derived from an init image (see `generate_candidates`).
+        # The server only samples `chain_steps` x `chain_denoising_strength` steps
+        self.chain_denoising_strength = chain_denoising_strength
+        self.chain_steps = chain_steps
 
     def _create_client(self, url: str):
-        parsed = urlparse(url)
-
-        if parsed.hostname is None:
-            raise Exception("Failed to get hostname.")
-        if parsed.port is None:
-            raise Exception("Failed to get port.")
-
-        return webuiapi.WebUIApi(
-            host=parsed.hostname, port=parsed.port, use_https=parsed.scheme == "https"
-        )
-
-    def _prepare_seg_image(self):
-        image_size = (self.width, self.width)
-
-        im = Image.new("RGBA", image_size, "white")
-        draw = ImageDraw.Draw(im)
-
-        pizza_d = image_size[0] * 0.90
-        pizza_padding = (image_size[0] - pizza_d) / 2
-
-        # Draw a dish somewhat smaller than the pizza
-        dish_padding = pizza_padding + 10
-        draw.ellipse(
-            (
-                (dish_padding, dish_padding),
-                (image_size[0] - dish_padding, image_size[1] - dish_padding),
-            ),
-            # The "DISH" class is not suitable for rendering an empty dish
-            fill=ADE20K.ROCK,
-            outline="white",
-            width=0,
-        )
-
-        # Draw pieces of pizza
-        for i in range(0, self.num_pieces):
-            draw.pieslice(
-                (
-                    (pizza_padding, pizza_padding),
-                    (image_size[0] - pizza_padding, image_size[1] - pizza_padding),
-                ),
-                start=360 / self.total_num_pieces * i - randint(0, 5),
-                end=360 / self.total_num_pieces * (i + 1) + randint(0, 5),
-                fill=ADE20K.FOOD,
-                outline="white",
-                width=0,
+        return create_client(url)
+
+    def _prepare_seg_guide(self, num_pieces: Optional[int] = None, seed: int = -1):
+        if num_pieces is None:
+            num_pieces = self.num_pieces
+
+        # Without a jitter seed, a fixed seed still makes the request reproducible
+        # (and cacheable, see result_cache.is_cacheable)
+        jitter_seed = self.jitter_seed
+        if jitter_seed is None and seed != -1:
+            jitter_seed = seed
+        start_jitter, end_jitter = pick_jitter(num_pieces, jitter_seed)
+        # Random jitter rarely repeats a layout, so do not cache (or compress hard)
+        encode = seg_guide if self.jitter_seed is not None else encode_seg_guide
+        with stage("seg_map"):
+            guide = encode(
+                self.width, num_pieces, self.total_num_pieces, start_jitter, end_jitter
             )
 
-        # Rotate 90 deg CCW to shift the origin to 12 o'clock
-        im = im.transpose(Image.Transpose.ROTATE_90)
-
         if self.debug:
             logger.debug("Saving seg_image to debug_seg_image.png")
-            im.save("debug_seg_image.png")
+            guide.decode().save("debug_seg_image.png")
 
-        return im
+        return guide
 
-    def _prepare_cn_seg_model(self, models: List[str], weight: float):
-        seg_image = self._prepare_seg_image()
-
-        seg_model = next((x for x in models if "sd15_seg" in x), None)
-        logger.debug(f"{seg_model=}")
-
-        if seg_model is None:
-            raise Exception(
-                (
-                    "Failed to find a proper segmentation model,"
-                    "which contains 'sd15_seg' in its name."
-                )
-            )
-
-        return webuiapi.ControlNetUnit(
-            image=seg_image,  # type: ignore
+    def _prepare_cn_seg_model(
+        self,
+        seg_model: str,
+        weight: float,
+        num_pieces: Optional[int] = None,
+        seed: int = -1,
+    ):
+        return GuideUnit(
+            self._prepare_seg_guide(num_pieces, seed),
             module="none",
             model=seg_model,
             weight=weight,
@@ -109,21 +135,14 @@ class PizzaGen:
             resize_mode="Crop and Resize",
         )
 
-    def _prepare_cn_depth_model(self, models: List[str], depth_guide: Image.Image):
-        depth_model = next((x for x in models if "sd15_depth" in x), None)
-        logger.debug(f"{depth_model=}")
-
-        if depth_model is None:
-            raise Exception(
-                (
-                    "Failed to find a proper depth model,"
-                    "which contains 'sd15_depth' in its name."
-                )
-            )
-
-        return webuiapi.ControlNetUnit(
-            image=depth_guide,  # type: ignore
-            module="depth_midas",
+    def _prepare_cn_depth_model(
+        self, depth_model: str, depth_guide: Guide, module: str = DEPTH_MODULE
+    ):
+        encoded = encode_guide(depth_guide)
+        assert encoded is not None
+        return GuideUnit(
+            encoded,
+            module=module,
             model=depth_model,
             weight=0.8,
             guidance_end=0.7,
@@ -131,10 +150,11 @@ class PizzaGen:
             resize_mode="Crop and Resize",
         )
 
-    def _prepare_prompts(
-        self,
-    ):
-        emptiness = 1.0 - (self.num_pieces) / self.total_num_pieces
+    def _prepare_prompts(self, num_pieces: Optional[int] = None):
+        if num_pieces is None:
+            num_pieces = self.num_pieces
+
+        emptiness = 1.0 - (num_pieces) / self.total_num_pieces
         empty_plate_weight = f"{emptiness * 1.1:.2f}"
         logger.debug(f"{empty_plate_weight=}")
 
@@ -156,31 +176,33 @@ class PizzaGen:
 
         return prompt, neg_prompt
 
-    def generate(
+    def _prepare_txt2img_args(
         self,
-        depth_guide: Optional[Image.Image] = None,
+        client: webuiapi.WebUIApi,
+        depth_guide: Optional[Guide] = None,
         prompt_override: Optional[str] = None,
         neg_prompt_override: Optional[str] = None,
         seed: int = -1,
-    ):
-        # Configure ControlNet units
-        cn = webuiapi.ControlNetInterface(self.client)
-        cn_models: List[str] = cn.model_list()
-        logger.debug(f"{cn_models=}")
-
+        num_pieces: Optional[int] = None,
+        depth_module: str = DEPTH_MODULE,
+    ) -> Dict[str, Any]:
         # Weaker weight if depth_guide is given
         seg_weight = 1.1 if depth_guide else 3.0
         if self.seg_weight is not None:
             seg_weight = self.seg_weight
 
         logger.debug(f"{seg_weight=}")
-        cn_units = [self._prepare_cn_seg_model(cn_models, seg_weight)]
+        seg_model = self.model_cache.resolve(client, "sd15_seg")
+        cn_units = [self._prepare_cn_seg_model(seg_model, seg_weight, num_pieces, seed)]
 
         if depth_guide:
-            cn_units.append(self._prepare_cn_depth_model(cn_models, depth_guide))
+            depth_model = self.model_cache.resolve(client, "sd15_depth")
+            cn_units.append(
+                self._prepare_cn_depth_model(depth_model, depth_guide, depth_module)
+            )
 
         # Prepare prompts
-        prompt, neg_prompt = self._prepare_prompts()
+        prompt, neg_prompt = self._prepare_prompts(num_pieces)
 
         if prompt_override:
             prompt = prompt_override
@@ -188,20 +210,326 @@ class PizzaGen:
             neg_prompt = neg_prompt_override
         logger.debug(f"{prompt=}, {neg_prompt=}")
 
-        # Generate image
-        with console.status("Processing...", spinner="pong"):
-            res = self.client.txt2img(
-                prompt=prompt,
-                negative_prompt=neg_prompt,
+        args = dict(
+            prompt=prompt,
+            negative_prompt=neg_prompt,
+            seed=seed,
+            cfg_scale=2.5,
+            steps=STEPS,
+            width=self.width,
+            height=self.width,
+            sampler_name="DPM++ 3M SDE",
+            controlnet_units=cn_units,
+            # webuiapi mutates its (shared) default, which races between
+            # concurrent requests
+            alwayson_scripts={},
+        )
+        # Only when needed, to keep fingerprints of single images as they were
+        if self.candidates > 1:
+            args["batch_size"] = self.candidates
+        return args
+
+    def _prepare_img2img_args(
+        self, client: webuiapi.WebUIApi, init_image: Image.Image, **kwargs
+    ) -> Dict[str, Any]:
+        args = self._prepare_txt2img_args(client, **kwargs)
+        args.update(
+            images=[init_image],
+            denoising_strength=self.chain_denoising_strength,
+            steps=self.chain_steps,
+        )
+        return args
+
+    @property
+    def chain_sampling_steps(self):
+        """Steps sampled per img2img request, vs `STEPS` per txt2img request."""
+        return self.chain_steps * min(self.chain_denoising_strength, 1.0)
+
+    def _validate(
+        self, image: Image.Image, info: dict, num_pieces: Optional[int], attempt: int
+    ) -> SliceReport:
+        assert self.validator
+        if num_pieces is None:
+            num_pieces = self.num_pieces
+
+        with stage("validate"):
+            report = self.validator.validate(image, num_pieces, self.total_num_pieces)
+        info["slice_validation"] = {**asdict(report), "attempt": attempt + 1}
+
+        if not report.valid:
+            logger.warning(
+                f"Rejected {num_pieces}p (attempt {attempt + 1}/{self.max_attempts}): "
+                f"{report.summary()}"
+            )
+
+        return report
+
+    def _preprocess_depth(
+        self,
+        client: webuiapi.WebUIApi,
+        depth_guide: Optional[EncodedImage],
+        cache: bool = True,
+    ) -> Tuple[Optional[EncodedImage], str]:
+        """
+        Return the guide to send and the ControlNet module to run on it. Without
+        `cache` (guides used once), the server preprocesses the guide as usual, as a
+        separate detection would cost a round-trip for nothing.
+        """
+        if depth_guide is None or self.depth_cache is None or not cache:
+            return depth_guide, DEPTH_MODULE
+        if server_root(client) in self._no_depth_maps:
+            return depth_guide, DEPTH_MODULE
+
+        try:
+            return self.depth_cache.get(client, depth_guide), "none"
+        except RuntimeError as e:
+            logger.warning(
+                f"Failed to compute a depth map on '{server_root(client)}', "
+                f"sending the guide instead: {e}"
+            )
+            # e.g. an older ControlNet without the endpoint; do not ask again
+            if e.args and e.args[0] == 404:
+                self._no_depth_maps.add(server_root(client))
+            return depth_guide, DEPTH_MODULE
+
+    def _rank(
+        self, res: webuiapi.WebUIApiResult, num_pieces: Optional[int], attempt: int
+    ) -> List[Tuple[Tuple[bool, float], Candidate]]:
+        """Return the candidates of a response with their sort keys."""
+        ranked = []
+        for x in split_candidates(res, self.candidates):
+            valid, score = True, 0.0
+            if self.validator:
+                report = self._validate(x.image, x.info, num_pieces, attempt)
+                valid, score = report.valid, report.score
+            if self.scorer:
+                score = float(self.scorer(x.image, x.info))
+            if self.scorer or (self.validator and self.candidates > 1):
+                x.score = score
+                x.info.setdefault("candidate", {})["score"] = score
+            ranked.append(((valid, score), x))
+        return ranked
+
+    def _best_first(self, ranked: List[Tuple[Tuple[bool, float], Candidate]]):
+        # Stable, so without scores the first image of the first batch comes first
+        if self.scorer is None and self.validator is None:
+            return [x for _, x in ranked]
+        return [x for _, x in sorted(ranked, key=lambda x: x[0], reverse=True)]
+
+    def generate_candidates(
+        self,
+        depth_guide: Optional[Guide] = None,
+        prompt_override: Optional[str] = None,
+        neg_prompt_override: Optional[str] = None,
+        seed: int = -1,
+        num_pieces: Optional[int] = None,
+        init_image: Optional[Image.Image] = None,
+        cache_depth_guide: bool = True,
+    ) -> List[Candidate]:
+        """
+        Generate `candidates` images per request and return all of them, best first.
+        `num_pieces` overrides the instance default.
+
+        With a validator, batches without a passing image are resampled with derived
+        seeds (up to `max_attempts` times).
+
+        With `init_image` (e.g. the previous frame of a set), images are derived from
+        it by img2img, with `chain_denoising_strength` and `chain_steps`.
+
+        Pass `cache_depth_guide=False` for depth guides used once (e.g. stage 1
+        images), so that they are not kept in the depth map cache.
+        """
+        run, prepare = run_txt2img, self._prepare_txt2img_args
+        if init_image is not None:
+            run = run_img2img
+            prepare = partial(self._prepare_img2img_args, init_image=init_image)
+
+        # Encoded (and preprocessed) once for all attempts
+        depth_guide, depth_module = self._preprocess_depth(
+            self.client, encode_guide(depth_guide), cache_depth_guide
+        )
+
+        ranked = []
+        for attempt in range(self.max_attempts):
+            prepare_args = partial(
+                prepare,
+                self.client,
+                depth_guide=depth_guide,
+                prompt_override=prompt_override,
+                neg_prompt_override=neg_prompt_override,
+                seed=resample_seed(seed, attempt),
+                num_pieces=num_pieces,
+                depth_module=depth_module,
+            )
+
+            # Generate image
+            with console.status("Processing...", spinner="pong"):
+                res = run(
+                    self.client, prepare_args, self.model_cache, self.result_cache
+                )
+
+            batch = self._rank(res, num_pieces, attempt)
+            ranked += batch
+            if any(valid for (valid, _), _ in batch):
+                break
+
+        return self._best_first(ranked)
+
+    def generate(
+        self,
+        depth_guide: Optional[Guide] = None,
+        prompt_override: Optional[str] = None,
+        neg_prompt_override: Optional[str] = None,
+        seed: int = -1,
+        num_pieces: Optional[int] = None,
+        init_image: Optional[Image.Image] = None,
+        cache_depth_guide: bool = True,
+    ):
+        """
+        Generate an image. `num_pieces` overrides the instance default.
+
+        With a validator, rejected images are resampled with derived seeds, and the
+        best one is returned if none of them passes. With several candidates per
+        request, the best one is returned (see `generate_candidates`).
+        """
+        best = self.generate_candidates(
+            depth_guide=depth_guide,
+            prompt_override=prompt_override,
+            neg_prompt_override=neg_prompt_override,
+            seed=seed,
+            num_pieces=num_pieces,
+            init_image=init_image,
+            cache_depth_guide=cache_depth_guide,
+        )[0]
+        return best.image, best.info
+
+    async def agenerate_candidates(
+        self,
+        client: webuiapi.WebUIApi,
+        depth_guide: Optional[Guide] = None,
+        prompt_override: Optional[str] = None,
+        neg_prompt_override: Optional[str] = None,
+        seed: int = -1,
+        num_pieces: Optional[int] = None,
+        init_image: Optional[Image.Image] = None,
+        cache_depth_guide: bool = True,
+    ) -> List[Candidate]:
+        """Same as `generate_candidates`, but against the given client."""
+        run, prepare = arun_txt2img, self._prepare_txt2img_args
+        if init_image is not None:
+            run = arun_img2img
+            prepare = partial(self._prepare_img2img_args, init_image=init_image)
+
+        encoded = await asyncio.to_thread(encode_guide, depth_guide)
+        depth_guide, depth_module = await asyncio.to_thread(
+            self._preprocess_depth, client, encoded, cache_depth_guide
+        )
+
+        ranked = []
+        for attempt in range(self.max_attempts):
+            # Model lookups may hit the network and seg maps are CPU bound,
+            # so keep them off the event loop
+            prepare_args = partial(
+                asyncio.to_thread,
+                prepare,
+                client,
+                depth_guide=depth_guide,
+                prompt_override=prompt_override,
+                neg_prompt_override=neg_prompt_override,
+                seed=resample_seed(seed, attempt),
+                num_pieces=num_pieces,
+                depth_module=depth_module,
+            )
+
+            res = await run(client, prepare_args, self.model_cache, self.result_cache)
+
+            batch = await asyncio.to_thread(self._rank, res, num_pieces, attempt)
+            ranked += batch
+            if any(valid for (valid, _), _ in batch):
+                break
+
+        return self._best_first(ranked)
+
+    async def agenerate(
+        self,
+        client: webuiapi.WebUIApi,
+        depth_guide: Optional[Guide] = None,
+        prompt_override: Optional[str] = None,
+        neg_prompt_override: Optional[str] = None,
+        seed: int = -1,
+        num_pieces: Optional[int] = None,
+        init_image: Optional[Image.Image] = None,
+        cache_depth_guide: bool = True,
+    ):
+        """Same as `generate`, but against the given client (e.g. from a ServerPool)."""
+        best = (
+            await self.agenerate_candidates(
+                client,
+                depth_guide=depth_guide,
+                prompt_override=prompt_override,
+                neg_prompt_override=neg_prompt_override,
                 seed=seed,
-                cfg_scale=2.5,
-                steps=20,
-                width=self.width,
-                height=self.width,
-                sampler_name="DPM++ 3M SDE",
-                controlnet_units=cn_units,
-                use_async=False,
+                num_pieces=num_pieces,
+                init_image=init_image,
+                cache_depth_guide=cache_depth_guide,
             )
-            res = cast(webuiapi.WebUIApiResult, res)
+        )[0]
+        return best.image, best.info
+
+    def generate_two_stage(
+        self,
+        prompt_override: Optional[str] = None,
+        neg_prompt_override: Optional[str] = None,
+        seed: int = -1,
+        num_pieces: Optional[int] = None,
+    ):
+        """
+        Run both stages in one call. The strong-seg stage 1 image is handed over
+        in memory as the depth guide of the weak-seg stage 2.
+        """
+        kwargs = dict(
+            prompt_override=prompt_override,
+            neg_prompt_override=neg_prompt_override,
+            seed=seed,
+            num_pieces=num_pieces,
+        )
+
+        stage1_image, stage1_info = self.generate(**kwargs)
+        image, info = self.generate(
+            depth_guide=stage1_image, cache_depth_guide=False, **kwargs
+        )
+
+        return TwoStageResult(image, info, stage1_image, stage1_info)
+
+    async def agenerate_two_stage(
+        self,
+        pool: ServerPool,
+        prompt_override: Optional[str] = None,
+        neg_prompt_override: Optional[str] = None,
+        seed: int = -1,
+        num_pieces: Optional[int] = None,
+    ):
+        """
+        Same as `generate_two_stage`, but each stage is scheduled on the pool.
+        Stage 2 jobs take precedence, so that with several frames in flight,
+        stage 2 of a frame overlaps with stage 1 of the next ones.
+        """
+        kwargs = dict(
+            prompt_override=prompt_override,
+            neg_prompt_override=neg_prompt_override,
+            seed=seed,
+            num_pieces=num_pieces,
+        )
+
+        stage1_image, stage1_info = await pool.submit(partial(self.agenerate, **kwargs))
+        image, info = await pool.submit(
+            partial(
+                self.agenerate,
+                depth_guide=stage1_image,
+                cache_depth_guide=False,
+                **kwargs,
+            ),
+            priority=1,
+        )
 
-        return res.image, res.info
+        return TwoStageResult(image, info, stage1_image, stage1_info)
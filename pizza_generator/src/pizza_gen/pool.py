@@ -0,0 +1,280 @@
+import asyncio
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Iterable, List, Optional, TypeVar
+
+import aiohttp
+import requests
+import webuiapi
+
+from pizza_gen.logger import get_logger
+from pizza_gen.metrics import stage
+from pizza_gen.webui import create_client, server_root
+
+logger = get_logger(__name__)
+
+T = TypeVar("T")
+
+Job = Callable[[webuiapi.WebUIApi], Awaitable[T]]
+
+
+@dataclass
+class Server:
+    url: str
+    client: webuiapi.WebUIApi
+    max_in_flight: int
+    in_flight: int = 0
+    healthy: bool = True
+    consecutive_failures: int = 0
+    retry_at: float = 0.0
+    completed: int = 0
+    failed: int = 0
+    busy_seconds: float = field(default=0.0, repr=False)
+
+    @property
+    def load(self):
+        return self.in_flight / self.max_in_flight
+
+    def is_available(self, now: float):
+        if self.in_flight >= self.max_in_flight:
+            return False
+        # Unhealthy servers get a "half-open" chance once their backoff has elapsed
+        return self.healthy or now >= self.retry_at
+
+
+class NoServerAvailable(Exception):
+    pass
+
+
+# Statuses of overloaded or broken servers. Other errors (e.g. 404 of a missing
+# endpoint, or 422 of a bad payload) would be the same on every server
+SERVER_FAILURE_STATUSES = (408, 429)
+
+
+def _status(error: BaseException) -> Optional[int]:
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code
+    # webuiapi's error of non-200 responses: RuntimeError(status_code, text)
+    if isinstance(error, RuntimeError) and error.args:
+        if isinstance(error.args[0], int):
+            return error.args[0]
+    return None
+
+
+def is_server_failure(error: BaseException):
+    """
+    Whether a job failed because of its server, so that it may succeed on another.
+    Other errors (e.g. bugs, or missing models) would fail anywhere.
+    """
+    status = _status(error)
+    if status is not None:
+        return status >= 500 or status in SERVER_FAILURE_STATUSES
+    return isinstance(
+        error,
+        (aiohttp.ClientError, requests.RequestException, ConnectionError, TimeoutError),
+    )
+
+
+class ServerPool:
+    """
+    Schedule jobs over several stable-diffusion-webui servers.
+
+    Each server runs at most `max_in_flight` jobs at once. Failed jobs are retried
+    on another server, and failing servers are skipped until they pass a health
+    check or their backoff expires.
+    """
+
+    def __init__(
+        self,
+        server_urls: Iterable[str],
+        max_in_flight: int = 1,
+        max_attempts: int = 3,
+        health_check_interval: float = 30.0,
+        failure_backoff: float = 10.0,
+        max_failure_backoff: float = 300.0,
+    ) -> None:
+        self.servers = [
+            Server(url=url, client=create_client(url), max_in_flight=max_in_flight)
+            for url in server_urls
+        ]
+        if not self.servers:
+            raise ValueError("At least one server is required.")
+
+        self.max_attempts = max_attempts
+        self.health_check_interval = health_check_interval
+        self.failure_backoff = failure_backoff
+        self.max_failure_backoff = max_failure_backoff
+
+        self._cond: Optional[asyncio.Condition] = None
+        self._health_task: Optional[asyncio.Task] = None
+        # Number of jobs waiting for a slot, by priority
+        self._waiting: Counter[int] = Counter()
+
+    async def __aenter__(self):
+        self._cond = asyncio.Condition()
+        await self.check_health()
+        self._health_task = asyncio.create_task(self._health_loop())
+        return self
+
+    async def __aexit__(self, *exc):
+        if self._health_task:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+        self._log_stats()
+
+    @property
+    def capacity(self):
+        return sum(x.max_in_flight for x in self.servers)
+
+    async def _ping(self, server: Server):
+        url = f"{server_root(server.client)}/internal/ping"
+        try:
+            timeout = aiohttp.ClientTimeout(total=5)
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.get(url, ssl=False) as response:
+                    return response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def check_health(self):
+        results = await asyncio.gather(*[self._ping(x) for x in self.servers])
+
+        assert self._cond is not None
+        async with self._cond:
+            for server, ok in zip(self.servers, results):
+                if ok and not server.healthy:
+                    logger.info(f"'{server.url}' is back online.")
+                    server.healthy = True
+                    server.consecutive_failures = 0
+                elif not ok and server.healthy:
+                    self._mark_failed(server, "Health check failed")
+            self._cond.notify_all()
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            await self.check_health()
+
+    def _mark_failed(self, server: Server, reason: object):
+        server.healthy = False
+        server.consecutive_failures += 1
+        backoff = min(
+            self.failure_backoff * 2 ** (server.consecutive_failures - 1),
+            self.max_failure_backoff,
+        )
+        server.retry_at = time.monotonic() + backoff
+        logger.warning(f"'{server.url}' failed ({reason}). Retrying in {backoff:.0f}s.")
+
+    def _pick(self, exclude: List[Server]):
+        now = time.monotonic()
+        candidates = [
+            x for x in self.servers if x.is_available(now) and x not in exclude
+        ]
+        if not candidates:
+            # Rather retry on the same server than wait forever
+            candidates = [x for x in self.servers if x.is_available(now)]
+        if not candidates:
+            return None
+
+        # Prefer healthy, least loaded servers
+        return min(candidates, key=lambda x: (not x.healthy, x.load, x.completed))
+
+    def _next_wakeup(self):
+        now = time.monotonic()
+        pending = [x.retry_at - now for x in self.servers if not x.healthy]
+        return max(min(pending), 0.1) if pending else None
+
+    def _outranked(self, priority: int):
+        return any(n > 0 for p, n in self._waiting.items() if p > priority)
+
+    async def _acquire(self, exclude: List[Server], priority: int):
+        assert self._cond is not None, "Use ServerPool with `async with`."
+        async with self._cond:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    server = None if self._outranked(priority) else self._pick(exclude)
+                    if server is not None:
+                        break
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), self._next_wakeup())
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self._waiting[priority] -= 1
+                self._cond.notify_all()
+
+            server.in_flight += 1
+            return server
+
+    async def _release(self, server: Server, ok: Optional[bool], error: object = None):
+        assert self._cond is not None
+        async with self._cond:
+            server.in_flight -= 1
+            if ok is None:
+                pass
+            elif ok:
+                server.completed += 1
+                server.healthy = True
+                server.consecutive_failures = 0
+            else:
+                server.failed += 1
+                self._mark_failed(server, error)
+            self._cond.notify_all()
+
+    async def submit(self, job: Job[T], priority: int = 0) -> T:
+        """
+        Run `job(client)` on the best available server, retrying on server failures
+        (see `is_server_failure`); other errors are raised as is. Waiting jobs with a
+        higher `priority` get free slots first.
+
+        Records the time waiting for a server as the "queue" stage and the time
+        running the job as "generate", in the metrics being collected.
+        """
+        tried: List[Server] = []
+        last_error: Optional[BaseException] = None
+
+        for attempt in range(self.max_attempts):
+            with stage("queue"):
+                server = await self._acquire(tried, priority)
+            tried.append(server)
+
+            started_at = time.perf_counter()
+            try:
+                with stage("generate"):
+                    result = await job(server.client)
+            except asyncio.CancelledError:
+                await self._release(server, ok=None)
+                raise
+            except Exception as e:
+                server.busy_seconds += time.perf_counter() - started_at
+                if not is_server_failure(e):
+                    await self._release(server, ok=None)
+                    raise
+                await self._release(server, ok=False, error=e)
+                last_error = e
+                continue
+
+            server.busy_seconds += time.perf_counter() - started_at
+            await self._release(server, ok=True)
+            return result
+
+        raise NoServerAvailable(
+            f"Job failed after {self.max_attempts} attempts."
+        ) from last_error
+
+    async def map(self, jobs: Iterable[Job[T]]) -> List[T]:
+        return await asyncio.gather(*[self.submit(x) for x in jobs])
+
+    def _log_stats(self):
+        for x in self.servers:
+            logger.info(
+                f"'{x.url}': {x.completed} done, {x.failed} failed, "
+                f"busy {x.busy_seconds:.1f}s."
+            )
@@ -0,0 +1,187 @@
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+from rich.table import Table
+
+from pizza_gen.logger import console, get_logger
+
+logger = get_logger(__name__)
+
+# Encoder options per format; WebP trades encode time for smaller files
+SAVE_OPTIONS: Dict[str, dict] = {
+    "webp": dict(method=6),
+    "avif": dict(speed=6),
+    "jpeg": dict(optimize=True, progressive=True),
+    "png": dict(optimize=True),
+}
+
+
+@dataclass(frozen=True)
+class Variant:
+    width: int
+    format: str
+    quality: Optional[int] = None
+
+    @property
+    def name(self):
+        quality = f"q{self.quality}" if self.quality is not None else ""
+        return f"{self.width}w{quality}.{self.format}"
+
+    @classmethod
+    def parse(cls, spec: str):
+        """Parse 'WIDTH:FORMAT[:QUALITY]', e.g. '480:webp:80'."""
+        parts = spec.split(":")
+        if len(parts) not in (2, 3):
+            raise ValueError(f"Invalid variant '{spec}' (expected WIDTH:FORMAT[:Q])")
+
+        quality = int(parts[2]) if len(parts) == 3 else None
+        return cls(width=int(parts[0]), format=parts[1].lower(), quality=quality)
+
+    def output_path(self, master_path: Path):
+        # e.g. pizza_12p_3p_<hash>.480w.webp
+        return master_path.with_name(f"{master_path.stem}.{self.width}w.{self.format}")
+
+
+def parse_variants(specs: List[str]):
+    """
+    Parse `Variant.parse` specs. Variants are named by width and format only, so
+    two of them differing in quality would overwrite each other.
+    """
+    variants = [Variant.parse(x) for x in specs]
+    seen: Dict[Tuple[int, str], str] = {}
+    for spec, x in zip(specs, variants):
+        key = (x.width, x.format)
+        if key in seen:
+            raise ValueError(
+                f"Variants '{seen[key]}' and '{spec}' would both be saved as "
+                f"'*.{x.width}w.{x.format}'."
+            )
+        seen[key] = spec
+    return variants
+
+
+def is_format_supported(format: str):
+    Image.init()
+    return format.upper() in Image.SAVE
+
+
+@dataclass
+class EncodeResult:
+    variant: Variant
+    path: Path
+    bytes: int
+    seconds: float
+
+
+def encode_variant(master_path: Path, variant: Variant, force: bool = False):
+    """Resize and encode `master_path`. Runs in worker processes."""
+    path = variant.output_path(master_path)
+    if path.exists() and not force:
+        return EncodeResult(variant, path, path.stat().st_size, 0.0)
+
+    started_at = time.perf_counter()
+    with Image.open(master_path) as im:
+        im.load()
+        height = round(im.height * variant.width / im.width)
+        resized = im.resize((variant.width, height), Image.Resampling.LANCZOS)
+
+    options = dict(SAVE_OPTIONS.get(variant.format, {}))
+    if variant.quality is not None:
+        options["quality"] = variant.quality
+
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    resized.save(tmp_path, format=variant.format, **options)
+    os.replace(tmp_path, path)
+
+    return EncodeResult(
+        variant, path, path.stat().st_size, time.perf_counter() - started_at
+    )
+
+
+class PostProcessor:
+    """
+    Encode resized variants of saved images in a process pool.
+
+    `submit` returns immediately, so that batch runs can send the next request
+    while the previous images are being encoded. `close` waits for every job.
+    """
+
+    def __init__(
+        self,
+        variants: List[Variant],
+        max_workers: Optional[int] = None,
+        force: bool = False,
+    ) -> None:
+        self.variants = []
+        for x in variants:
+            if is_format_supported(x.format):
+                self.variants.append(x)
+            else:
+                logger.warning(f"'{x.format}' is not supported by Pillow. Skipping.")
+
+        self.force = force
+        # Workers are started from within asyncio and its threads, so do not fork
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self._futures: List[Future] = []
+        self._master_bytes: Dict[Path, int] = {}
+
+    def submit(self, master_path: Path):
+        self._master_bytes[master_path] = master_path.stat().st_size
+        for x in self.variants:
+            self._futures.append(
+                self._executor.submit(encode_variant, master_path, x, self.force)
+            )
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+        results: List[EncodeResult] = []
+        for x in self._futures:
+            try:
+                results.append(x.result())
+            except Exception as e:
+                logger.error(f"Failed to encode a variant: {e}")
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.report(self.close())
+
+    def report(self, results: List[EncodeResult]):
+        if not results:
+            return
+
+        by_variant: Dict[Variant, List[EncodeResult]] = defaultdict(list)
+        for x in results:
+            by_variant[x.variant].append(x)
+
+        master_bytes = sum(self._master_bytes.values()) / len(self._master_bytes)
+
+        table = Table(title="Post-processed variants")
+        for col in ["variant", "images", "mean (KiB)", "vs master", "encode (ms)"]:
+            table.add_column(col, justify="right")
+        table.add_row(
+            "master", str(len(self._master_bytes)), f"{master_bytes / 1024:.1f}"
+        )
+        for variant, xs in by_variant.items():
+            mean_bytes = sum(x.bytes for x in xs) / len(xs)
+            encoded = [x.seconds for x in xs if x.seconds > 0]
+            table.add_row(
+                variant.name,
+                str(len(xs)),
+                f"{mean_bytes / 1024:.1f}",
+                f"{mean_bytes / master_bytes:.0%}",
+                f"{sum(encoded) / len(encoded) * 1000:.1f}" if encoded else "-",
+            )
+        console.print(table)
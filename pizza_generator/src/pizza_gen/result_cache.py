@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image
+
+from pizza_gen.guides import EncodedImage
+from pizza_gen.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Bump when the fingerprint layout changes
+FINGERPRINT_VERSION = 2
+
+# Request args that do not affect the generated image
+IGNORED_ARGS = ("alwayson_scripts", "use_async")
+
+
+def image_digest(image: Image.Image) -> str:
+    h = hashlib.sha256()
+    h.update(f"{image.mode}:{image.size}".encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, Image.Image):
+        return {"image_sha256": image_digest(value)}
+    if isinstance(value, EncodedImage):
+        return {"png_sha256": value.sha256}
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(x) for x in value]
+    if hasattr(value, "__dict__"):
+        # e.g. webuiapi.ControlNetUnit
+        return {"type": type(value).__name__, **_normalize(vars(value))}
+    return value
+
+
+def request_fingerprint(kind: str, args: Dict[str, Any]) -> str:
+    """
+    Fingerprint a request from its args (prompts, seed, sampler, steps, cfg, size,
+    ControlNet units and the contents of their images) before it is sent.
+    """
+    normalized = {
+        "version": FINGERPRINT_VERSION,
+        "kind": kind,
+        "args": _normalize({k: v for k, v in args.items() if k not in IGNORED_ARGS}),
+    }
+    data = json.dumps(normalized, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def is_cacheable(args: Dict[str, Any]):
+    # Random seeds never produce the same image twice
+    return args.get("seed", -1) != -1
+
+
+class ResultCache:
+    """
+    On-disk cache of generated images and their info, keyed by request fingerprint.
+    The least recently used entries are evicted once `max_bytes` is exceeded.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = 2 * 1024**3) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        self._total_bytes = sum(x.stat().st_size for x in self._files())
+
+    def _files(self):
+        return self.path.glob("*/*.*")
+
+    def _entry_paths(self, fingerprint: str):
+        base = self.path / fingerprint[:2] / fingerprint
+        return base.with_suffix(".png"), base.with_suffix(".json")
+
+    def get(self, fingerprint: str) -> Optional[Tuple[Image.Image, dict]]:
+        image_path, info_path = self._entry_paths(fingerprint)
+
+        try:
+            with info_path.open(encoding="utf-8") as fp:
+                info = json.load(fp)
+            with Image.open(image_path) as im:
+                im.load()
+                image = im.copy()
+        except (OSError, ValueError):
+            return None
+
+        # Mark as recently used
+        for x in (image_path, info_path):
+            os.utime(x)
+
+        logger.debug(f"Result cache hit: {fingerprint=}")
+        return image, info
+
+    def put(self, fingerprint: str, image: Image.Image, info: dict):
+        image_path, info_path = self._entry_paths(fingerprint)
+        image_path.parent.mkdir(exist_ok=True)
+
+        # Write to temporary files first, so readers never see partial entries
+        suffix = f".{os.getpid()}.tmp"
+        image_tmp = image_path.with_suffix(suffix)
+        info_tmp = info_path.with_suffix(f".info{suffix}")
+
+        image.save(image_tmp, format="PNG")
+        with info_tmp.open("w", encoding="utf-8") as fp:
+            json.dump(info, fp, ensure_ascii=False)
+
+        # An entry written again (e.g. by another process) replaces the old one
+        old_bytes = sum(x.stat().st_size for x in (image_path, info_path) if x.exists())
+        os.replace(image_tmp, image_path)
+        os.replace(info_tmp, info_path)
+
+        self._total_bytes += (
+            image_path.stat().st_size + info_path.stat().st_size - old_bytes
+        )
+        if self._total_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        # Image and info of an entry are evicted together, by their last use
+        entries: Dict[str, Tuple[float, int]] = {}
+        for x in self._files():
+            if x.name.endswith(".tmp"):
+                continue
+            try:
+                st = x.stat()
+            except FileNotFoundError:
+                continue
+            mtime, size = entries.get(x.stem, (0.0, 0))
+            entries[x.stem] = max(mtime, st.st_mtime), size + st.st_size
+
+        total = sum(size for _, size in entries.values())
+        # Leave some headroom to avoid evicting on every put
+        target = self.max_bytes * 0.9
+        for fingerprint, (_, size) in sorted(entries.items(), key=lambda x: x[1][0]):
+            if total <= target:
+                break
+            for x in self._entry_paths(fingerprint):
+                x.unlink(missing_ok=True)
+            total -= size
+
+        logger.debug(f"Evicted result cache entries: {self._total_bytes=} -> {total=}")
+        self._total_bytes = total
@@ -0,0 +1,162 @@
+import asyncio
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, List, Literal, Optional, cast
+
+import webuiapi
+
+from pizza_gen.candidates import batch_images
+from pizza_gen.logger import get_logger
+from pizza_gen.metrics import stage
+from pizza_gen.model_cache import (
+    ControlNetModelCache,
+    ModelNotFound,
+    is_model_rejection,
+)
+from pizza_gen.result_cache import ResultCache, is_cacheable, request_fingerprint
+
+logger = get_logger(__name__)
+
+Kind = Literal["txt2img", "img2img"]
+
+
+def _cached_result(images, info):
+    return webuiapi.WebUIApiResult(images=images, parameters={}, info=info, json={})
+
+
+def _cache_keys(fingerprint: str, args: Dict[str, Any]):
+    # Each image of a batch is stored on its own
+    batch_size = args.get("batch_size", 1)
+    if batch_size == 1:
+        return [fingerprint]
+    return [f"{fingerprint}-{i}" for i in range(batch_size)]
+
+
+def _cache_get(result_cache: ResultCache, keys: List[str]):
+    entries = []
+    for key in keys:
+        entry = result_cache.get(key)
+        if entry is None:
+            return None
+        entries.append(entry)
+    return _cached_result([x[0] for x in entries], entries[0][1])
+
+
+def _cache_put(
+    result_cache: ResultCache, keys: List[str], res: webuiapi.WebUIApiResult
+):
+    # The info of a batch describes all of its images, which are cached without
+    # the grid (if any)
+    info = res.info
+    if isinstance(info, dict) and info.get("index_of_first_image"):
+        info = {**info, "index_of_first_image": 0}
+    for key, image in zip(keys, batch_images(res, len(keys))):
+        result_cache.put(key, image, info)
+
+
+def _stamp(res: webuiapi.WebUIApiResult, fingerprint: str):
+    # Lets outputs be traced back to their request (see catalog.py)
+    if isinstance(res.info, dict):
+        res.info["request_fingerprint"] = fingerprint
+
+
+def _raise_if_model_rejection(error: RuntimeError, args: Dict[str, Any]):
+    # Still rejected with a fresh model list, so the server does not have it
+    if is_model_rejection(error, args):
+        raise ModelNotFound(f"The server rejected a ControlNet model: {error}")
+
+
+def run_request(
+    kind: Kind,
+    client: webuiapi.WebUIApi,
+    prepare_args: Callable[[], Dict[str, Any]],
+    model_cache: ControlNetModelCache,
+    result_cache: Optional[ResultCache] = None,
+) -> webuiapi.WebUIApiResult:
+    """
+    Call txt2img or img2img (`kind`) with `prepare_args()`.
+
+    - If `result_cache` has a result for the same request, return it instead. The
+      images of a batch (`batch_size`) are cached one by one.
+    - The request fingerprint is stored in `info["request_fingerprint"]`.
+    - If the server rejects a cached model name, refresh `model_cache` and retry once.
+    """
+    args = prepare_args()
+    generate = getattr(client, kind)
+
+    fingerprint = request_fingerprint(kind, args)
+    keys = _cache_keys(fingerprint, args)
+    if result_cache and is_cacheable(args):
+        with stage("result_cache"):
+            cached = _cache_get(result_cache, keys)
+        if cached:
+            return cached
+
+    try:
+        res = generate(**args, use_async=False)
+    except RuntimeError as e:
+        if not is_model_rejection(e, args):
+            raise
+        logger.warning("The server rejected a cached model name. Refreshing.")
+        model_cache.invalidate(client)
+        args = prepare_args()
+        try:
+            res = generate(**args, use_async=False)
+        except RuntimeError as e:
+            _raise_if_model_rejection(e, args)
+            raise
+    res = cast(webuiapi.WebUIApiResult, res)
+    _stamp(res, fingerprint)
+
+    if result_cache and is_cacheable(args):
+        with stage("result_cache"):
+            _cache_put(result_cache, keys, res)
+
+    return res
+
+
+async def arun_request(
+    kind: Kind,
+    client: webuiapi.WebUIApi,
+    prepare_args: Callable[[], Awaitable[Dict[str, Any]]],
+    model_cache: ControlNetModelCache,
+    result_cache: Optional[ResultCache] = None,
+) -> webuiapi.WebUIApiResult:
+    """Same as `run_request`, but with webuiapi's async API."""
+    args = await prepare_args()
+    generate = getattr(client, kind)
+
+    fingerprint = await asyncio.to_thread(request_fingerprint, kind, args)
+    keys = _cache_keys(fingerprint, args)
+    if result_cache and is_cacheable(args):
+        with stage("result_cache"):
+            cached = await asyncio.to_thread(_cache_get, result_cache, keys)
+        if cached:
+            return cached
+
+    try:
+        res = await generate(**args, use_async=True)
+    except RuntimeError as e:
+        if not is_model_rejection(e, args):
+            raise
+        logger.warning("The server rejected a cached model name. Refreshing.")
+        model_cache.invalidate(client)
+        args = await prepare_args()
+        try:
+            res = await generate(**args, use_async=True)
+        except RuntimeError as e:
+            _raise_if_model_rejection(e, args)
+            raise
+    res = cast(webuiapi.WebUIApiResult, res)
+    _stamp(res, fingerprint)
+
+    if result_cache and is_cacheable(args):
+        with stage("result_cache"):
+            await asyncio.to_thread(_cache_put, result_cache, keys, res)
+
+    return res
+
+
+run_txt2img = partial(run_request, "txt2img")
+run_img2img = partial(run_request, "img2img")
+arun_txt2img = partial(arun_request, "txt2img")
+arun_img2img = partial(arun_request, "img2img")
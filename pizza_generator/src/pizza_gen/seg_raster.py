@@ -0,0 +1,137 @@
+from functools import lru_cache
+from random import Random
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from .ade20k import ADE20K
+
+BACKGROUND = (255, 255, 255)
+
+# Relative to the image width, as in the original ImageDraw implementation
+PIZZA_DIAMETER_RATIO = 0.90
+DISH_INSET_PX = 10
+
+MAX_JITTER_DEG = 5
+
+# Label values of seg maps, rendered through PALETTE
+BACKGROUND_LABEL, DISH_LABEL, FOOD_LABEL = 0, 1, 2
+PALETTE = (BACKGROUND, ADE20K.ROCK, ADE20K.FOOD)
+
+
+@lru_cache(maxsize=8)
+def polar_grid(width: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return (angle, radius) of every pixel center, where the angle is in degrees
+    clockwise from 12 o'clock and the radius is in pixels from the image center.
+    """
+    coords = np.arange(width, dtype=np.float32) + 0.5 - width / 2
+    dx = coords[np.newaxis, :]
+    dy = coords[:, np.newaxis]
+
+    angle = np.degrees(np.arctan2(dx, -dy)) % 360
+    radius = np.hypot(dx, dy)
+
+    for x in (angle, radius):
+        x.flags.writeable = False
+
+    return angle, radius
+
+
+def pizza_radius(width: int):
+    return width * PIZZA_DIAMETER_RATIO / 2
+
+
+def dish_radius(width: int):
+    return pizza_radius(width) - DISH_INSET_PX
+
+
+def slice_labels(width: int, total_num_pieces: int) -> np.ndarray:
+    """Per-pixel slice index (0 = the slice right after 12 o'clock), -1 outside."""
+    angle, radius = polar_grid(width)
+
+    labels = (angle // (360 / total_num_pieces)).astype(np.int16)
+    labels[radius > pizza_radius(width)] = -1
+
+    return labels
+
+
+def pick_jitter(num_pieces: int, seed: Optional[int] = None) -> Tuple[int, int]:
+    """
+    Pick how far (in degrees) the pizza extends beyond its nominal start and end.
+    Only the outermost edges matter as inner slices overlap each other.
+    """
+    rng = Random(f"{seed}/{num_pieces}") if seed is not None else Random()
+    return rng.randint(0, MAX_JITTER_DEG), rng.randint(0, MAX_JITTER_DEG)
+
+
+@lru_cache(maxsize=8)
+def _base_layers(width: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return (labels with only the dish, flat indices of pizza pixels, their angles)"""
+    angle, radius = polar_grid(width)
+
+    # Draw a dish somewhat smaller than the pizza
+    # The "DISH" class is not suitable for rendering an empty dish
+    labels = np.full((width, width), BACKGROUND_LABEL, dtype=np.uint8)
+    labels[radius <= dish_radius(width)] = DISH_LABEL
+
+    pizza_indices = np.flatnonzero(radius <= pizza_radius(width))
+    pizza_angles = angle.ravel()[pizza_indices]
+
+    for x in (labels, pizza_indices, pizza_angles):
+        x.flags.writeable = False
+
+    return labels, pizza_indices, pizza_angles
+
+
+def render_seg_labels(
+    width: int,
+    num_pieces: int,
+    total_num_pieces: int,
+    start_jitter: int = 0,
+    end_jitter: int = 0,
+) -> np.ndarray:
+    base_labels, pizza_indices, pizza_angles = _base_layers(width)
+    labels = base_labels.copy()
+
+    if num_pieces <= 0:
+        return labels
+
+    # Draw pieces of pizza as a single sector from `start` to `end` (clockwise)
+    start = -start_jitter
+    end = 360 / total_num_pieces * num_pieces + end_jitter
+    if end - start >= 360:
+        in_sector = slice(None)
+    elif start < 0:
+        in_sector = (pizza_angles >= 360 + start) | (pizza_angles <= end)
+    else:
+        in_sector = (pizza_angles >= start) & (pizza_angles <= end)
+
+    labels.ravel()[pizza_indices[in_sector]] = FOOD_LABEL
+
+    return labels
+
+
+@lru_cache(maxsize=64)
+def render_seg_map(
+    width: int,
+    num_pieces: int,
+    total_num_pieces: int,
+    start_jitter: int = 0,
+    end_jitter: int = 0,
+) -> Image.Image:
+    """
+    Render a segmentation map with `num_pieces` of `total_num_pieces` slices on a
+    dish, starting at 12 o'clock and going clockwise.
+
+    Results are shared through an LRU cache, so do not modify the returned image.
+    """
+    labels = render_seg_labels(
+        width, num_pieces, total_num_pieces, start_jitter, end_jitter
+    )
+
+    im = Image.fromarray(labels, mode="P")
+    im.putpalette([c for color in PALETTE for c in color])
+
+    return im.convert("RGB")
@@ -0,0 +1,147 @@
+import json
+import subprocess
+import sys
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+from rich.table import Table
+
+from pizza_gen.logger import console
+
+# Modules that must not be loaded by merely importing a CLI, as shell loops (see
+# README) start one process per image
+HEAVY_MODULES = ("litellm", "webuiapi", "PIL", "numpy", "aiohttp", "pydantic", "rich")
+
+# Prints the seconds and the loaded modules of importing the module given in argv
+_IMPORT_SCRIPT = """
+import json, sys, time
+started_at = time.perf_counter()
+__import__(sys.argv[1])
+seconds = time.perf_counter() - started_at
+print(json.dumps({"seconds": seconds, "modules": sorted(sys.modules)}))
+"""
+
+# Runs the app of the module given in argv, with the remaining args
+_HELP_SCRIPT = "import importlib, sys; importlib.import_module(sys.argv.pop(1)).app()"
+
+
+@dataclass
+class EntryPoint:
+    name: str
+    module: str
+    # Budgets in seconds, measured with ~2x headroom (best of a few runs)
+    import_budget: float
+    help_budget: float
+
+
+ENTRY_POINTS = [
+    EntryPoint("pizza_gen", "pizza_gen.cli", import_budget=0.3, help_budget=0.8),
+    EntryPoint(
+        "circular_prompt_gen",
+        "circular_prompt_gen.cli",
+        import_budget=0.3,
+        help_budget=0.8,
+    ),
+]
+
+
+@dataclass
+class StartupResult:
+    entry_point: EntryPoint
+    import_seconds: float
+    help_seconds: float
+    heavy_modules: List[str] = field(default_factory=list)
+    # Packages spending the most time importing, with their seconds
+    slowest: List[Tuple[str, float]] = field(default_factory=list)
+
+    def problems(self):
+        problems = []
+        if self.heavy_modules:
+            problems.append(f"imports {', '.join(self.heavy_modules)}")
+        if self.import_seconds > self.entry_point.import_budget:
+            problems.append(
+                f"import took {self.import_seconds:.3f}s "
+                f"(budget: {self.entry_point.import_budget}s)"
+            )
+        if self.help_seconds > self.entry_point.help_budget:
+            problems.append(
+                f"--help took {self.help_seconds:.3f}s "
+                f"(budget: {self.entry_point.help_budget}s)"
+            )
+        return problems
+
+
+def parse_importtime(stderr: str, top: int = 5):
+    """Self time of `-X importtime` summed by top-level package, slowest first."""
+    seconds: Counter[str] = Counter()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, _, name = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            # The header
+            continue
+        seconds[name.strip().split(".")[0]] += int(self_us) / 1e6
+    return seconds.most_common(top)
+
+
+def _run(args: List[str]):
+    return subprocess.run(
+        [sys.executable, *args], capture_output=True, text=True, check=True
+    )
+
+
+def measure_import(module: str, repeat: int):
+    """Best-of-`repeat` seconds of importing `module` in a fresh interpreter."""
+    best: Optional[dict] = None
+    stderr = ""
+    for _ in range(repeat):
+        proc = _run(["-X", "importtime", "-c", _IMPORT_SCRIPT, module])
+        res = json.loads(proc.stdout)
+        if best is None or res["seconds"] < best["seconds"]:
+            best, stderr = res, proc.stderr
+    assert best is not None
+    return best["seconds"], best["modules"], parse_importtime(stderr)
+
+
+def measure_help(module: str, repeat: int):
+    """Best-of-`repeat` wall time of `--help`, including interpreter startup."""
+    times = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        _run(["-c", _HELP_SCRIPT, module, "--help"])
+        times.append(time.perf_counter() - started_at)
+    return min(times)
+
+
+def check_startup(entry_points: List[EntryPoint] = ENTRY_POINTS, repeat: int = 3):
+    results = []
+    for x in entry_points:
+        import_seconds, modules, slowest = measure_import(x.module, repeat)
+        loaded = {m.split(".")[0] for m in modules}
+        results.append(
+            StartupResult(
+                x,
+                import_seconds,
+                measure_help(x.module, repeat),
+                [m for m in HEAVY_MODULES if m in loaded],
+                slowest,
+            )
+        )
+    return results
+
+
+def print_startup_report(results: List[StartupResult]):
+    table = Table(title="CLI startup")
+    for col in ["entry point", "import (ms)", "--help (ms)", "slowest imports (ms)"]:
+        table.add_column(col, justify="right")
+    for x in results:
+        table.add_row(
+            x.entry_point.name,
+            f"{x.import_seconds * 1000:.0f}",
+            f"{x.help_seconds * 1000:.0f}",
+            ", ".join(f"{name} {s * 1000:.0f}" for name, s in x.slowest),
+        )
+    console.print(table)
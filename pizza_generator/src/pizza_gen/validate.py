@@ -0,0 +1,113 @@
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Tuple
+
+import numpy as np
+from PIL import Image
+
+from pizza_gen.seg_raster import dish_radius, polar_grid, slice_labels
+
+
+@dataclass
+class SliceReport:
+    num_pieces: int
+    total_num_pieces: int
+    # Slices that are mostly food
+    detected: int
+    # Slices that should have food but do not, or vice versa
+    wrong_slices: int
+    # Mean food ratio of slices that should have food
+    food_overlap: float
+    # Mean non-food ratio of slices that should be empty
+    plate_emptiness: float
+    valid: bool
+
+    @property
+    def score(self):
+        """Higher is better, in [-1, 1]."""
+        penalty = self.wrong_slices / self.total_num_pieces
+        return (self.food_overlap + self.plate_emptiness) / 2 - penalty
+
+    def summary(self):
+        return (
+            f"{self.detected}/{self.num_pieces} slices detected, "
+            f"overlap {self.food_overlap:.2f}, emptiness {self.plate_emptiness:.2f}"
+        )
+
+
+@lru_cache(maxsize=8)
+def _slice_index(
+    width: int, total_num_pieces: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return (flat indices of pixels on the dish, their slices, pixels per slice)"""
+    _, radius = polar_grid(width)
+    labels = slice_labels(width, total_num_pieces).ravel()
+
+    # The crust beyond the dish is part of the pizza whether eaten or not
+    indices = np.flatnonzero(radius.ravel() <= dish_radius(width))
+    slices = labels[indices]
+    counts = np.bincount(slices, minlength=total_num_pieces)
+
+    for x in (indices, slices, counts):
+        x.flags.writeable = False
+
+    return indices, slices, counts
+
+
+@dataclass
+class SliceValidator:
+    """
+    Check that an image shows `num_pieces` slices where the seg map put them.
+
+    Pixels are classified by chroma (max - min of RGB): pizza is far more saturated
+    than the plate, which the default prompts ask to be empty. Each slice is then
+    counted as food if more than half of its pixels are.
+    """
+
+    # Pixels with a higher chroma count as food
+    chroma_threshold: int = 48
+    min_overlap: float = 0.6
+    min_emptiness: float = 0.8
+
+    def food_mask(self, image: Image.Image) -> np.ndarray:
+        arr = np.asarray(image.convert("RGB"))
+        r, g, b = arr[..., 0], arr[..., 1], arr[..., 2]
+        # Much faster than reducing over the last axis
+        chroma = np.maximum(np.maximum(r, g), b) - np.minimum(np.minimum(r, g), b)
+        return chroma > self.chroma_threshold
+
+    def validate(
+        self, image: Image.Image, num_pieces: int, total_num_pieces: int
+    ) -> SliceReport:
+        if image.width != image.height:
+            raise Exception(f"Expected a square image, got {image.size}.")
+
+        indices, slices, counts = _slice_index(image.width, total_num_pieces)
+        food = self.food_mask(image).ravel()[indices]
+
+        food_counts = np.bincount(slices[food], minlength=total_num_pieces)
+        food_ratio = food_counts / np.maximum(counts, 1)
+
+        # Slices are filled clockwise from 12 o'clock
+        expected = np.arange(total_num_pieces) < num_pieces
+        has_food = food_ratio > 0.5
+
+        food_overlap = food_ratio[expected].mean() if expected.any() else 1.0
+        plate_emptiness = (
+            1 - food_ratio[~expected].mean() if not expected.all() else 1.0
+        )
+        wrong_slices = int((has_food != expected).sum())
+
+        return SliceReport(
+            num_pieces=num_pieces,
+            total_num_pieces=total_num_pieces,
+            detected=int(has_food.sum()),
+            wrong_slices=wrong_slices,
+            food_overlap=float(food_overlap),
+            plate_emptiness=float(plate_emptiness),
+            valid=bool(
+                wrong_slices == 0
+                and food_overlap >= self.min_overlap
+                and plate_emptiness >= self.min_emptiness
+            ),
+        )
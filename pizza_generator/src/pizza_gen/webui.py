@@ -0,0 +1,115 @@
+import time
+from contextvars import ContextVar
+from typing import Any, Mapping, Optional
+from urllib.parse import urlparse
+
+import aiohttp
+import requests
+import webuiapi
+
+from pizza_gen.metrics import record_size, record_time, stage
+
+# When the current txt2img or img2img call started building its payload
+_encode_started_at: ContextVar[Optional[float]] = ContextVar(
+    "encode_started_at", default=None
+)
+
+
+def _payload_size(value: Any) -> int:
+    """Roughly the size of `value` as JSON, dominated by base64 images."""
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(len(k) + _payload_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(_payload_size(x) for x in value)
+    return 8
+
+
+def _record_response(headers: Mapping[str, str], size: int):
+    record_size("response", size)
+    # Set by stable-diffusion-webui's API middleware
+    if process_time := headers.get("X-Process-Time"):
+        try:
+            record_time("server", float(process_time))
+        except ValueError:
+            pass
+
+
+class InstrumentedWebUIApi(webuiapi.WebUIApi):
+    """
+    Records how long txt2img and img2img requests take to encode (e.g. ControlNet
+    images to base64 PNG), to get a response and to decode it, in the metrics being
+    collected.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.session.hooks["response"].append(self._on_response)
+
+    def _on_response(self, response: requests.Response, *args, **kwargs):
+        # Skip GETs such as the model list, which are timed as their own stage
+        if response.request.method == "POST":
+            record_time("request", response.elapsed.total_seconds())
+            _record_response(response.headers, len(response.content))
+
+    def txt2img(self, *args, **kwargs):
+        token = _encode_started_at.set(time.perf_counter())
+        try:
+            return super().txt2img(*args, **kwargs)
+        finally:
+            _encode_started_at.reset(token)
+
+    def img2img(self, *args, **kwargs):
+        token = _encode_started_at.set(time.perf_counter())
+        try:
+            return super().img2img(*args, **kwargs)
+        finally:
+            _encode_started_at.reset(token)
+
+    def post_and_get_api_result(self, url, json, use_async):
+        if started_at := _encode_started_at.get():
+            record_time("encode", time.perf_counter() - started_at)
+            record_size("request", _payload_size(json))
+        return super().post_and_get_api_result(url, json, use_async)
+
+    def _to_api_result(self, response):
+        with stage("decode"):
+            return super()._to_api_result(response)
+
+    async def _to_api_result_async(self, response):
+        with stage("decode"):
+            return await super()._to_api_result_async(response)
+
+    async def async_post(self, url, json):
+        # Same as webuiapi's, but times the request
+        auth = None
+        if self.session.auth:
+            auth = aiohttp.BasicAuth(*self.session.auth)  # type: ignore
+
+        timeout = aiohttp.ClientTimeout(total=None)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            started_at = time.perf_counter()
+            async with session.post(url, json=json, auth=auth) as response:
+                body = await response.read()
+                record_time("request", time.perf_counter() - started_at)
+                _record_response(response.headers, len(body))
+                return await self._to_api_result_async(response)
+
+
+def create_client(url: str):
+    parsed = urlparse(url)
+
+    if parsed.hostname is None:
+        raise Exception("Failed to get hostname.")
+    if parsed.port is None:
+        raise Exception("Failed to get port.")
+
+    return InstrumentedWebUIApi(
+        host=parsed.hostname, port=parsed.port, use_https=parsed.scheme == "https"
+    )
+
+
+def server_root(client: webuiapi.WebUIApi):
+    """Return e.g. 'http://127.0.0.1:7860' for a client."""
+    return client.baseurl.removesuffix("/sdapi/v1")
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from pizza_gen.mock_server import MockConfig, MockSDServer
+from pizza_gen.pool import NoServerAvailable, ServerPool
+
+
+def txt2img(client):
+    return asyncio.to_thread(
+        client.txt2img, prompt="pizza", width=64, height=64, steps=1
+    )
+
+
+@pytest.fixture
+def servers():
+    with (
+        MockSDServer() as good,
+        MockSDServer(MockConfig(error_rate=1.0)) as bad,
+    ):
+        yield good, bad
+
+
+def test_failover(servers):
+    good, bad = servers
+
+    async def run():
+        async with ServerPool([bad.url, good.url], failure_backoff=60) as pool:
+            results = await pool.map([txt2img] * 4)
+            return results, pool.servers
+
+    results, (bad_server, good_server) = asyncio.run(run())
+
+    assert all(x.image is not None for x in results)
+    assert good_server.completed == 4
+    # Backed off after its first failure, so the other jobs went elsewhere
+    assert bad_server.failed == 1
+    assert not bad_server.healthy
+    assert bad.stats.errors == 1
+
+
+def test_no_server_available(servers):
+    _, bad = servers
+
+    async def run():
+        async with ServerPool([bad.url], max_attempts=2, failure_backoff=0) as pool:
+            await pool.submit(txt2img)
+
+    with pytest.raises(NoServerAvailable):
+        asyncio.run(run())
+    assert bad.stats.errors == 2
+
+
+def test_client_errors_are_not_retried(servers):
+    good, _ = servers
+
+    async def submit_missing():
+        async with ServerPool([good.url], max_attempts=3) as pool:
+            with pytest.raises(RuntimeError):
+                await pool.submit(
+                    lambda client: asyncio.to_thread(client.custom_post, "missing")
+                )
+            return pool.servers[0]
+
+    server = asyncio.run(submit_missing())
+    # A 404 would fail on any server: neither retried nor held against the server
+    assert server.failed == 0
+    assert server.healthy
@@ -0,0 +1,25 @@
+import os
+
+from pizza_gen.startup import ENTRY_POINTS, EntryPoint, check_startup
+
+
+def test_entry_points_within_budget():
+    for x in check_startup(ENTRY_POINTS):
+        assert x.problems() == [], x.entry_point.name
+
+
+def test_heavy_and_slow_entry_point(tmp_path, monkeypatch):
+    (tmp_path / "heavy_cli.py").write_text("import numpy\n\napp = print\n")
+    monkeypatch.setenv(
+        "PYTHONPATH", os.pathsep.join([str(tmp_path), os.environ.get("PYTHONPATH", "")])
+    )
+
+    entry_point = EntryPoint("heavy", "heavy_cli", import_budget=0, help_budget=0)
+    (res,) = check_startup([entry_point], repeat=1)
+
+    assert res.heavy_modules == ["numpy"]
+    assert "numpy" in dict(res.slowest)
+    problems = res.problems()
+    assert problems[0] == "imports numpy"
+    assert problems[1].startswith("import took")
+    assert problems[2].startswith("--help took")